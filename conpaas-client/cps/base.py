@@ -130,15 +130,101 @@ class BaseClient(object):
         raise Exception, "Call to method %s on %s failed: %s.\nParams = %s" % (
             method, service['manager'], res[1], data)
 
+    def callmanager_file(self, service_id, method, data, destfile):
+        """Call a manager API method returning a file.
+
+        The file is written to 'destfile' while it is downloaded. Return
+        None on success, or the manager response as callmanager does (eg:
+        an error message).
+        """
+        service = self.service_dict(service_id)
+
+        dest = open(destfile, 'w')
+        try:
+            res = https.client.jsonrpc_get_file(service['manager'], 443, '/',
+                                                method, dest, data)
+        finally:
+            dest.close()
+
+        if res[1] is None:
+            return None
+
+        os.remove(destfile)
+
+        if res[0] == 200:
+            try:
+                data = simplejson.loads(res[1])
+            except simplejson.decoder.JSONDecodeError:
+                return res[1]
+
+            return data.get('result', data)
+
+        raise Exception, "Call to method %s on %s failed: %s.\nParams = %s" % (
+            method, service['manager'], res[1], data)
+
+    # Longest time the manager is asked to wait for a state at once
+    WAIT_TIMEOUT = 60
+
+    # Delays between polls, for managers which cannot be reached or do not
+    # support wait_for_state
+    MIN_POLL_DELAY = 1
+    MAX_POLL_DELAY = 30
+
     def wait_for_state(self, sid, state):
-        """Poll the state of service 'sid' till it matches 'state'."""
-        res = { 'state': None }
+        """Wait till the state of service 'sid' matches 'state'.
 
-        while res['state'] != state:
+        The manager is asked to answer once it gets in that state. Older
+        managers are polled, less and less often."""
+        delay = self.MIN_POLL_DELAY
+        # Cleared once the manager turns out not to support wait_for_state
+        wait = True
+
+        while True:
             try:
+                if wait:
+                    try:
+                        res = self.callmanager(sid, "wait_for_state", False,
+                            { 'states': [ state ],
+                              'timeout': self.WAIT_TIMEOUT })
+                    except (socket.error, urllib2.URLError):
+                        raise
+                    except Exception:
+                        # Older managers answer 404
+                        wait = False
+                        res = None
+
+                    if type(res) is dict and 'reached' in res:
+                        if res['reached']:
+                            return
+
+                        # The manager waited for WAIT_TIMEOUT, ask again
+                        delay = self.MIN_POLL_DELAY
+                        continue
+
                 res = self.callmanager(sid, "get_service_info", False, {})
+                if res['state'] == state:
+                    return
             except (socket.error, urllib2.URLError):
-                time.sleep(2)
+                pass
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.MAX_POLL_DELAY)
+
+    def wait_for_job(self, jid):
+        """Poll the director till job 'jid' is over. Return the job."""
+        res = self.callapi("job/%s" % jid, False, {})
+
+        while res and res['state'] in ('PENDING', 'RUNNING'):
+            time.sleep(2)
+            res = self.callapi("job/%s" % jid, False, {})
+
+        if not res:
+            raise Exception("Job %s not found" % jid)
+
+        if res['state'] == 'ERROR':
+            raise Exception(res['msg'])
+
+        return res
 
     def createapp(self, app_name):
         print "Creating new application... "
@@ -160,8 +246,15 @@ class BaseClient(object):
             res = self.callapi("start/" + service_type + '/' + cloud, True, data)
         sid = res['sid']
 
-        print "Creating new manager on " + res['manager'] + "... ",
-        sys.stdout.flush()
+        if 'jid' in res:
+            # The director starts the manager in the background
+            print "Creating new manager... ",
+            sys.stdout.flush()
+
+            self.wait_for_job(res['jid'])
+        else:
+            print "Creating new manager on " + res['manager'] + "... ",
+            sys.stdout.flush()
 
         self.wait_for_state(sid, initial_state)
 
@@ -326,12 +419,16 @@ class BaseClient(object):
                 print service
 
     def upload_startup_script(self, service_id, filename):
-        contents = open(filename).read()
+        # The file is read while it is being uploaded
+        contents = open(filename)
 
         files = [ ( 'script', filename, contents ) ]
 
-        res = self.callmanager(service_id, "/", True, 
-            { 'method': 'upload_startup_script', }, files)
+        try:
+            res = self.callmanager(service_id, "/", True, 
+                { 'method': 'upload_startup_script', }, files)
+        finally:
+            contents.close()
 
         if 'error' in res:
             print res['error']
@@ -22,22 +22,30 @@ class WebClient(BaseClient):
             print
 
     def upload_key(self, service_id, filename):
-        contents = open(filename).read()
+        # The file is read while it is being uploaded
+        contents = open(filename)
 
         files = [ ( 'key', filename, contents ) ]
 
-        res = self.callmanager(service_id, "/", True, { 'method': "upload_authorized_key",  }, files)
+        try:
+            res = self.callmanager(service_id, "/", True, { 'method': "upload_authorized_key",  }, files)
+        finally:
+            contents.close()
         if 'error' in res:
             print res['error']
         else:
             print res['outcome']
 
     def upload_code(self, service_id, filename):
-        contents = open(filename).read()
+        # The file is read while it is being uploaded
+        contents = open(filename)
 
         files = [ ( 'code', filename, contents ) ]
 
-        res = self.callmanager(service_id, "/", True, { 'method': "upload_code_version",  }, files)
+        try:
+            res = self.callmanager(service_id, "/", True, { 'method': "upload_code_version",  }, files)
+        finally:
+            contents.close()
         if 'error' in res:
             print res['error']
         else:
@@ -46,17 +54,16 @@ class WebClient(BaseClient):
     def download_code(self, service_id, version):
         params = { 'codeVersionId': version }
 
-        res = self.callmanager(service_id, "download_code_version", 
-            False, params)
+        destfile = os.path.join(os.getenv('TMPDIR', '/tmp'), version) + '.tar.gz'
+        res = self.callmanager_file(service_id, "download_code_version", 
+            params, destfile)
 
-        if 'error' in res:
-            print res['error']
-
-        else:
-            destfile = os.path.join(os.getenv('TMPDIR', '/tmp'), version) + '.tar.gz'
-            open(destfile, 'w').write(res)
+        if res is None:
             print destfile, 'written'
 
+        elif 'error' in res:
+            print res['error']
+
     def usage(self, cmdname):
         BaseClient.usage(self, cmdname)
         print "    add_nodes         serviceid b w p [cloud]     # add    b backend, w web and p proxy nodes"
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Measure how many manager requests per second the director handles on
+the test database, with and without the client certificate cache: for
+the credit callback, and for a route doing nothing but authentication.
+
+Usage: python benchmark.py [requests]
+"""
+
+import os
+import sys
+import time
+
+os.environ['DIRECTOR_TESTING'] = "true"
+
+import cpsdirector
+
+from sqlalchemy import event
+
+from conpaas.core.https import x509
+
+queries = [ 0 ]
+
+def count_query(*args):
+    queries[0] += 1
+
+def manager_certificate(uid, sid):
+    """Return a manager certificate for service sid of user uid, signed by
+    a throwaway CA"""
+    ca_key = x509.gen_rsa_keypair()
+    ca_req = x509.create_x509_req(ca_key, CN='Benchmark CA')
+    ca_cert = x509.create_cert(ca_req, ca_req, ca_key, 1, 0, 3600)
+
+    key = x509.gen_rsa_keypair()
+    req = x509.create_x509_req(key, userId=str(uid), serviceLocator=str(sid),
+                               O='ConPaaS', CN='ConPaaS', role='manager')
+    return x509.cert_as_pem(x509.create_cert(req, ca_cert, ca_key, 2, 0, 3600))
+
+@cpsdirector.user.cert_required(role='manager')
+def authenticate():
+    return 'ok'
+
+cpsdirector.app.add_url_rule('/benchmark/authenticate', 'authenticate',
+                             authenticate, methods=['POST'])
+
+ROUTES = [ ('Credit callback', '/callback/decrementUserCredit.php'),
+           ('Authentication only', '/benchmark/authenticate') ]
+
+def run(client, cert, route, requests):
+    """Return the number of requests to route handled per second, and the
+    number of database queries per request"""
+    environ = { 'SSL_CLIENT_CERT': cert }
+    data = { 'sid': 1, 'decrement': 0 }
+
+    queries[0] = 0
+    start = time.time()
+    for _ in range(requests):
+        response = client.post(route, data=data, environ_base=environ)
+        assert response.status_code == 200 and response.data != 'false'
+    return (requests / (time.time() - start),
+            float(queries[0]) / requests)
+
+def main(requests):
+    cpsdirector.db.drop_all()
+    cpsdirector.db.create_all()
+
+    uid = cpsdirector.user.create_user('benchmark', 'Bench', 'Mark',
+        'benchmark@example.org', 'ConPaaS', 'password', 1000).uid
+    client = cpsdirector.app.test_client()
+    client.post('/start/php', data={ 'uid': uid })
+
+    cert = manager_certificate(uid, 1)
+    event.listen(cpsdirector.db.engine, 'before_cursor_execute', count_query)
+
+    # Check the actual certificate from now on
+    del os.environ['DIRECTOR_TESTING']
+
+    cache = cpsdirector.user.cert_cache
+    ttl = cache.ttl
+
+    for name, route in ROUTES:
+        # Entries expire right away: every request parses the certificate
+        # and checks the service owner
+        cache.ttl = -1
+        cache.clear()
+        uncached = run(client, cert, route, requests)
+
+        cache.ttl = ttl
+        cache.clear()
+        cached = run(client, cert, route, requests)
+
+        print '%s (%s requests)' % (name, requests)
+        print '  without certificate cache: %8.1f requests/s, %.1f queries/request' % uncached
+        print '  with certificate cache:    %8.1f requests/s, %.1f queries/request' % cached
+        print '  speedup:                   %8.2fx' % (cached[0] / uncached[0])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(2000)
@@ -33,6 +33,9 @@ app.register_blueprint(cloud.cloud_page)
 from cpsdirector import manifest
 app.register_blueprint(manifest.manifest_page)
 
+from cpsdirector import job
+app.register_blueprint(job.job_page)
+
 if __name__ == "__main__":
     db.create_all()
     app.run(host="0.0.0.0", debug=True)
@@ -15,7 +15,9 @@ from flask import jsonify, request, g
 import simplejson
 
 import ConfigParser
-from netaddr import IPNetwork
+from netaddr import IPNetwork, IPAddress
+
+from sqlalchemy import event, func
 
 from cpsdirector import db
 
@@ -46,27 +48,111 @@ class Application(db.Model):
             'aid': self.aid, 'name': self.name,
         }
 
-    def get_available_vpn_subnet(self):
-        """Find an available VPN subnet for the next service to be created in
-        this application."""
-        try:
-            network = config_parser.get('conpaas', 'VPN_BASE_NETWORK')
-            netmask = config_parser.get('conpaas', 'VPN_NETMASK')
-            srvbits = config_parser.get('conpaas', 'VPN_SERVICE_BITS')
-        except ConfigParser.NoOptionError:
+    def allocate_vpn_subnet(self, service):
+        """Assign a free VPN subnet to service, which must have been flushed
+        already. The assignment is part of the current session.
+
+        @param service The new service of this application
+
+        @return The subnet, or None if there is no VPN or no subnet left
+        """
+        vpn = _vpn_config()
+        if not vpn:
+            return
+
+        table = VpnSubnet.__table__
+        mine = table.c.application_id == self.aid
+
+        # Reuse the lowest subnet released by a deleted service
+        while True:
+            free = db.session.query(VpnSubnet.number).filter_by(
+                application_id=self.aid, service_id=None).order_by(
+                VpnSubnet.number).first()
+            if free is None:
+                break
+
+            result = db.session.execute(table.update().where(
+                mine & (table.c.number == free[0]) &
+                (table.c.service_id == None)).values(service_id=service.sid))
+            if result.rowcount == 1:
+                return _vpn_subnet(vpn, free[0])
+
+        # Otherwise take the next one
+        last = db.session.query(func.max(VpnSubnet.number)).filter(
+            mine).scalar()
+        if last is None and self._import_vpn_subnets(vpn, service) >= 0:
+            # Start again, with the subnets left free by older services
+            db.session.flush()
+            return self.allocate_vpn_subnet(service)
+        elif last is None:
+            last = -1
+
+        number = last + 1
+        base_net, prefixlen = vpn
+        if number >= 2 ** (prefixlen - base_net.prefixlen):
+            log('No VPN subnet left in application %s' % self.aid)
             return
-            
-        # Split the given network into subnets. 
-        base_net = IPNetwork(network + '/' + netmask)
-        vpn_subnets = base_net.subnet(32 - base_net.prefixlen - int(srvbits))
 
-        assigned_networks = [ service.subnet for service in self.services ]
+        db.session.add(VpnSubnet(application_id=self.aid, number=number,
+                                 service_id=service.sid))
+        return _vpn_subnet(vpn, number)
+
+    def _import_vpn_subnets(self, vpn, service):
+        """Record the subnets of the services created before the VPN
+        subnets table existed. Return the highest subnet number in use, or
+        -1 if there is none."""
+        services = db.session.query(Service.subnet, Service.sid).filter(
+            Service.application_id == self.aid, Service.subnet != None,
+            Service.sid != service.sid)
+        assigned = dict((_vpn_subnet_number(vpn, subnet), sid)
+                        for subnet, sid in services)
+
+        last = max(assigned.keys() + [ -1 ])
+        for number in range(last + 1):
+            db.session.add(VpnSubnet(application_id=self.aid, number=number,
+                                     service_id=assigned.get(number)))
+        return last
+
+class VpnSubnet(db.Model):
+    """VPN subnet number 'number' of an application, assigned to service
+    'service_id' or free if it is None.
+
+    Subnets are numbered from the start of VPN_BASE_NETWORK. Those of an
+    application are recorded once taken, and kept when released so that
+    finding a free one is a single indexed lookup."""
+    application_id = db.Column(db.Integer, db.ForeignKey('application.aid'),
+                               primary_key=True)
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    service_id = db.Column(db.Integer, index=True)
+
+    __table_args__ = (db.Index('ix_vpn_subnet_free', 'application_id',
+                               'service_id', 'number'), )
 
-        for candidate_network in vpn_subnets:
-            candidate_network = str(candidate_network)
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+def _vpn_config():
+    """Return the VPN base network and the prefix length of the subnet of
+    each service, or None if no VPN is configured."""
+    try:
+        network = config_parser.get('conpaas', 'VPN_BASE_NETWORK')
+        netmask = config_parser.get('conpaas', 'VPN_NETMASK')
+        srvbits = config_parser.get('conpaas', 'VPN_SERVICE_BITS')
+    except ConfigParser.NoOptionError:
+        return
 
-            if candidate_network not in assigned_networks:
-                return candidate_network
+    base_net = IPNetwork(network + '/' + netmask)
+    return base_net, 32 - base_net.prefixlen - int(srvbits)
+
+def _vpn_subnet(vpn, number):
+    base_net, prefixlen = vpn
+    first = base_net.first + number * 2 ** (32 - prefixlen)
+    return '%s/%s' % (IPAddress(first), prefixlen)
+
+def _vpn_subnet_number(vpn, subnet):
+    base_net, prefixlen = vpn
+    return (IPNetwork(subnet).first - base_net.first) / 2 ** (32 - prefixlen)
 
 def get_app_by_id(user_id, app_id):
     app = Application.query.filter_by(aid=app_id).first()
@@ -137,7 +223,21 @@ def createapp():
 
 from cpsdirector.service import Service
 from cpsdirector.service import stop
-from cpsdirector.service import callmanager
+from cpsdirector.service import callmanagers
+
+def _release_vpn_subnet(mapper, connection, service):
+    table = VpnSubnet.__table__
+    connection.execute(table.update().where(
+        table.c.service_id == service.sid).values(service_id=None))
+
+def _forget_vpn_subnets(mapper, connection, app):
+    table = VpnSubnet.__table__
+    connection.execute(table.delete().where(
+        table.c.application_id == app.aid))
+
+# Released along with the service, in the same transaction
+event.listen(Service, 'after_delete', _release_vpn_subnet)
+event.listen(Application, 'before_delete', _forget_vpn_subnets)
 
 @application_page.route("/delete/<int:appid>", methods=['POST'])
 @cert_required(role='user')
@@ -156,8 +256,22 @@ def delete(appid):
         return build_response(simplejson.dumps(False))
 
     # If an application with id 'appid' exists and user is the owner
-    for service in Service.query.filter_by(application_id=appid):
-        callmanager(service.sid, "shutdown", True, {})
+    services = Service.query.filter_by(application_id=appid).all()
+
+    # Their managers could not be stopped
+    if [ service for service in services if service.state == 'PREINIT' ]:
+        log('Application %s has services whose manager is starting' % appid)
+        return build_response(simplejson.dumps(False))
+
+    # Shut all the services down at once
+    outcome = callmanagers([ service for service in services
+                             if service.manager ], "shutdown", True, {})
+    for manager, exc_info in outcome.errors:
+        log('Failed to shut down the manager at %s: %s' % (manager,
+                                                           exc_info[1]))
+    outcome.check()
+
+    for service in services:
         stop(service.sid)
 
     db.session.delete(app)
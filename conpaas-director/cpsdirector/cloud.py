@@ -1,22 +1,28 @@
 import os.path
 import simplejson
 
+from ConfigParser import ConfigParser
+
 from netaddr import IPNetwork
 
 from conpaas.core.controller import Controller
+from conpaas.core.context import context_cache
 from conpaas.core.misc import file_get_contents
 from conpaas.core.node import ServiceNode
 
 from cpsdirector.x509cert import generate_certificate
 from cpsdirector.common import config_parser, log
 from cpsdirector.user import User
-from cpsdirector import db
+from cpsdirector import db, credit
 
 from flask import Blueprint
 cloud_page = Blueprint('cloud_page', __name__)
 
 class ManagerController(Controller):
 
+    # Manager keys are generated by generate_certificate
+    KEY_POOL_SIZE = 0
+
     def __init__(self, service_name, service_id, user_id, cloud_name, app_id, vpn):
         self.config_parser = self.__get_config(str(service_id), str(user_id),
                                                str(app_id), service_name, vpn)
@@ -47,22 +53,19 @@ class ManagerController(Controller):
 
         director = self.config_parser.get('director', 'DIRECTOR_URL')
 
-        # Values to be passed to the context file template
-        tmpl_values = {}
-
-        # Get contextualization script for the cloud
-        try:
-            tmpl_values['cloud_script'] = file_get_contents(
-                os.path.join(cloud_scripts_dir, cloud))
-        except IOError:
-            tmpl_values['cloud_script'] = ''
-
-        # Get manager setup file
-        mngr_setup = file_get_contents(
-            os.path.join(mngr_scripts_dir, 'manager-setup'))
+        paths = [ os.path.join(cloud_scripts_dir, cloud),
+                  os.path.join(mngr_scripts_dir, 'manager-setup'),
+                  os.path.join(mngr_cfg_dir, 'default-manager.cfg'),
+                  os.path.join(mngr_cfg_dir, service_name + '-manager.cfg'),
+                  os.path.join(mngr_scripts_dir, 'default-manager-start'),
+                  os.path.join(mngr_scripts_dir,
+                               service_name + '-manager-start') ]
 
-        tmpl_values['mngr_setup'] = mngr_setup.replace('%DIRECTOR_URL%',
-                                                       director)
+        # Values to be passed to the context file template. Those read
+        # from disk are only read again when the files change.
+        tmpl_values = dict(context_cache.get(
+            ('manager', service_name, cloud, conpaas_home, director), paths,
+            lambda: self.__get_context_files(service_name, director, *paths)))
 
         # Get cloud config values from director.cfg
         cloud_sections = ['iaas']
@@ -81,21 +84,8 @@ class ManagerController(Controller):
         for section_name in cloud_sections:
             __extract_cloud_cfg(section_name)
 
-        # Get manager config file
-        mngr_cfg = file_get_contents(
-            os.path.join(mngr_cfg_dir, 'default-manager.cfg'))
-
-        # Add service-specific config file (if any)
-        mngr_service_cfg = os.path.join(mngr_cfg_dir,
-                                        service_name + '-manager.cfg')
-
-        if os.path.isfile(mngr_service_cfg):
-            mngr_cfg += file_get_contents(mngr_service_cfg)
-
-        # Modify manager config file setting the required variables
-        mngr_cfg = mngr_cfg.replace('%DIRECTOR_URL%', director)
-        mngr_cfg = mngr_cfg.replace('%CONPAAS_SERVICE_TYPE%', service_name)
-
+        # Modify manager config file setting the service-specific variables
+        mngr_cfg = tmpl_values['mngr_cfg']
         for option_name in 'SERVICE_ID', 'USER_ID', 'APP_ID':
             mngr_cfg = mngr_cfg.replace('%CONPAAS_' + option_name + '%',
                                         self.config_parser.get("manager",
@@ -122,18 +112,6 @@ class ManagerController(Controller):
 
         tmpl_values['mngr_cfg'] = mngr_cfg
 
-        # Add default manager startup script
-        tmpl_values['mngr_start_script'] = file_get_contents(
-            os.path.join(mngr_scripts_dir, 'default-manager-start'))
-
-        # Or the service-specific one (if any)
-        mngr_startup_scriptname = os.path.join(
-            mngr_scripts_dir, service_name + '-manager-start')
-
-        if os.path.isfile(mngr_startup_scriptname):
-            tmpl_values['mngr_start_script'] = file_get_contents(
-                mngr_startup_scriptname)
-
         # Get key and a certificate from CA
         mngr_certs = self._get_certificate(email="info@conpaas.eu",
                                            cn="ConPaaS",
@@ -167,18 +145,58 @@ EOF
 
 %(mngr_start_script)s""" % tmpl_values
 
+    def __get_context_files(self, service_name, director, cloud_script,
+                            mngr_setup, default_mngr_cfg, mngr_service_cfg,
+                            default_mngr_start, mngr_service_start):
+        """Return the parts of the manager context file which only depend
+        on files, as a dictionary of template values"""
+        tmpl_values = {}
+
+        # Get contextualization script for the cloud
+        try:
+            tmpl_values['cloud_script'] = file_get_contents(cloud_script)
+        except IOError:
+            tmpl_values['cloud_script'] = ''
+
+        # Get manager setup file
+        tmpl_values['mngr_setup'] = file_get_contents(mngr_setup).replace(
+            '%DIRECTOR_URL%', director)
+
+        # Get manager config file
+        mngr_cfg = file_get_contents(default_mngr_cfg)
+
+        # Add service-specific config file (if any)
+        if os.path.isfile(mngr_service_cfg):
+            mngr_cfg += file_get_contents(mngr_service_cfg)
+
+        # Modify manager config file setting the required variables
+        mngr_cfg = mngr_cfg.replace('%DIRECTOR_URL%', director)
+        tmpl_values['mngr_cfg'] = mngr_cfg.replace('%CONPAAS_SERVICE_TYPE%',
+                                                   service_name)
+
+        # Add default manager startup script, or the service-specific one
+        # (if any)
+        if os.path.isfile(mngr_service_start):
+            tmpl_values['mngr_start_script'] = file_get_contents(
+                mngr_service_start)
+        else:
+            tmpl_values['mngr_start_script'] = file_get_contents(
+                default_mngr_start)
+
+        return tmpl_values
+
     def deduct_credit(self, value):
         uid = self.config_parser.get("manager", "USER_ID")
         service_id = self.config_parser.get("manager", "SERVICE_ID")
 
-        user = User.query.filter_by(uid=uid).one()
-        log('Decrement user %s credit: sid=%s, old_credit=%s, decrement=%s' % (
-            uid, service_id, user.credit, value))
-        user.credit -= value
+        log('Decrement user %s credit: sid=%s, decrement=%s' % (
+            uid, service_id, value))
 
-        if user.credit > -1:
+        if not credit.charge([ (service_id, value) ]):
             db.session.commit()
-            log('New credit for user %s: %s' % (uid, user.credit))
+            log('New credit for user %s: %s' % (uid,
+                User.query.filter_by(uid=uid).one().credit))
+            credit.rollup_if_due()
             return True
 
         db.session.rollback()
@@ -199,33 +217,37 @@ EOF
             if cloud.get_cloud_name() == cloud_name ][0]
 
     def __get_config(self, service_id, user_id, app_id, service_type="", vpn=None):
-        """Add manager configuration"""
-        if not config_parser.has_section("manager"):
-            config_parser.add_section("manager")
-
-        config_parser.set("manager", "SERVICE_ID", service_id)
-        config_parser.set("manager", "USER_ID", user_id)
-        config_parser.set("manager", "APP_ID", app_id)
-        config_parser.set("manager", "CREDIT_URL",
-                        config_parser.get('director',
-                                            'DIRECTOR_URL') + "/credit")
-        config_parser.set("manager", "TERMINATE_URL",
-                        config_parser.get('director',
-                                            'DIRECTOR_URL') + "/terminate")
-        config_parser.set("manager", "CA_URL",
-                        config_parser.get('director',
-                                            'DIRECTOR_URL') + "/ca")
-        config_parser.set("manager", "TYPE", service_type)
+        """Return a copy of the director configuration, with the manager
+        configuration added. Each controller has its own: managers are
+        started concurrently."""
+        parser = ConfigParser()
+        for section in config_parser.sections():
+            parser.add_section(section)
+            for option, value in config_parser.items(section, raw=True):
+                parser.set(section, option, value)
+
+        if not parser.has_section("manager"):
+            parser.add_section("manager")
+
+        parser.set("manager", "SERVICE_ID", service_id)
+        parser.set("manager", "USER_ID", user_id)
+        parser.set("manager", "APP_ID", app_id)
+        parser.set("manager", "CREDIT_URL",
+                   parser.get('director', 'DIRECTOR_URL') + "/credit")
+        parser.set("manager", "TERMINATE_URL",
+                   parser.get('director', 'DIRECTOR_URL') + "/terminate")
+        parser.set("manager", "CA_URL",
+                   parser.get('director', 'DIRECTOR_URL') + "/ca")
+        parser.set("manager", "TYPE", service_type)
 
         if vpn:
-            config_parser.set("manager", "IPOP_SUBNET", vpn)
+            parser.set("manager", "IPOP_SUBNET", vpn)
 
-        return config_parser
+        return parser
 
 
     def _stop_reservation_timer(self):
-        for reservation_timer in self._Controller__reservation_map.values():
-            reservation_timer.stop()
+        self._Controller__reservations.stop()
 
 
 def start(service_name, service_id, user_id, cloud_name, app_id, vpn):
@@ -29,6 +29,9 @@ if os.getenv('DIRECTOR_TESTING'):
     config_parser.set("director", "DATABASE_URI", "sqlite:///director-test.db")
     config_parser.set("director", "DIRECTOR_URL", "")
 
+    # run jobs synchronously
+    config_parser.set("director", "JOB_WORKERS", "0")
+
 def chown(path, username, groupname):
     os.chown(path, getpwnam(username).pw_uid, getgrnam(groupname).gr_gid)
 
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+    cpsdirector.credit
+    ==================
+
+    ConPaaS director: charging users for their nodes.
+
+    The balance of each user is kept in User.credit. Charges are deducted
+    from it with a single conditional UPDATE per user, so that concurrent
+    charges can neither be lost nor make the balance negative. Each charge
+    is also written to a ledger, whose old entries are regularly rolled up
+    into one entry per service, so that the ledger does not grow with the
+    number of node-hours.
+
+    Managers can only charge their own service, through the
+    /callback/decrementUserCredit.php callback. Their ReservationScheduler
+    already merges the nodes due within a minute into one call, so the
+    callback takes a single (service, nodes) entry. charge() takes a list
+    so that the director can charge several services in one transaction.
+
+    :copyright: (C) 2013 by Contrail Consortium.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from cpsdirector import db
+
+from cpsdirector.common import log
+
+# Credits charged for each node, every hour
+NODE_PRICE = 1
+
+# Ledger entries older than this many seconds are rolled up
+ROLLUP_AGE = 24 * 3600
+
+class CreditCharge(db.Model):
+    cid = db.Column(db.Integer, primary_key=True,
+        autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.uid'))
+    # Not a foreign key: charges outlive their services
+    service_id = db.Column(db.Integer)
+    nodes = db.Column(db.Integer)
+    amount = db.Column(db.Integer)
+    created = db.Column(db.DateTime)
+    # True for entries summing up older ones
+    rollup = db.Column(db.Boolean, default=False)
+
+def _deduct(uid, amount):
+    """Deduct amount from the credit of user uid if it is large enough.
+    Return True on success."""
+    from cpsdirector.user import User
+    table = User.__table__
+    result = db.session.execute(table.update().where(
+        (table.c.uid == uid) & (table.c.credit >= amount)).values(
+        credit=table.c.credit - amount))
+    return result.rowcount == 1
+
+def charge(charges):
+    """Charge the owners of the given services for their nodes.
+
+    Each user is charged all at once for the nodes of their services: if
+    their credit is not enough, none of their charges is made. The
+    changes are part of the current session, and have to be committed
+    with it.
+
+    @param charges A list of (service id, number of nodes) tuples
+
+    @return The set of ids of the users who did not have enough credit
+    """
+    from cpsdirector.service import Service
+
+    sids = set(int(sid) for sid, _ in charges)
+    owners = dict(db.session.query(Service.sid, Service.user_id).filter(
+        Service.sid.in_(sids)))
+
+    by_user = {}
+    for sid, nodes in charges:
+        sid = int(sid)
+        if sid not in owners:
+            log('Not charging %s nodes of service %s: service not found' % (
+                nodes, sid))
+            continue
+        by_user.setdefault(owners[sid], []).append((sid, int(nodes)))
+
+    refused = set()
+    entries = []
+    now = datetime.now()
+    for uid, user_charges in by_user.items():
+        amount = sum(nodes for _, nodes in user_charges) * NODE_PRICE
+        if not _deduct(uid, amount):
+            log('User %s does not have enough credit for %s' % (uid, amount))
+            refused.add(uid)
+            continue
+
+        entries.extend({ 'user_id': uid, 'service_id': sid, 'nodes': nodes,
+                         'amount': nodes * NODE_PRICE, 'created': now,
+                         'rollup': False }
+                       for sid, nodes in user_charges if nodes)
+
+    if entries:
+        db.session.execute(CreditCharge.__table__.insert(), entries)
+
+    return refused
+
+def rollup(before):
+    """Replace the ledger entries of each service older than before with a
+    single one. Commits the session.
+
+    Return the number of entries removed."""
+    table = CreditCharge.__table__
+    old = (table.c.created < before) & (table.c.rollup == False)
+
+    totals = db.session.query(table.c.user_id, table.c.service_id,
+                              func.count(), func.sum(table.c.nodes),
+                              func.sum(table.c.amount)).filter(old).group_by(
+                              table.c.user_id, table.c.service_id).all()
+    count = sum(total[2] for total in totals)
+    if not count:
+        return 0
+
+    result = db.session.execute(table.delete().where(old))
+    if result.rowcount != count:
+        # Another process rolled these entries up meanwhile
+        db.session.rollback()
+        return 0
+
+    db.session.execute(table.insert(), [
+        { 'user_id': uid, 'service_id': sid, 'nodes': nodes,
+          'amount': amount, 'created': before, 'rollup': True }
+        for uid, sid, _, nodes, amount in totals ])
+    db.session.commit()
+
+    log('Rolled up %s credit ledger entries into %s' % (count, len(totals)))
+    return count
+
+_last_rollup = [ 0 ]
+
+def rollup_if_due():
+    """Roll up the ledger entries older than ROLLUP_AGE, at most once every
+    ROLLUP_AGE seconds. To be called once charges are committed."""
+    if _last_rollup[0] + ROLLUP_AGE > time.time():
+        return
+
+    _last_rollup[0] = time.time()
+    rollup(datetime.now() - timedelta(seconds=ROLLUP_AGE))
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""
+    cpsdirector.job
+    ===============
+
+    ConPaaS director: long operations run in the background.
+
+    Operations such as starting a manager VM take minutes. Instead of
+    keeping an HTTP worker busy for that long, they are stored as jobs in
+    the database and run by a few worker threads. The client gets the job
+    id right away and polls /job/<jid> for its progress.
+
+    The jobs a director process runs are marked as alive regularly. Those
+    left RUNNING by a process which stopped are failed, and cleaned up
+    after, by the other processes or the next one started.
+
+    :copyright: (C) 2013 by Contrail Consortium.
+"""
+
+from flask import Blueprint
+from flask import g
+
+import sys
+import time
+import Queue
+import threading
+import traceback
+
+import simplejson
+from datetime import datetime, timedelta
+
+from cpsdirector import app
+from cpsdirector import db
+
+from cpsdirector.common import log
+from cpsdirector.common import build_response
+from cpsdirector.common import config_parser
+
+job_page = Blueprint('job_page', __name__)
+
+class Job(db.Model):
+    jid = db.Column(db.Integer, primary_key=True,
+        autoincrement=True)
+    type = db.Column(db.String(32))
+    # PENDING, RUNNING, DONE or ERROR
+    state = db.Column(db.String(32))
+    # Progress or error message
+    msg = db.Column(db.String(1024))
+    # JSON-encoded parameters of the job
+    params = db.Column(db.Text)
+    created = db.Column(db.DateTime)
+    updated = db.Column(db.DateTime)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.uid'))
+    # Not a foreign key: services whose job failed are deleted
+    service_id = db.Column(db.Integer)
+
+    def __init__(self, **kwargs):
+        # Default values
+        self.state = "PENDING"
+        self.msg = ""
+        self.created = self.updated = datetime.now()
+
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+    def to_dict(self):
+        ret = {}
+        for c in self.__table__.columns:
+            if c.name == 'params':
+                continue
+            ret[c.name] = getattr(self, c.name)
+            if type(ret[c.name]) is datetime:
+                ret[c.name] = ret[c.name].isoformat()
+
+        return ret
+
+    def get_params(self):
+        return simplejson.loads(self.params)
+
+
+def set_progress(jid, msg):
+    """Record progress of running job jid. May be called from any thread,
+    the change is committed with the session of that thread."""
+    table = Job.__table__
+    db.session.execute(table.update().where(table.c.jid == jid).values(
+        msg=msg, updated=datetime.now()))
+    db.session.commit()
+
+# Functions running each type of job. They take the job as their only
+# argument and return a message describing its outcome.
+job_handlers = {}
+
+# Functions cleaning up after each type of job, when it was interrupted
+# by the end of the director process running it. They take the job as
+# their only argument.
+job_cleanups = {}
+
+# Seconds between two updates of the jobs run by this process
+HEARTBEAT_INTERVAL = 60
+
+# Jobs not updated for that many intervals were interrupted
+STALE_INTERVALS = 5
+
+# Ids of the jobs run by this process
+_running = set()
+_running_lock = threading.Lock()
+
+def _claim(jid):
+    """Switch job jid from PENDING to RUNNING. Return False if another
+    worker or director process got it first."""
+    table = Job.__table__
+    result = db.session.execute(table.update().where(
+        (table.c.jid == jid) & (table.c.state == 'PENDING')).values(
+        state='RUNNING', updated=datetime.now()))
+    db.session.commit()
+    return result.rowcount == 1
+
+def run_job(jid):
+    """Run job jid if it is still pending"""
+    if not _claim(jid):
+        return
+
+    with _running_lock:
+        _running.add(jid)
+    try:
+        _run_claimed(jid)
+    finally:
+        with _running_lock:
+            _running.discard(jid)
+
+def _run_claimed(jid):
+    job = Job.query.get(jid)
+    log('Running job %s (%s)' % (job.jid, job.type))
+    try:
+        msg = job_handlers[job.type](job)
+    except Exception, err:
+        db.session.rollback()
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        log(''.join('!! ' + line for line in lines))
+
+        job = Job.query.get(jid)
+        job.state = 'ERROR'
+        job.msg = 'Error upon %s: %s %s' % (job.type, type(err), err)
+    else:
+        job.state = 'DONE'
+        job.msg = msg
+
+    job.updated = datetime.now()
+    db.session.commit()
+    log('Job %s: %s %s' % (job.jid, job.state, job.msg))
+
+def _mark_running():
+    """Record that the jobs run by this process are still alive"""
+    with _running_lock:
+        running = list(_running)
+    if not running:
+        return
+
+    table = Job.__table__
+    db.session.execute(table.update().where(
+        table.c.jid.in_(running) & (table.c.state == 'RUNNING')).values(
+        updated=datetime.now()))
+    db.session.commit()
+
+def fail_stale_jobs():
+    """Fail the jobs left RUNNING by a director process which stopped, and
+    clean up after them. Return their ids."""
+    table = Job.__table__
+    before = datetime.now() - timedelta(
+        seconds=HEARTBEAT_INTERVAL * STALE_INTERVALS)
+
+    failed = []
+    for job in Job.query.filter((Job.state == 'RUNNING') &
+                                (Job.updated < before)).all():
+        # Only one process fails it
+        result = db.session.execute(table.update().where(
+            (table.c.jid == job.jid) & (table.c.state == 'RUNNING') &
+            (table.c.updated == job.updated)).values(
+            state='ERROR', updated=datetime.now(),
+            msg='Interrupted by the end of the director process running it'))
+        db.session.commit()
+        if result.rowcount != 1:
+            continue
+
+        log('Job %s (%s) was interrupted' % (job.jid, job.type))
+        failed.append(job.jid)
+        if job.type in job_cleanups:
+            try:
+                job_cleanups[job.type](job)
+            except Exception:
+                db.session.rollback()
+                log('Failed to clean up after job %s: %s' % (job.jid,
+                    traceback.format_exc()))
+    return failed
+
+class JobQueue(object):
+    """Worker threads running jobs in the order they are submitted.
+
+    With no workers, jobs are run by submit itself."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.started = False
+
+    def submit(self, job):
+        """Run job, which has to be committed already"""
+        if self.workers == 0:
+            run_job(job.jid)
+            return
+
+        self.start()
+        self.queue.put(job.jid)
+
+    def start(self):
+        """Start the workers and the heartbeat, fail the jobs interrupted
+        by a previous run of the director and queue the pending ones"""
+        with self.lock:
+            targets = [ self._work ] * (self.workers - len(self.threads))
+            if not self.started:
+                targets.append(self._beat)
+
+            for target in targets:
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+                if target == self._work:
+                    self.threads.append(thread)
+
+            if self.started:
+                return
+            self.started = True
+
+        fail_stale_jobs()
+
+        if self.workers:
+            for job in Job.query.filter_by(state='PENDING'):
+                self.queue.put(job.jid)
+
+    def join(self):
+        """Wait for all the queued jobs to be run"""
+        self.queue.join()
+
+    def _work(self):
+        while True:
+            jid = self.queue.get()
+            try:
+                run_job(jid)
+            except Exception:
+                log('Failed to run job %s: %s' % (jid,
+                                                  traceback.format_exc()))
+            finally:
+                # Each thread has its own session
+                db.session.remove()
+                self.queue.task_done()
+
+    def _beat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                _mark_running()
+                fail_stale_jobs()
+            except Exception:
+                log('Failed to check the running jobs: %s' %
+                    traceback.format_exc())
+            finally:
+                db.session.remove()
+
+if config_parser.has_option('director', 'JOB_WORKERS'):
+    job_queue = JobQueue(config_parser.getint('director', 'JOB_WORKERS'))
+else:
+    job_queue = JobQueue(4)
+
+@app.before_first_request
+def start_jobs():
+    """Start the job queue along with the director, rather than with the
+    first job submitted"""
+    job_queue.start()
+
+def submit(type, user_id, service_id=None, **params):
+    """Store a new job and have it run in the background.
+
+    Return the job."""
+    job = Job(type=type, user_id=user_id, service_id=service_id,
+              params=simplejson.dumps(params))
+    db.session.add(job)
+    db.session.commit()
+
+    job_queue.submit(job)
+    return job
+
+from cpsdirector.user import cert_required
+
+@job_page.route("/job/<int:jobid>", methods=['POST', 'GET'])
+@cert_required(role='user')
+def get_job(jobid):
+    """eg: GET /job/3
+
+    Returns a dictionary with the job data (state, progress message and
+    id of the service it concerns), or False if the job does not exist or
+    does not belong to the user.
+    """
+    job = Job.query.get(jobid)
+    if not job or job.user_id != g.user.uid:
+        log('Job %s does not exist or is not owned by user %s' % (
+            jobid, g.user.uid))
+        return build_response(simplejson.dumps(False))
+
+    return build_response(simplejson.dumps(job.to_dict()))
@@ -10,12 +10,17 @@
 """
 
 from flask import Blueprint
-from flask import jsonify, request, g
+from flask import jsonify, request, g, has_app_context
 
+import sys
 import simplejson
 import time
 import socket
 import urllib2
+import threading
+import traceback
+
+from cpsdirector import app
 
 from cpsdirector.common import log
 from cpsdirector.common import build_response
@@ -37,7 +42,7 @@ def check_manifest(json):
     return True
 
 from cpsdirector.user import cert_required
-from multiprocessing import Process
+from cpsdirector import job
 @manifest_page.route("/upload_manifest", methods=['POST'])
 @cert_required(role='user')
 def upload_manifest():
@@ -52,11 +57,9 @@ def upload_manifest():
         return simplejson.dumps(False)
 
     if request.values.get('thread'):
-        log('Starting a new process for the manifest')
-        p = Process(target=new_manifest, args=(json,))
-        p.start()
-        log('Process started, now return')
-        return simplejson.dumps(True)
+        started = job.submit('manifest', g.user.uid, manifest=json)
+        log('Manifest deployed by job %s, now return' % started.jid)
+        return simplejson.dumps({ 'jid': started.jid })
 
     msg = new_manifest(json)
 
@@ -96,6 +99,10 @@ def download_manifest(appid):
 from cpsdirector.service import callmanager
 
 class MGeneral():
+    # Types of the services of the manifest which have to be started
+    # before this one
+    depends_on = ()
+
     def check_error(self, ret):
         try:
             return simplejson.loads(ret.data).get('msg')
@@ -119,15 +126,53 @@ class MGeneral():
 
         return res
 
+    # Longest time the manager is asked to wait for a state at once
+    WAIT_TIMEOUT = 60
+
+    # Delays between polls, for managers which cannot be reached or do not
+    # support wait_for_state
+    MIN_POLL_DELAY = 1
+    MAX_POLL_DELAY = 30
+
     def wait_for_state(self, sid, state):
-        """Poll the state of service 'sid' till it matches 'state'."""
-        res = { 'state': None }
+        """Wait till the state of service 'sid' matches 'state'.
+
+        The manager is asked to answer once it gets in that state. Older
+        managers are polled, less and less often."""
+        delay = self.MIN_POLL_DELAY
+        # Cleared once the manager turns out not to support wait_for_state
+        wait = True
 
-        while res['state'] != state:
+        while True:
             try:
+                if wait:
+                    try:
+                        res = callmanager(sid, "wait_for_state", False,
+                            { 'states': [ state ],
+                              'timeout': self.WAIT_TIMEOUT })
+                    except (socket.error, urllib2.URLError):
+                        raise
+                    except Exception:
+                        # Older managers answer 404
+                        wait = False
+                        res = None
+
+                    if type(res) is dict and 'reached' in res:
+                        if res['reached']:
+                            return
+
+                        # The manager waited for WAIT_TIMEOUT, ask again
+                        delay = self.MIN_POLL_DELAY
+                        continue
+
                 res = callmanager(sid, "get_service_info", False, {})
+                if res['state'] == state:
+                    return
             except (socket.error, urllib2.URLError):
-                time.sleep(2)
+                pass
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.MAX_POLL_DELAY)
 
     def update_environment(self, appid):
         env = ''
@@ -183,6 +228,9 @@ class MGeneral():
 from cpsdirector.service import _start as service_start
 from cpsdirector.service import _rename as service_rename
 class MPhp(MGeneral):
+    # update_environment needs the IP addresses of their nodes
+    depends_on = ('mysql', 'xtreemfs')
+
     def upload_code(self, service_id, url):
         contents = urllib2.urlopen(url).read()
         filename = url.split('/')[-1]
@@ -715,9 +763,125 @@ class MTaskFarm(MGeneral):
 
         return 'ok'
 
+manifest_services = {
+    'php': MPhp,
+    'java': MJava,
+    'mysql': MMySql,
+    'scalaris': MScalaris,
+    'hadoop': MHadoop,
+    'selenium': MSelenium,
+    'xtreemfs': MXTreemFS,
+    'taskfarm': MTaskFarm,
+}
+
+from cpsdirector.user import User
+class ManifestDeployer(object):
+    """Start the services of a manifest, each one in its own thread.
+
+    A service waits only for the services it depends on (see
+    MGeneral.depends_on), so that deploying an application takes as long
+    as its longest chain of dependencies."""
+
+    def __init__(self, services, appid, uid, progress=None):
+        """
+            @param services The 'Services' list of the manifest
+
+            @param progress Called with a message each time the state of
+                            one of the services changes
+        """
+        self.services = services
+        self.appid = appid
+        self.uid = uid
+        self.progress = progress
+
+        self.labels = []
+        for index, service in enumerate(services):
+            label = service.get('ServiceName')
+            if not label:
+                label = '%s #%d' % (service.get('Type'), index + 1)
+            self.labels.append(label)
+
+        self.lock = threading.Lock()
+        self.states = [ 'waiting' ] * len(services)
+        self.results = [ 'Not started' ] * len(services)
+        self.done = [ threading.Event() for _ in services ]
+
+    def dependencies(self, index):
+        """Return the indexes of the services service index depends on"""
+        depends_on = manifest_services[self.services[index].get('Type')].depends_on
+        return [ dep for dep, service in enumerate(self.services)
+                 if dep != index and service.get('Type') in depends_on ]
+
+    def set_state(self, index, state):
+        with self.lock:
+            self.states[index] = state
+            msg = ', '.join('%s: %s' % (label, state)
+                            for label, state in zip(self.labels, self.states))
+
+        log('Manifest of application %s: %s' % (self.appid, msg))
+        if self.progress:
+            self.progress(msg)
+
+    def deploy(self, index):
+        for dep in self.dependencies(index):
+            self.done[dep].wait()
+            if self.results[dep] != 'ok':
+                return 'Not started, %s failed' % self.labels[dep]
+
+        self.set_state(index, 'starting')
+        service = self.services[index]
+        try:
+            return manifest_services[service.get('Type')]().start(
+                service, self.appid)
+        except Exception, err:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+            log(''.join('!! ' + line for line in lines))
+            return 'Error upon starting %s: %s %s' % (self.labels[index],
+                                                     type(err), err)
+
+    def run_deploy(self, index):
+        # Each thread has its own application context and database session
+        try:
+            with app.app_context():
+                g.user = User.query.get(self.uid)
+                result = self.deploy(index)
+
+                self.results[index] = result
+                if result == 'ok':
+                    self.set_state(index, 'done')
+                else:
+                    self.set_state(index, result)
+        finally:
+            # Never leave the services depending on this one waiting
+            self.done[index].set()
+
+    def run(self):
+        """Return 'ok' if all the services started properly, the error of
+        the first one which did not otherwise."""
+        for service in self.services:
+            if service.get('Type') not in manifest_services:
+                return 'Service %s does not exists' % service.get('Type')
+
+        threads = []
+        for index in range(len(self.services)):
+            thread = threading.Thread(target=self.run_deploy, args=(index,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        for result in self.results:
+            if result != 'ok':
+                return result
+
+        return 'ok'
+
 from cpsdirector.application import check_app_exists
 from cpsdirector.application import _createapp as createapp
-def new_manifest(json):
+def new_manifest(json, progress=None):
     try:
         parse = simplejson.loads(json)
     except:
@@ -748,27 +912,26 @@ def new_manifest(json):
     if not parse.get('Services'):
         return 'ok'
 
-    for service in parse.get('Services'):
-        if service.get('Type') == 'php':
-            msg = MPhp().start(service, appid)
-        elif service.get('Type') == 'java':
-            msg = MJava().start(service, appid)
-        elif service.get('Type') == 'mysql':
-            msg = MMySql().start(service, appid)
-        elif service.get('Type') == 'scalaris':
-            msg = MScalaris().start(service, appid)
-        elif service.get('Type') == 'hadoop':
-            msg = MHadoop().start(service, appid)
-        elif service.get('Type') == 'selenium':
-            msg = MSelenium().start(service, appid)
-        elif service.get('Type') == 'xtreemfs':
-            msg = MXTreemFS().start(service, appid)
-        elif service.get('Type') == 'taskfarm':
-            msg = MTaskFarm().start(service, appid)
-        else:
-            return 'Service %s does not exists' % service.get('Type')
+    deployer = ManifestDeployer(parse.get('Services'), appid, g.user.uid,
+                                progress)
+    return deployer.run()
+
+def manifest_job(deploy_job):
+    """Job handler deploying a manifest uploaded with 'thread'"""
+    progress = lambda msg: job.set_progress(deploy_job.jid, msg)
+    manifest = deploy_job.get_params()['manifest']
+
+    if has_app_context():
+        # Run by the request itself
+        msg = new_manifest(manifest, progress)
+    else:
+        with app.app_context():
+            g.user = User.query.get(deploy_job.user_id)
+            msg = new_manifest(manifest, progress)
+
+    if msg != 'ok':
+        raise Exception(msg)
 
-        if msg is not 'ok':
-            return msg
+    return 'Manifest deployed'
 
-    return 'ok'
+job.job_handlers['manifest'] = manifest_job
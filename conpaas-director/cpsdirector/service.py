@@ -12,9 +12,11 @@
 from flask import Blueprint
 from flask import jsonify, helpers, request, make_response, g
 
+from sqlalchemy import event
 from sqlalchemy.exc import InvalidRequestError
 
 import sys
+import threading
 import traceback
 
 import simplejson
@@ -96,31 +98,26 @@ def get_service(user_id, service_id):
     return service
 
 from conpaas.core import https
-def callmanager(service_id, method, post, data, files=[]):
-    """Call the manager API.
+from conpaas.core.https import fanout
 
-    'service_id': an integer holding the service id of the manager.
-    'method': a string representing the API method name.
-    'post': boolean value. True for POST method, false for GET.
-    'data': a dictionary representing the data to be sent to the director.
-    'files': sequence of (name, filename, value) tuples for data to be uploaded as files.
-
-    callmanager loads the manager JSON response and returns it as a Python
-    object.
-    """
-    service = get_service(g.user.uid, service_id)
+def _callmanager(manager, method, post, data, files=[]):
+    """Call the API of the manager running at address 'manager'. The
+    arguments and return value are those of callmanager.
 
+    Unlike callmanager, it does not depend on the request and can be called
+    from any thread."""
+    # Only built again if the certificates change
     https.client.conpaas_init_ssl_ctx('/etc/cpsdirector/certs', 'director')
 
     # File upload
     if files:
-        res = https.client.https_post(service.manager, 443, '/', data, files)
+        res = https.client.https_post(manager, 443, '/', data, files)
     # POST
     elif post:
-        res = https.client.jsonrpc_post(service.manager, 443, '/', method, data)
+        res = https.client.jsonrpc_post(manager, 443, '/', method, data)
     # GET
     else:
-        res = https.client.jsonrpc_get(service.manager, 443, '/', method, data)
+        res = https.client.jsonrpc_get(manager, 443, '/', method, data)
 
     if res[0] == 200:
         try:
@@ -132,7 +129,33 @@ def callmanager(service_id, method, post, data, files=[]):
         return data.get('result', data)
 
     raise Exception, "Call to method %s on %s failed: %s.\nParams = %s" % (
-        method, service.manager, res[1], data)
+        method, manager, res[1], data)
+
+def callmanager(service_id, method, post, data, files=[]):
+    """Call the manager API.
+
+    'service_id': an integer holding the service id of the manager.
+    'method': a string representing the API method name.
+    'post': boolean value. True for POST method, false for GET.
+    'data': a dictionary representing the data to be sent to the director.
+    'files': sequence of (name, filename, value) tuples for data to be uploaded as files.
+
+    callmanager loads the manager JSON response and returns it as a Python
+    object. Connections to the managers are kept open and reused.
+    """
+    service = get_service(g.user.uid, service_id)
+
+    return _callmanager(service.manager, method, post, data, files)
+
+def callmanagers(services, method, post, data):
+    """Call the same method on the managers of all the given services at
+    the same time.
+
+    Return a FanoutOutcome (see conpaas.core.https.fanout) holding the
+    result or the error of each call, in the order of the services."""
+    managers = [ service.manager for service in services ]
+    return fanout.call_nodes(
+        lambda manager: _callmanager(manager, method, post, data), managers)
 
 @service_page.route("/available_services", methods=['GET'])
 def available_services():
@@ -141,9 +164,23 @@ def available_services():
 
 from cpsdirector.application import get_default_app, get_app_by_id
 
-from cpsdirector.user import cert_required
+from cpsdirector.user import cert_required, cert_cache
 
-def _start(servicetype, cloudname, appid):
+def _forget_service(mapper, connection, service):
+    cert_cache.invalidate(sid=service.sid)
+
+event.listen(Service, 'after_delete', _forget_service)
+
+from cpsdirector import job
+
+# Services are created one at a time, so that concurrent requests do not
+# get the same VPN subnet
+_create_lock = threading.Lock()
+
+def _create_service(servicetype, appid):
+    """Validate the request and commit a new service in PREINIT state.
+
+    Return a (service, error response) tuple, one of them being None."""
     log('User %s creating a new %s service inside application %s' % (
 	    g.user.username, servicetype, appid))
 
@@ -151,34 +188,71 @@ def _start(servicetype, cloudname, appid):
     if servicetype not in valid_services:
         error_msg = 'Unknown service type: %s' % servicetype
         log(error_msg)
-        return build_response(jsonify({ 'error': True,
-                                        'msg': error_msg }))
+        return None, build_response(jsonify({ 'error': True,
+                                              'msg': error_msg }))
 
     app = get_app_by_id(g.user.uid, appid)
     if not app:
-        return build_response(jsonify({ 'error': True,
-		                        'msg': "Application not found" }))
+        return None, build_response(jsonify({ 'error': True,
+		                              'msg': "Application not found" }))
 
-    # Do we have to assign a VPN subnet to this service?
-    vpn = app.get_available_vpn_subnet()
+    with _create_lock:
+        # New service with default name, proper servicetype and user
+        # relationship
+        s = Service(name="New %s service" % servicetype, type=servicetype,
+            user=g.user, application=app, state="PREINIT")
 
-    # New service with default name, proper servicetype and user relationship
-    s = Service(name="New %s service" % servicetype, type=servicetype,
-        user=g.user, application=app, subnet=vpn)
+        db.session.add(s)
+        # flush() is needed to get auto-incremented sid
+        db.session.flush()
 
-    db.session.add(s)
-    # flush() is needed to get auto-incremented sid
-    db.session.flush()
+        # Do we have to assign a VPN subnet to this service?
+        s.subnet = app.allocate_vpn_subnet(s)
+
+        # Committed before starting the manager, which takes minutes
+        db.session.commit()
 
+    return s, None
+
+def _start_manager(s, cloudname):
+    """Start the manager of service s and commit it.
+
+    If that fails, the service is deleted and the exception raised again."""
+    # Starting commits the session, the service may be gone afterwards
+    sid, servicetype, user_id = s.sid, s.type, s.user_id
+    appid, subnet = s.application_id, s.subnet
     try:
-        s.manager, s.vmid, s.cloud = manager_controller.start(
-            servicetype, s.sid, g.user.uid, cloudname, appid, vpn)
-    except Exception, err:
+        manager, vmid, cloud = manager_controller.start(
+            servicetype, sid, user_id, cloudname, appid, subnet)
+    except Exception:
+        exc_info = sys.exc_info()
         try:
             db.session.delete(s)
             db.session.commit()
         except InvalidRequestError:
             db.session.rollback()
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    if not Service.query.filter_by(sid=sid).count():
+        # Deleted meanwhile: nobody else knows about this VM
+        manager_controller.ManagerController(servicetype, sid, user_id,
+            cloud, appid, subnet).stop(vmid)
+        raise Exception('Service %s deleted while its manager was starting'
+                        % sid)
+
+    s.manager, s.vmid, s.cloud = manager, vmid, cloud
+    s.state = "INIT"
+    db.session.commit()
+
+def _start(servicetype, cloudname, appid):
+    """Create a new service and wait for its manager to be started"""
+    s, error = _create_service(servicetype, appid)
+    if error:
+        return error
+
+    try:
+        _start_manager(s, cloudname)
+    except Exception, err:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
         log(''.join('!! ' + line for line in lines))
@@ -186,11 +260,37 @@ def _start(servicetype, cloudname, appid):
         log(error_msg)
         return build_response(jsonify({ 'error': True, 'msg': error_msg }))
 
-    db.session.commit()
-
     log('%s (id=%s) created properly' % (s.name, s.sid))
     return build_response(jsonify(s.to_dict()))
 
+def start_service_job(start_job):
+    """Job handler starting the manager of a service created by /start"""
+    s = Service.query.get(start_job.service_id)
+    if not s:
+        raise Exception('Service %s does not exist anymore' %
+                        start_job.service_id)
+
+    _start_manager(s, start_job.get_params()['cloudname'])
+
+    log('%s (id=%s) created properly' % (s.name, s.sid))
+    return 'Manager of service %s started at %s' % (s.sid, s.manager)
+
+job.job_handlers['start_service'] = start_service_job
+
+def start_service_cleanup(start_job):
+    """Delete the service whose manager start_job was starting when the
+    director stopped, so that it does not stay in PREINIT state"""
+    s = Service.query.get(start_job.service_id)
+    if not s or s.state != 'PREINIT':
+        return
+
+    db.session.delete(s)
+    db.session.commit()
+    log('Service %s deleted: the start of its manager was interrupted. Its '
+        'VM, if any, has to be killed from the cloud' % s.sid)
+
+job.job_cleanups['start_service'] = start_service_cleanup
+
 @service_page.route("/start/<servicetype>", methods=['POST'])
 @service_page.route("/start/<servicetype>/<cloudname>", methods=['POST'])
 @cert_required(role='user')
@@ -201,9 +301,12 @@ def start(servicetype, cloudname="default"):
     created has to belong to a specific application. If 'appid' is omitted, the
     service will belong to the default application.
 
-    Returns a dictionary with service data (manager's vmid and IP address,
-    service name and ID) in case of successful authentication and correct
-    service creation. False is returned otherwise.
+    The manager VM is started in the background. Returns a dictionary with
+    service data (service name and ID, state PREINIT) and the id of the job
+    starting the manager ('jid'), which can be followed through /job/<jid>.
+    The manager's vmid and IP address are filled in once the job is DONE.
+    Until then, the service can not be stopped.
+    False is returned in case of failed authentication.
     """
     appid = request.values.get('appid')
 
@@ -211,7 +314,26 @@ def start(servicetype, cloudname="default"):
     if not appid:
         appid = get_default_app(g.user.uid).aid
 
-    return _start(servicetype, cloudname, appid)
+    s, error = _create_service(servicetype, appid)
+    if error:
+        return error
+
+    sid = s.sid
+
+    started = job.submit('start_service', g.user.uid, sid,
+                         cloudname=cloudname)
+
+    if started.state == 'ERROR':
+        # The job has been run synchronously (no workers)
+        return build_response(jsonify({ 'error': True, 'msg': started.msg }))
+
+    s = Service.query.get(sid)
+    if s:
+        res = s.to_dict()
+    else:
+        res = { 'sid': sid, 'state': 'PREINIT' }
+    res['jid'] = started.jid
+    return build_response(jsonify(res))
 
 def _rename(serviceid, newname):
     log('User %s attempting to rename service %s' % (g.user.uid, serviceid))
@@ -267,21 +389,47 @@ def stop(serviceid):
     if not service:
         return build_response(simplejson.dumps(False))
 
+    if service.state == 'PREINIT':
+        log('Service %s can not be stopped while its manager is starting' %
+            serviceid)
+        return build_response(simplejson.dumps(False))
+
     # If a service with id 'serviceid' exists and user is the owner
     service.stop()
     return build_response(simplejson.dumps(True))
 
+def _list_services(services):
+    """Return the dictionaries of the given services. If the request asks
+    for it ('manager_state'), each of them includes the state reported by
+    its manager, None if the manager could not be reached. The managers
+    are asked all at once."""
+    services_dicts = [ service.to_dict() for service in services ]
+    if not request.values.get('manager_state'):
+        return services_dicts
+
+    running = [ service for service in services if service.manager ]
+    outcome = callmanagers(running, "get_service_info", False, {})
+    states = {}
+    for service, result in zip(running, outcome.results):
+        if type(result) is dict:
+            states[service.sid] = result.get('state')
+
+    for service_dict in services_dicts:
+        service_dict['manager_state'] = states.get(service_dict['sid'])
+
+    return services_dicts
+
 @service_page.route("/list", methods=['POST', 'GET'])
 @cert_required(role='user')
 def list_all_services():
     """POST /list
 
     List running ConPaaS services under a specific application if the user is
-    authenticated. Return False otherwise.
+    authenticated. Return False otherwise. With 'manager_state', the state
+    of each service is asked to its manager.
     """
-    return build_response(simplejson.dumps([
-        ser.to_dict() for ser in g.user.services.all()
-    ]))
+    return build_response(simplejson.dumps(
+        _list_services(g.user.services.all())))
 
 @service_page.route("/list/<int:appid>", methods=['POST', 'GET'])
 @cert_required(role='user')
@@ -289,11 +437,11 @@ def list_services(appid):
     """POST /list/2
 
     List running ConPaaS services under a specific application if the user is
-    authenticated. Return False otherwise.
+    authenticated. Return False otherwise. With 'manager_state', the state
+    of each service is asked to its manager.
     """
-    return build_response(simplejson.dumps([
-        ser.to_dict() for ser in Service.query.filter_by(application_id=appid)
-    ]))
+    return build_response(simplejson.dumps(
+        _list_services(Service.query.filter_by(application_id=appid).all())))
 
 @service_page.route("/download/ConPaaS.tar.gz", methods=['GET'])
 def download():
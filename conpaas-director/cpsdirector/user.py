@@ -13,21 +13,102 @@ from flask import Blueprint
 from flask import jsonify, helpers, request, make_response, g
 
 import os
+import time
 import hashlib
+import threading
 import zipfile
 import simplejson
 from datetime import datetime
 from functools import wraps
+from collections import OrderedDict
 from StringIO import StringIO
 from OpenSSL import crypto
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 
 from cpsdirector import db, x509cert
+from cpsdirector import credit as billing
 from cpsdirector.common import log, config_parser, build_response
 
 from conpaas.core import https
 
 user_page = Blueprint('user_page', __name__)
 
+class CertCache(object):
+    """Identities found in client certificates, kept for ttl seconds.
+
+    Entries are keyed by certificate fingerprint and hold the certificate
+    fields, as well as the id of the service the certificate has been
+    checked against, if any. At most size entries are kept, the oldest
+    ones are dropped first.
+
+    Entries are dropped when their user or service is deleted by this
+    process. Deletions made by other director processes are only noticed
+    once the entries expire."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, fingerprint):
+        """Return a (certificate fields, checked service id) tuple, or None"""
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None:
+                return None
+
+            if entry[0] < time.time():
+                del self.entries[fingerprint]
+                return None
+
+            return entry[1], entry[2]
+
+    def put(self, fingerprint, cert, sid=None):
+        with self.lock:
+            self.entries.pop(fingerprint, None)
+            while len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+
+            self.entries[fingerprint] = (time.time() + self.ttl, dict(cert),
+                                         sid)
+
+    def invalidate(self, uid=None, sid=None):
+        """Forget the certificates of user uid, or of service sid"""
+        with self.lock:
+            for fingerprint, entry in self.entries.items():
+                if ((uid is not None and entry[1].get('UID') == str(uid)) or
+                        (sid is not None and entry[2] == sid)):
+                    del self.entries[fingerprint]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+cert_cache = CertCache(1024, 300)
+
+def _attach(cls, ident, **columns):
+    """Return the instance of cls whose primary key is ident in the current
+    session, without querying the database. Its attributes, other than
+    the given columns, are loaded when first used.
+
+    The instance has to exist in the database."""
+    key = identity_key(cls, ident)
+    instance = db.session.identity_map.get(key)
+    if instance is not None:
+        return instance
+
+    instance = cls._sa_class_manager.new_instance()
+    setattr(instance, cls.__mapper__.primary_key[0].key, ident)
+    for name, value in columns.items():
+        setattr(instance, name, value)
+
+    make_transient_to_detached(instance)
+    db.session.add(instance)
+    return instance
+
 class cert_required(object):
 
     def __init__(self, role):
@@ -36,18 +117,30 @@ class cert_required(object):
     def __call__(self, fn):
         @wraps(fn)
         def decorated(*args, **kwargs):
-            g.cert = {}
-
             if os.environ.get('DIRECTOR_TESTING'):
                 # No SSL certificate check if we are testing. Trust what the
                 # client is sending.
-                g.cert['UID'] = request.values.get('uid')
-                g.cert['role'] = request.values.get('role')
-                g.cert['serviceLocator'] = request.values.get('sid')
+                cert = '%s/%s/%s' % (request.values.get('uid'),
+                                     request.values.get('role'),
+                                     request.values.get('sid'))
             else:
                 cert = request.environ['SSL_CLIENT_CERT']
-                for key in 'serviceLocator', 'UID', 'role':
-                    g.cert[key] = https.x509.get_x509_dn_field(cert, key)
+
+            fingerprint = hashlib.sha1(cert).hexdigest()
+            cached = cert_cache.get(fingerprint)
+
+            if cached:
+                g.cert, checked_sid = cached
+            else:
+                g.cert, checked_sid = {}, None
+
+                if os.environ.get('DIRECTOR_TESTING'):
+                    g.cert['UID'] = request.values.get('uid')
+                    g.cert['role'] = request.values.get('role')
+                    g.cert['serviceLocator'] = request.values.get('sid')
+                else:
+                    for key in 'serviceLocator', 'UID', 'role':
+                        g.cert[key] = https.x509.get_x509_dn_field(cert, key)
 
             try:
                 uid = int(g.cert['UID'])
@@ -56,12 +149,6 @@ class cert_required(object):
                 log(error_msg)
                 return make_response(error_msg, 401)
 
-            # Getting user data from DB
-            g.user = User.query.get(uid)
-            if not g.user:
-                # authentication failed
-                return build_response(simplejson.dumps(False))
-
             if self.role == 'manager':
                 # manager cert required
                 try:
@@ -72,14 +159,39 @@ class cert_required(object):
                     # Return HTTP_UNAUTHORIZED
                     return make_response(error_msg, 401)
 
-                # check if the service is actually owned by the user
-                from cpsdirector.service import get_service
-                g.service = get_service(uid, service_locator)
-                if not g.service:
+                if checked_sid == service_locator:
+                    # Ownership already checked
+                    from cpsdirector.service import Service
+                    g.user = _attach(User, uid)
+                    g.service = _attach(Service, service_locator,
+                                        user_id=uid)
+                else:
+                    # Getting user data from DB
+                    g.user = User.query.get(uid)
+                    if not g.user:
+                        # authentication failed
+                        return build_response(simplejson.dumps(False))
+
+                    # check if the service is actually owned by the user
+                    from cpsdirector.service import get_service
+                    g.service = get_service(uid, service_locator)
+                    if not g.service:
+                        return build_response(simplejson.dumps(False))
+
+                    log('cert_required: valid certificate (user %s, service %s)' %
+                        (uid, service_locator))
+                    checked_sid = service_locator
+            elif cached:
+                g.user = _attach(User, uid)
+            else:
+                # Getting user data from DB
+                g.user = User.query.get(uid)
+                if not g.user:
+                    # authentication failed
                     return build_response(simplejson.dumps(False))
 
-                log('cert_required: valid certificate (user %s, service %s)' %
-                    (uid, service_locator))
+            if not cached or checked_sid != cached[1]:
+                cert_cache.put(fingerprint, g.cert, checked_sid)
 
             return fn(*args, **kwargs)
         return decorated
@@ -113,6 +225,11 @@ class User(db.Model):
             'created': self.created.isoformat(),
         }
 
+def _forget_user(mapper, connection, user):
+    cert_cache.invalidate(uid=user.uid)
+
+event.listen(User, 'after_delete', _forget_user)
+
 def get_user(username, password):
     """Return a User object if the specified (username, password) combination
     is valid."""
@@ -254,15 +371,47 @@ def get_manager_cert():
 
     csr = crypto.load_certificate_request(crypto.FILETYPE_PEM,
         request.files['csr'].read())
-    return x509cert.create_x509_cert(
+    cert = x509cert.create_x509_cert(
         config_parser.get('conpaas', 'CERT_DIR'), csr)
+    return cert
+
+@user_page.route("/ca/get_certs.php", methods=['POST'])
+@cert_required(role='manager')
+def get_manager_certs():
+    """POST /ca/get_certs.php
+
+    POSTed files named 'csr' are certificate requests to be signed.
+
+    Returns a dictionary with the 'certs' attribute holding the
+    certificates, in the order of the requests.
+    """
+    csrs = request.files.getlist('csr')
+
+    log('%d certificate requests from manager %s (user %s)' % (
+        len(csrs), g.cert['serviceLocator'], g.cert['UID']))
+
+    if not csrs:
+        return jsonify({ 'error': True, 'msg': 'csr is a required field' })
+
+    try:
+        csrs = [ crypto.load_certificate_request(crypto.FILETYPE_PEM,
+                                                 csr.read())
+                 for csr in csrs ]
+    except crypto.Error, err:
+        return jsonify({ 'error': True,
+                         'msg': 'Invalid certificate request: %s' % err })
+
+    certs = x509cert.create_x509_certs(
+        config_parser.get('conpaas', 'CERT_DIR'), csrs)
+    return jsonify({ 'error': False, 'certs': certs })
 
 @user_page.route("/callback/decrementUserCredit.php", methods=['POST'])
 @cert_required(role='manager')
 def credit():
     """POST /callback/decrementUserCredit.php
 
-    POSTed values must contain sid and decrement.
+    POSTed values must contain sid and decrement, the number of nodes of
+    the service to be charged for.
 
     Returns a dictionary with the 'error' attribute set to False if the user
     had enough credit, True otherwise.
@@ -273,13 +422,12 @@ def credit():
     log('Decrement user credit: sid=%s, old_credit=%s, decrement=%s' % (
         service_id, g.service.user.credit, decrement))
 
-    # Decrement user's credit
-    g.service.user.credit -= decrement
-
-    if g.service.user.credit > -1:
+    # Decrement user's credit, if it is large enough
+    if not billing.charge([ (g.service.sid, decrement) ]):
         # User has enough credit
         db.session.commit()
         log('New credit for user %s: %s' % (g.service.user.uid, g.service.user.credit))
+        billing.rollup_if_due()
         return jsonify({ 'error': False })
 
     # User does not have enough credit
@@ -1,58 +1,150 @@
 import os
-import random
+import threading
 
 from OpenSSL import crypto
+from sqlalchemy.exc import IntegrityError
 
 from conpaas.core.misc import file_get_contents
+from conpaas.core.context import context_cache
 from conpaas.core.https import x509
 
-def create_x509_cert(cert_dir, x509_req):
-    # Load the CA cert
-    ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, 
-        file_get_contents(os.path.join(cert_dir, "ca_cert.pem")))
-    
-    # Load private key
-    key = crypto.load_privatekey(crypto.FILETYPE_PEM, 
-        file_get_contents(os.path.join(cert_dir, "ca_key.pem")))
-
-    # Generate serial number
-    serial = random.randint(1, 2048)
+from cpsdirector import db
+
+class CertSerial(db.Model):
+    """The next serial number to be given to a certificate (single row)"""
+    id = db.Column(db.Integer, primary_key=True)
+    next_serial = db.Column(db.Integer, nullable=False)
+
+# Certificates used to get a random serial number between 1 and 2048
+FIRST_SERIAL = 2049
+
+def _reserve_serials(connection, count):
+    """Return the first of count serial numbers reserved in the current
+    transaction of connection, or None if another process reserved some
+    meanwhile"""
+    table = CertSerial.__table__
+
+    row = connection.execute(table.select().where(table.c.id == 1)).first()
+    if row is None:
+        connection.execute(table.insert().values(
+            id=1, next_serial=FIRST_SERIAL + count))
+        return FIRST_SERIAL
+
+    # Only succeeds if no other process reserved serials meanwhile
+    result = connection.execute(table.update().where(
+        (table.c.id == 1) &
+        (table.c.next_serial == row.next_serial)).values(
+        next_serial=row.next_serial + count))
+    if result.rowcount == 1:
+        return row.next_serial
+
+def reserve_serials(count):
+    """Reserve count serial numbers in the database, so that no other
+    process gives them out. The reservation is committed at once, on its
+    own connection: the serials are never given out again, even if the
+    session of the caller is rolled back.
+
+    Return the first one, the others follow it."""
+    connection = db.engine.connect()
+    try:
+        # Directors installed before serials were kept in the database
+        CertSerial.__table__.create(connection, checkfirst=True)
+
+        while True:
+            try:
+                with connection.begin():
+                    serial = _reserve_serials(connection, count)
+            except IntegrityError:
+                # The row has been inserted by another process meanwhile
+                continue
+            if serial is not None:
+                return serial
+    finally:
+        connection.close()
+
+class CertificateAuthority(object):
+    """The director's CA, loaded from cert_dir once.
+
+    Serial numbers are reserved in the database SERIAL_BLOCK at a time,
+    and given out in increasing order."""
+
+    SERIAL_BLOCK = 64
+
+    def __init__(self, cert_dir):
+        self.ca_cert_pem = file_get_contents(
+            os.path.join(cert_dir, "ca_cert.pem"))
+        self.ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                               self.ca_cert_pem)
+        self.key = crypto.load_privatekey(crypto.FILETYPE_PEM,
+            file_get_contents(os.path.join(cert_dir, "ca_key.pem")))
+
+        self.lock = threading.Lock()
+        self.next_serial = self.end_serial = 0
+
+    def get_serial(self):
+        with self.lock:
+            if self.next_serial == self.end_serial:
+                self.next_serial = reserve_serials(self.SERIAL_BLOCK)
+                self.end_serial = self.next_serial + self.SERIAL_BLOCK
+            serial = self.next_serial
+            self.next_serial += 1
+            return serial
+
+    def sign(self, x509_req):
+        """Return the certificate for x509_req, in PEM format"""
+        # Valid for one year starting from now
+        not_before = 0
+        not_after  = 60 * 60 * 24 * 365
+
+        newcert = x509.create_cert(x509_req, self.ca_cert, self.key,
+            self.get_serial(), not_before, not_after)
+
+        return crypto.dump_certificate(crypto.FILETYPE_PEM, newcert)
+
+def get_authority(cert_dir):
+    """Return the CA of cert_dir, loaded again only if its files change"""
+    paths = [ os.path.join(cert_dir, "ca_cert.pem"),
+              os.path.join(cert_dir, "ca_key.pem") ]
+    return context_cache.get(('ca', cert_dir), paths,
+                             lambda: CertificateAuthority(cert_dir))
 
-    # Valid for one year starting from now 
-    not_before = 0
-    not_after  = 60 * 60 * 24 * 365
+def create_x509_cert(cert_dir, x509_req):
+    return get_authority(cert_dir).sign(x509_req)
 
-    newcert = x509.create_cert(x509_req, 
-        ca_cert, key, serial, not_before, not_after)
+def create_x509_certs(cert_dir, x509_reqs):
+    """Sign the given requests.
 
-    return crypto.dump_certificate(crypto.FILETYPE_PEM, newcert)
+    Return the certificates in PEM format, in the order of the requests."""
+    authority = get_authority(cert_dir)
+    return [ authority.sign(x509_req) for x509_req in x509_reqs ]
 
 def generate_certificate(cert_dir, uid, sid, role, email, cn, org, ca_cert=None):
     """Generates a new x509 certificate for a manager from scratch.
 
     Creates a key, a request and then the certificate."""
+    authority = get_authority(cert_dir)
 
     # Get CA cert
     if ca_cert is None:
-        ca_cert = file_get_contents(os.path.join(cert_dir, "ca_cert.pem"))
+        ca_cert = authority.ca_cert_pem
 
     # Generate keypair
     req_key  = x509.gen_rsa_keypair()
 
     # Generate certificate request
-    x509_req = x509.create_x509_req(req_key, userId=uid, serviceLocator=sid, 
+    x509_req = x509.create_x509_req(req_key, userId=uid, serviceLocator=sid,
         O=org, emailAddress=email, CN=cn, role=role)
 
     # Sign the request
-    certificate = create_x509_cert(cert_dir, x509_req)
+    certificate = authority.sign(x509_req)
 
-    return { 'ca_cert': ca_cert, 
-             'key': crypto.dump_privatekey(crypto.FILETYPE_PEM, req_key), 
+    return { 'ca_cert': ca_cert,
+             'key': crypto.dump_privatekey(crypto.FILETYPE_PEM, req_key),
              'cert': certificate }
 
 def get_cert_cname(cert_dir):
     """Return the CNAME value of director's certificate"""
-    cert = crypto.load_certificate(crypto.FILETYPE_PEM, 
+    cert = crypto.load_certificate(crypto.FILETYPE_PEM,
         file_get_contents(os.path.join(cert_dir, "cert.pem")))
 
     subject = cert.get_subject()
@@ -3,9 +3,13 @@
 import os
 import urllib
 import hashlib
+import time
 import unittest
+from datetime import datetime, timedelta
 import simplejson
 
+import mock
+
 os.environ['DIRECTOR_TESTING'] = "true"
 
 import cpsdirector 
@@ -25,6 +29,7 @@ class Common(unittest.TestCase):
     def setUp(self):
         cpsdirector.db.drop_all()
         cpsdirector.db.create_all()
+        cpsdirector.user.cert_cache.clear()
 
     def create_user(self, data=TEST_USER_DATA):
         return cpsdirector.user.create_user(data['username'], 
@@ -194,6 +199,215 @@ class DirectorTest(Common):
         self.test_proper_start(subnet='172.16.0.0/14', sid=1)
         self.test_proper_start(subnet='172.20.0.0/14', sid=2)
 
+    def test_vpn_subnet_reuse(self):
+        self.create_user()
+
+        cpsdirector.common.config_parser.set('conpaas', 'VPN_BASE_NETWORK', '172.16.0.0')
+        cpsdirector.common.config_parser.set('conpaas', 'VPN_NETMASK', '255.240.0.0')
+        cpsdirector.common.config_parser.set('conpaas', 'VPN_SERVICE_BITS', '6')
+
+        def start():
+            response = self.app.post('/start/php', data={ 'uid': 1 })
+            return simplejson.loads(response.data)['subnet']
+
+        self.assertEquals([ '172.16.0.0/14', '172.20.0.0/14', '172.24.0.0/14' ],
+                          [ start(), start(), start() ])
+
+        # The lowest released subnet is taken first
+        self.app.post('/stop/2', data={ 'uid': 1 })
+        self.app.post('/stop/1', data={ 'uid': 1 })
+        self.assertEquals([ '172.16.0.0/14', '172.20.0.0/14', '172.28.0.0/14' ],
+                          [ start(), start(), start() ])
+
+        # All subnets are taken
+        self.assertEquals(None, start())
+
+        # Subnets go along with their application
+        with mock.patch('cpsdirector.service._callmanager'):
+            self.app.post('/delete/1', data={ 'uid': 1 })
+        self.assertEquals(0, cpsdirector.application.VpnSubnet.query.count())
+
+    def test_vpn_subnet_import(self):
+        self.create_user()
+
+        cpsdirector.common.config_parser.set('conpaas', 'VPN_BASE_NETWORK', '172.16.0.0')
+        cpsdirector.common.config_parser.set('conpaas', 'VPN_NETMASK', '255.240.0.0')
+        cpsdirector.common.config_parser.set('conpaas', 'VPN_SERVICE_BITS', '6')
+
+        # A service started before subnets were recorded
+        self.app.post('/start/php', data={ 'uid': 1 })
+        cpsdirector.application.VpnSubnet.query.delete()
+        service = cpsdirector.service.Service.query.get(1)
+        service.subnet = '172.20.0.0/14'
+        cpsdirector.db.session.commit()
+
+        def start():
+            response = self.app.post('/start/php', data={ 'uid': 1 })
+            return simplejson.loads(response.data)['subnet']
+
+        # Free subnets before it are taken first
+        self.assertEquals([ '172.16.0.0/14', '172.24.0.0/14' ],
+                          [ start(), start() ])
+
+    def test_background_start(self):
+        self.create_user()
+
+        job_queue = cpsdirector.job.job_queue
+        job_queue.workers = 2
+        try:
+            response = self.app.post('/start/php', data={ 'uid': 1 })
+            servicedict = simplejson.loads(response.data)
+            job_queue.join()
+        finally:
+            job_queue.workers = 0
+
+        self.assertEquals(1, servicedict['sid'])
+        self.assertEquals('PREINIT', servicedict['state'])
+        self.assertEquals(None, servicedict['manager'])
+
+        response = self.app.get('/job/%s?uid=1' % servicedict['jid'])
+        jobdict = simplejson.loads(response.data)
+        self.assertEquals('DONE', jobdict['state'])
+        self.assertEquals(1, jobdict['service_id'])
+
+        response = self.app.get('/list?uid=1')
+        servicedict = simplejson.loads(response.data)[0]
+        self.assertEquals('INIT', servicedict['state'])
+        self.assertEquals('127.0.0.3', servicedict['manager'])
+
+        # Jobs are only visible to their owner
+        data = dict(TEST_USER_DATA, username='otheruser',
+                    email='other@example.org')
+        user = self.create_user(data)
+        response = self.app.get('/job/%s?uid=%s' % (jobdict['jid'], user.uid))
+        self.assertEquals(False, simplejson.loads(response.data))
+
+    def test_stop_starting_service(self):
+        self.create_user()
+        self.app.post('/start/php', data={ 'uid': 1 })
+
+        # As returned by /start before its manager is started
+        service = cpsdirector.service.Service.query.get(1)
+        service.state = 'PREINIT'
+        service.manager = service.vmid = service.cloud = None
+        cpsdirector.db.session.commit()
+
+        with mock.patch('cpsdirector.service._callmanager') as callmanager:
+            response = self.app.post('/stop/1', data={ 'uid': 1 })
+            self.assertEquals(False, simplejson.loads(response.data))
+
+            response = self.app.post('/delete/1', data={ 'uid': 1 })
+            self.assertEquals(False, simplejson.loads(response.data))
+            self.failIf(callmanager.called)
+
+        self.assertEquals(1, cpsdirector.service.Service.query.count())
+
+    def test_service_deleted_while_starting(self):
+        self.create_user()
+
+        start = cpsdirector.cloud.start
+        def start_and_delete(*args):
+            started = start(*args)
+            # Committed by another request meanwhile
+            cpsdirector.db.engine.execute(
+                cpsdirector.service.Service.__table__.delete())
+            return started
+
+        with mock.patch('cpsdirector.cloud.start', start_and_delete):
+            with mock.patch('cpsdirector.cloud.ManagerController.stop') as stop:
+                response = self.app.post('/start/php', data={ 'uid': 1 })
+                self.assert_(simplejson.loads(response.data)['error'])
+
+        # The VM of the manager is not left running
+        stop.assert_called_once_with('3')
+        self.assertEquals(0, cpsdirector.service.Service.query.count())
+
+    def test_manager_config(self):
+        from cpsdirector.cloud import ManagerController
+
+        php = ManagerController('php', 11, 1, 'iaas', 1, '172.16.0.0/14')
+        mysql = ManagerController('mysql', 12, 1, 'iaas', 1, None)
+        for controller in php, mysql:
+            controller._stop_reservation_timer()
+
+        # Each controller keeps the values of its own service
+        self.assertEquals(('11', 'php', '172.16.0.0/14'),
+            (php.config_parser.get('manager', 'SERVICE_ID'),
+             php.config_parser.get('manager', 'TYPE'),
+             php.config_parser.get('manager', 'IPOP_SUBNET')))
+        self.assertEquals(('12', 'mysql'),
+            (mysql.config_parser.get('manager', 'SERVICE_ID'),
+             mysql.config_parser.get('manager', 'TYPE')))
+        self.failIf(mysql.config_parser.has_option('manager', 'IPOP_SUBNET'))
+        self.failIf(cpsdirector.common.config_parser.has_section('manager'))
+
+    def test_interrupted_start(self):
+        self.create_user()
+        self.app.post('/start/php', data={ 'uid': 1 })
+        self.app.post('/start/php', data={ 'uid': 1 })
+
+        # Left running by a director process which stopped, and by a live one
+        stale = datetime.now() - timedelta(seconds=
+            cpsdirector.job.HEARTBEAT_INTERVAL *
+            cpsdirector.job.STALE_INTERVALS + 1)
+        for jid, updated in (1, stale), (2, datetime.now()):
+            job = cpsdirector.job.Job.query.get(jid)
+            job.state, job.updated = 'RUNNING', updated
+            cpsdirector.service.Service.query.get(jid).state = 'PREINIT'
+        cpsdirector.db.session.commit()
+
+        self.assertEquals([ 1 ], cpsdirector.job.fail_stale_jobs())
+        self.assertEquals([ 'ERROR', 'RUNNING' ],
+                          [ job.state for job in
+                            cpsdirector.job.Job.query.order_by('jid') ])
+
+        # The service left in PREINIT state is gone
+        self.assertEquals([ 2 ], [ service.sid for service in
+                                   cpsdirector.service.Service.query.all() ])
+
+    def test_list_manager_state(self):
+        self.create_user()
+        self.app.post('/start/php', data={ 'uid': 1 })
+        self.app.post('/start/php', data={ 'uid': 1 })
+
+        # The dummy cloud gives the same address to all the managers
+        service = cpsdirector.service.Service.query.get(2)
+        service.manager = '127.0.0.4'
+        cpsdirector.db.session.commit()
+
+        states = { '127.0.0.3': { 'state': 'RUNNING' } }
+        def callmanager(manager, method, post, data):
+            self.assertEquals('get_service_info', method)
+            if manager not in states:
+                raise Exception('Manager %s unreachable' % manager)
+            return states[manager]
+
+        with mock.patch('cpsdirector.service._callmanager', callmanager):
+            response = self.app.get('/list?uid=1&manager_state=1')
+            services = simplejson.loads(response.data)
+            self.assertEquals([ 'RUNNING', None ],
+                              [ s['manager_state'] for s in services ])
+
+            response = self.app.get('/list/1?uid=1')
+            self.failIf('manager_state' in simplejson.loads(response.data)[0])
+
+    def test_deleteapp_shuts_down_services(self):
+        self.create_user()
+        self.app.post('/start/php', data={ 'uid': 1 })
+        self.app.post('/start/php', data={ 'uid': 1 })
+
+        calls = []
+        def callmanager(manager, method, post, data):
+            calls.append(method)
+            return {}
+
+        with mock.patch('cpsdirector.service._callmanager', callmanager):
+            response = self.app.post('/delete/1', data={ 'uid': 1 })
+            self.assertEquals(True, simplejson.loads(response.data))
+
+        self.assertEquals([ 'shutdown', 'shutdown' ], calls)
+        self.assertEquals([], cpsdirector.service.Service.query.all())
+
     def test_proper_rename(self):
         # create user and service
         self.create_user()
@@ -396,6 +610,71 @@ class DirectorTest(Common):
         self.assertEquals(200, response.status_code)
         self.assertEquals("application/zip", response.mimetype)
 
+    def test_get_manager_certs(self):
+        self.__new_service()
+
+        from StringIO import StringIO
+        from conpaas.core.https import x509
+
+        csrs = []
+        for role in 'agent', 'manager':
+            req = x509.create_x509_req(x509.gen_rsa_keypair(), userId='1',
+                serviceLocator='1', O='ConPaaS', CN=role, role=role)
+            csrs.append((StringIO(x509.x509_req_as_pem(req)), role + '.pem'))
+
+        data = { 'sid': 1, 'uid': 1, 'role': 'manager', 'csr': csrs }
+        response = self.app.post('/ca/get_certs.php', data=data)
+        result = simplejson.loads(response.data)
+        self.failIf(result['error'])
+
+        # Certificates are returned in the order of the requests
+        self.assertEquals(['agent', 'manager'],
+            [ x509.get_x509_dn_field(cert, 'role')
+              for cert in result['certs'] ])
+
+        data = { 'sid': 1, 'uid': 1, 'role': 'manager' }
+        response = self.app.post('/ca/get_certs.php', data=data)
+        self.assert_(simplejson.loads(response.data)['error'])
+
+    def test_certificate_serials(self):
+        from OpenSSL import crypto
+        from cpsdirector import x509cert
+
+        cert_dir = cpsdirector.common.config_parser.get('conpaas', 'CERT_DIR')
+
+        def serial(authority):
+            cert = authority.sign(x509.create_x509_req(key, CN='test'))
+            return crypto.load_certificate(crypto.FILETYPE_PEM,
+                                           cert).get_serial_number()
+
+        from conpaas.core.https import x509
+        key = x509.gen_rsa_keypair()
+
+        first = x509cert.CertificateAuthority(cert_dir)
+        first.SERIAL_BLOCK = 2
+        self.assertEquals([2049, 2050, 2051],
+                          [ serial(first) for _ in range(3) ])
+
+        # Serials reserved by another director process are skipped
+        second = x509cert.CertificateAuthority(cert_dir)
+        self.assertEquals(2053, serial(second))
+        self.assertEquals(2052, serial(first))
+        self.assertEquals(2053 + second.SERIAL_BLOCK, serial(first))
+
+        # Reservations are committed at once, whatever the session does
+        cpsdirector.db.session.rollback()
+        self.assertEquals(2053 + second.SERIAL_BLOCK + first.SERIAL_BLOCK,
+            x509cert.CertSerial.query.get(1).next_serial)
+
+        # A new block after a rollback does not give out serials again
+        third = x509cert.CertificateAuthority(cert_dir)
+        self.assertEquals(2053 + second.SERIAL_BLOCK + first.SERIAL_BLOCK,
+                          serial(third))
+
+        # The CA is loaded once
+        self.assert_(x509cert.get_authority(cert_dir) is
+                     x509cert.get_authority(cert_dir))
+
     def __test_new_user(self, data):
         response = self.app.post('/new_user', data=data)
         self.assertEquals(200, response.status_code)
@@ -699,7 +978,94 @@ class DirectorTest(Common):
 
         response = self.app.post('/upload_manifest', data=data)
         self.assertEquals(200, response.status_code)
-        self.assertEquals(True, simplejson.loads(response.data))
+        jid = simplejson.loads(response.data)['jid']
+
+        # The manifest has been deployed by a job
+        response = self.app.get('/job/%s?uid=1' % jid)
+        jobdict = simplejson.loads(response.data)
+        self.assertEquals('ERROR', jobdict['state'])
+        self.assert_('Application is not defined' in jobdict['msg'])
+
+    def test_manifest_dependencies(self):
+        user = self.create_user()
+        events = []
+
+        def fake_service(servicetype, depends_on=()):
+            class MFake(cpsdirector.manifest.MGeneral):
+                def start(self, json, appid):
+                    events.append(('start', servicetype))
+                    time.sleep(0.2)
+                    events.append(('end', servicetype))
+                    return 'ok'
+            MFake.depends_on = depends_on
+            return MFake
+
+        services = {
+            'php': fake_service('php', ('mysql', 'xtreemfs')),
+            'mysql': fake_service('mysql'),
+            'selenium': fake_service('selenium'),
+        }
+
+        progress = []
+        manifest = [ { 'Type': 'php', 'ServiceName': 'web' },
+                     { 'Type': 'mysql' }, { 'Type': 'selenium' } ]
+        with mock.patch.dict(cpsdirector.manifest.manifest_services, services):
+            deployer = cpsdirector.manifest.ManifestDeployer(manifest, 1,
+                    user.uid, progress.append)
+            self.assertEquals('ok', deployer.run())
+
+        # mysql and selenium start together, php once mysql is done
+        self.assertEquals(set([('start', 'mysql'), ('start', 'selenium')]),
+                          set(events[:2]))
+        self.assert_(events.index(('end', 'mysql')) <
+                     events.index(('start', 'php')))
+        self.assertEquals('web: done, mysql #2: done, selenium #3: done',
+                          progress[-1])
+
+    def test_manifest_failed_dependency(self):
+        user = self.create_user()
+
+        class MFailing(cpsdirector.manifest.MGeneral):
+            def start(self, json, appid):
+                return 'Cannot start'
+
+        started = []
+        class MPhp(cpsdirector.manifest.MGeneral):
+            depends_on = ('mysql',)
+            def start(self, json, appid):
+                started.append(json)
+                return 'ok'
+
+        services = { 'php': MPhp, 'mysql': MFailing }
+        manifest = [ { 'Type': 'php' }, { 'Type': 'mysql' } ]
+        with mock.patch.dict(cpsdirector.manifest.manifest_services, services):
+            deployer = cpsdirector.manifest.ManifestDeployer(manifest, 1,
+                    user.uid)
+            self.assertEquals('Not started, mysql #2 failed', deployer.run())
+
+        self.assertEquals([], started)
+
+    def test_wait_for_state_old_manager(self):
+        states = [ 'PROLOGUE', 'PROLOGUE', 'RUNNING' ]
+        calls = []
+        def callmanager(sid, method, post, data):
+            calls.append(method)
+            if method == 'wait_for_state':
+                # As _callmanager fails on the 404 of the manager
+                raise Exception('Call to method %s on 127.0.0.3 failed: '
+                                'method not found.\nParams = %s' % (method,
+                                                                    data))
+            return { 'state': states.pop(0) }
+
+        delays = []
+        with mock.patch('cpsdirector.manifest.callmanager', callmanager):
+            with mock.patch('time.sleep', delays.append):
+                cpsdirector.manifest.MGeneral().wait_for_state(1, 'RUNNING')
+
+        # Polled, less and less often
+        self.assertEquals([ 'wait_for_state' ] + [ 'get_service_info' ] * 3,
+                          calls)
+        self.assertEquals([ 1, 2 ], delays)
 
     def test_download_manifest_missing(self):
         self.create_user()
@@ -736,5 +1102,110 @@ class DirectorTest(Common):
         self.assertEquals(200, response.status_code)
         self.assertEquals(result, response.data)
 
+class CertCacheTest(Common):
+
+    def setUp(self):
+        Common.setUp(self)
+        self.app = cpsdirector.app.test_client()
+
+    def test_expiry_and_size(self):
+        cache = cpsdirector.user.CertCache(2, 60)
+        cache.put('a', { 'UID': '1' })
+        cache.put('b', { 'UID': '2' }, 3)
+        self.assertEquals(({ 'UID': '2' }, 3), cache.get('b'))
+
+        # The oldest entry is dropped
+        cache.put('c', { 'UID': '3' })
+        self.assertEquals(None, cache.get('a'))
+
+        cache.ttl = -1
+        cache.put('d', { 'UID': '4' })
+        self.assertEquals(None, cache.get('d'))
+
+    def test_invalidated_on_service_deletion(self):
+        self.create_user()
+        self.app.post('/start/php', data={ 'uid': 1 })
+
+        data = { 'uid': 1, 'sid': 1, 'role': 'manager', 'decrement': 1 }
+        response = self.app.post('/callback/decrementUserCredit.php', data=data)
+        self.assertEquals(False, simplejson.loads(response.data)['error'])
+
+        fingerprint = hashlib.sha1('1/manager/1').hexdigest()
+        self.assertEquals(1, cpsdirector.user.cert_cache.get(fingerprint)[1])
+
+        self.app.post('/stop/1', data={ 'uid': 1 })
+        self.assertEquals(None, cpsdirector.user.cert_cache.get(fingerprint))
+
+        response = self.app.post('/callback/decrementUserCredit.php', data=data)
+        self.assertEquals(False, simplejson.loads(response.data))
+
+class CreditTest(Common):
+
+    def setUp(self):
+        Common.setUp(self)
+        self.app = cpsdirector.app.test_client()
+
+        # Two services for the first user, one for the second
+        self.create_user()
+        self.create_user(dict(TEST_USER_DATA, username='otheruser',
+                              email='other@example.org', credit=3))
+        for uid in 1, 1, 2:
+            self.app.post('/start/php', data={ 'uid': uid })
+
+    def credits(self):
+        return [ user.credit for user in
+                 cpsdirector.user.User.query.order_by('uid') ]
+
+    def ledger(self):
+        CreditCharge = cpsdirector.credit.CreditCharge
+        return [ (charge.user_id, charge.service_id, charge.nodes,
+                  charge.rollup) for charge in
+                 CreditCharge.query.order_by(CreditCharge.cid) ]
+
+    def test_charge(self):
+        # Starting the managers already cost one credit each
+        self.assertEquals([ 118, 2 ], self.credits())
+
+        refused = cpsdirector.credit.charge([ (1, 10), (2, 5), (3, 3) ])
+        cpsdirector.db.session.commit()
+
+        # The second user cannot afford their nodes
+        self.assertEquals(set([ 2 ]), refused)
+        self.assertEquals([ 103, 2 ], self.credits())
+        self.assertEquals([ (1, 1, 10, False), (1, 2, 5, False) ],
+                          self.ledger()[-2:])
+
+    def test_charge_unknown_service(self):
+        self.assertEquals(set(), cpsdirector.credit.charge([ (42, 1) ]))
+        cpsdirector.db.session.commit()
+        self.assertEquals([ 118, 2 ], self.credits())
+
+    def test_never_negative(self):
+        # Many small charges cannot overdraw a credit
+        refused = [ cpsdirector.credit.charge([ (3, 1) ]) for _ in range(4) ]
+        cpsdirector.db.session.commit()
+
+        self.assertEquals([ set(), set(), set([ 2 ]), set([ 2 ]) ], refused)
+        self.assertEquals([ 118, 0 ], self.credits())
+
+    def test_rollup(self):
+        cpsdirector.credit.charge([ (1, 2), (2, 3) ])
+        cpsdirector.credit.charge([ (1, 4) ])
+        cpsdirector.db.session.commit()
+
+        # Nothing is old enough
+        before = datetime.now() - timedelta(hours=1)
+        self.assertEquals(0, cpsdirector.credit.rollup(before))
+
+        entries = len(self.ledger())
+        removed = cpsdirector.credit.rollup(datetime.now() + timedelta(hours=1))
+        self.assertEquals(entries, removed)
+        self.assertEquals([ (1, 1, 7, True), (1, 2, 4, True),
+                            (2, 3, 1, True) ], sorted(self.ledger()))
+
+        # Rolled up entries are not rolled up again
+        self.assertEquals(0, cpsdirector.credit.rollup(
+            datetime.now() + timedelta(hours=2)))
+
 if __name__ == "__main__":
     unittest.main()
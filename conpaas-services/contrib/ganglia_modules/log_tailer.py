@@ -0,0 +1,86 @@
+# Incremental reading of log files, shared by the Ganglia modules parsing
+# the nginx and PHP-FPM logs. Installed along with them.
+#
+# Replaces running /usr/sbin/logtail into a temporary file and reading it
+# back: the log is read once, in place.
+import os
+
+# Bytes read from the log at once
+CHUNK_SIZE = 64 * 1024
+
+# Yields the lines written to a log file since the previous call of lines().
+# The file is kept open between calls, and its inode checked: when the log
+# is rotated, the rest of the old file is read before the new one. When it
+# is truncated, it is read again from its start.
+class LogTailer(object):
+	def __init__(self, log_file):
+		self.log_file = log_file
+		self.file = None
+		self.inode = None
+		# beginning of a line not completely written yet
+		self.partial = ''
+
+	# Opens the log file, at its end the first time: what was written
+	# before the module started is not of interest.
+	def _open(self, at_end):
+		try:
+			f = open(self.log_file, 'rb')
+		except IOError:
+			return False
+
+		if self.file is not None:
+			self.file.close()
+		self.file = f
+		self.inode = os.fstat(f.fileno()).st_ino
+		self.partial = ''
+		if at_end:
+			f.seek(0, os.SEEK_END)
+		return True
+
+	# Yields the complete lines from the current position in the file.
+	def _read(self):
+		while True:
+			chunk = self.file.read(CHUNK_SIZE)
+			if not chunk:
+				return
+
+			lines = (self.partial + chunk).split('\n')
+			self.partial = lines.pop()
+			for line in lines:
+				yield line
+
+	def lines(self):
+		if self.file is None:
+			if not self._open(True):
+				return
+
+		for line in self._read():
+			yield line
+
+		try:
+			stat = os.stat(self.log_file)
+		except OSError:
+			# rotated, and the new log not created yet
+			return
+
+		if stat.st_ino != self.inode:
+			# rotated: the old file was read till its end, go on with the
+			# new one
+			if self.partial:
+				yield self.partial
+			if not self._open(False):
+				return
+		elif stat.st_size < self.file.tell():
+			# truncated
+			self.file.seek(0)
+			self.partial = ''
+		else:
+			return
+
+		for line in self._read():
+			yield line
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
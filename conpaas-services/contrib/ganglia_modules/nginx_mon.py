@@ -1,10 +1,14 @@
 # Ganglia module for parsing the nginx access log.
-# Computes average request rate and response time.
-# Uses the logtail tool to access the log.
-import subprocess, threading;
+# Computes average request rate and response time, the percentiles of the
+# response time, and the rate of errors and bytes sent.
+# Reads the log incrementally, with a LogTailer.
+import threading;
 import time, os;
 import logging;
 
+from log_tailer import LogTailer
+from histogram import LatencyHistogram, metric_units, to_metrics
+
 web_static_log = '/var/cache/cpsagent/nginx-static-timed.log'
 dbg_log = '/tmp/nginx_dbg.log'
 logtail_interval = 15
@@ -15,6 +19,11 @@ logger = logging.getLogger('Ganglia Web')
 # These variables hold the computed monitoring results.
 web_response_time = 0
 web_request_rate = 0
+web_error_rate = 0
+web_throughput = 0
+
+# Percentiles and histogram of the response times, see histogram.py
+histogram_metrics = {}
 
 # Can be used to stop the parsing thread.
 stop_parsing = False
@@ -35,8 +44,7 @@ class NginxLogParser(threading.Thread):
 
 		logger.debug("Initializing NginxLogParser with parse interval: " + \
 			str(self.parse_interval) + ", static log: " + self.static_log_file)
-		self.tmp_static_file = '/tmp/nginx_static_temp.log'		
-		self.tmp_proxy_file = '/tmp/nginx_proxy_temp.log'
+		self.static_tailer = LogTailer(self.static_log_file)
 
 		# last timestamp seen in the log
 		self.last_access_time = 0
@@ -45,32 +53,47 @@ class NginxLogParser(threading.Thread):
 	# Computes the average request rate and response time and writes them
 	# in global variables.
 	def process_static_log(self):  
-		global logger, web_response_time, web_request_rate
+		global logger, web_response_time, web_request_rate, web_error_rate, web_throughput
+		global histogram_metrics
 
 		#logger.debug("Processing static log...")
 
 		try:
-			# get what has been added to the log since last time we checked
-			f_tmp_w = open(self.tmp_static_file, 'w')
-			subprocess.call(['/usr/sbin/logtail', '-f', self.static_log_file], stdout=f_tmp_w)
-			f_tmp_w.close()
-
 			start_time = 0
 			crt_time = self.last_access_time
 			n_requests = 0
 			total_resp_time = 0
+			n_errors = 0
+			bytes_sent = 0
+			histogram = LatencyHistogram()
 		
-			f_tmp_r = open(self.tmp_static_file, 'r')
-			for line in f_tmp_r:
+			# what has been added to the log since last time we checked
+			for line in self.static_tailer.lines():
 				logger.debug(line + '\n')
-				tokens = line.split()
-				nt = len(tokens)
-				crt_time = float(tokens[nt - 2])
+				try:
+					tokens = line.split()
+					nt = len(tokens)
+					line_time = float(tokens[nt - 2])
+					resp_time = float(tokens[nt - 1])
+					# status and body size follow the quoted request
+					fields = line.split('"')[2].split()
+					status = fields[0]
+					body_size = int(fields[1])
+				except (IndexError, ValueError):
+					logger.warning("Skipping malformed log line: " + line)
+					continue
+
+				crt_time = line_time
 				if (start_time == 0):
 					start_time = crt_time
-				total_resp_time += float(tokens[nt - 1])	
+				total_resp_time += resp_time
+				histogram.add(resp_time * 1000)
 				n_requests += 1
 
+				if (status.startswith('5')):
+					n_errors += 1
+				bytes_sent += body_size
+
 			# not the first time we read from the log
 			if (self.last_access_time != 0):
 				start_time = self.last_access_time
@@ -80,22 +103,28 @@ class NginxLogParser(threading.Thread):
 			# request rate in requests / sec
 			if (start_time != end_time):
 				web_request_rate = n_requests / (end_time - start_time) 
+				web_error_rate = n_errors / (end_time - start_time)
+				web_throughput = bytes_sent / (end_time - start_time)
 				self.last_access_time = end_time
 			else:
 				web_request_rate = 0
+				web_error_rate = 0
+				web_throughput = 0
 
 			logger.debug("Start time: " + str(start_time) + ", end time: " + str(end_time) + "\n")
 			# response time in ms
 			if ((n_requests != 0) and (start_time != end_time)):
 				web_response_time = (total_resp_time * 1000) / n_requests			
+				histogram_metrics = to_metrics('web_response_time', histogram,
+					end_time - start_time)
 			else:
 				web_response_time = 0
+				histogram_metrics = to_metrics('web_response_time',
+					LatencyHistogram(), 0)
 
 			logger.debug("Req rate: " + str(web_request_rate) + ", response time: " + str(web_response_time) + 
 "n. requests: " + str(n_requests) + "\n")
 
-			f_tmp_r.close()
-
 		except Exception, ex:
 			logger.exception(ex)
 			return 1 		
@@ -124,6 +153,17 @@ def response_time_static_handler(name):
 	global web_response_time
 	return web_response_time
 
+def error_rate_static_handler(name):
+	global web_error_rate
+	return web_error_rate
+
+def throughput_static_handler(name):
+	global web_throughput
+	return web_throughput
+
+def histogram_handler(name):
+	global histogram_metrics
+	return histogram_metrics.get(name, 0)
 
 def metric_init(params):
 	global descriptors, web_static_log, logtail_interval
@@ -161,8 +201,39 @@ def metric_init(params):
 		'description': 'Web Response Time',
 		'groups': 'web'}
 
+	d3 = {'name': 'web_error_rate',
+		'call_back': error_rate_static_handler,
+		'time_max': 90,
+		'value_type': 'float',
+		'units': 'req/s',
+		'slope': 'both',
+		'format': '%f',
+		'description': 'Web Server Error Rate',
+		'groups': 'web'}
+
+	d4 = {'name': 'web_throughput',
+		'call_back': throughput_static_handler,
+		'time_max': 90,
+		'value_type': 'float',
+		'units': 'bytes/s',
+		'slope': 'both',
+		'format': '%f',
+		'description': 'Web Throughput',
+		'groups': 'web'}
 	
-	descriptors = [d1, d2]
+	descriptors = [d1, d2, d3, d4]
+
+	# percentiles and histogram of the response times
+	for name, units in metric_units('web_response_time'):
+		descriptors.append({'name': name,
+			'call_back': histogram_handler,
+			'time_max': 90,
+			'value_type': 'float',
+			'units': units,
+			'slope': 'both',
+			'format': '%f',
+			'description': 'Web Response Time ' + name[len('web_response_time') + 1:],
+			'groups': 'web'})
 
 	parser_thread =  NginxLogParser(web_static_log, web_static_log, logtail_interval)	
 	parser_thread.start()
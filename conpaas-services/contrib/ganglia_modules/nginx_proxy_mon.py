@@ -1,10 +1,15 @@
 # Ganglia module for parsing the nginx proxy access log.
-# Computes average request rate and response time for static and php requests.
-# Uses the logtail tool to access the log.
-import subprocess, threading;
+# Computes average request rate, response time and the percentiles of the
+# response time for static and php requests, and the rate of errors and bytes
+# sent for all of them.
+# Reads the log incrementally, with a LogTailer.
+import threading;
 import time, os;
 import logging;
 
+from log_tailer import LogTailer
+from histogram import LatencyHistogram, metric_units, to_metrics
+
 web_proxy_log = '/var/cache/cpsagent/nginx-proxy-timed.log'
 dbg_log = '/tmp/nginx_proxy_dbg.log'
 logtail_interval = 15
@@ -19,6 +24,12 @@ web_request_rate_lb = 0
 php_response_time_lb = 0
 php_request_rate_lb = 0
 
+error_rate_lb = 0
+throughput_lb = 0
+
+# Percentiles and histograms of the response times, see histogram.py
+histogram_metrics = {}
+
 # Can be used to stop the parsing thread.
 stop_parsing = False
 
@@ -37,7 +48,7 @@ class NginxLogParser(threading.Thread):
 
 		logger.debug("Initializing NginxLogParser with parse interval: " + \
 			str(self.parse_interval) + ", proxy log: " + self.proxy_log_file)	
-		self.tmp_proxy_file = '/tmp/nginx_proxy_temp.log'
+		self.proxy_tailer = LogTailer(self.proxy_log_file)
 
 		# last timestamp seen in the log
 		self.last_access_time = 0
@@ -47,36 +58,53 @@ class NginxLogParser(threading.Thread):
 	# in global variables.
 	def process_proxy_log(self):  
 		global logger, web_response_time_lb, web_request_rate_lb, php_response_time_lb, php_request_rate_lb
+		global error_rate_lb, throughput_lb, histogram_metrics
 
 		logger.debug("Processing proxy log...")
 
 		try:
-			# get what has been added to the log since last time we checked
-			f_tmp_w = open(self.tmp_proxy_file, 'w')
-			subprocess.call(['/usr/sbin/logtail', '-f', self.proxy_log_file], stdout=f_tmp_w)
-			f_tmp_w.close()
-
 			start_time = 0
 			crt_time = self.last_access_time
 			n_web_requests = 0
 			n_php_requests = 0
 			total_web_resp_time = 0
 			total_php_resp_time = 0
+			n_errors = 0
+			bytes_sent = 0
+			web_histogram = LatencyHistogram()
+			php_histogram = LatencyHistogram()
 		
-			f_tmp_r = open(self.tmp_proxy_file, 'r')
-			for line in f_tmp_r:
+			# what has been added to the log since last time we checked
+			for line in self.proxy_tailer.lines():
 				logger.debug(line + '\n')
-				tokens = line.split()
-				nt = len(tokens)
-				crt_time = float(tokens[nt - 2])
+				try:
+					tokens = line.split()
+					nt = len(tokens)
+					line_time = float(tokens[nt - 2])
+					resp_time = float(tokens[nt - 1])
+					# status and body size follow the quoted request
+					fields = line.split('"')[2].split()
+					status = fields[0]
+					body_size = int(fields[1])
+				except (IndexError, ValueError):
+					logger.warning("Skipping malformed log line: " + line)
+					continue
+
+				crt_time = line_time
 				if (start_time == 0):
 					start_time = crt_time
-				
+
+				if (status.startswith('5')):
+					n_errors += 1
+				bytes_sent += body_size
+
 				if (line.find('php') >= 0):
-					total_php_resp_time += float(tokens[nt - 1])	
+					total_php_resp_time += resp_time
+					php_histogram.add(resp_time * 1000)
 					n_php_requests += 1
 				else:
-					total_web_resp_time += float(tokens[nt - 1])	
+					total_web_resp_time += resp_time
+					web_histogram.add(resp_time * 1000)
 					n_web_requests += 1
 
 			# not the first time we read from the log
@@ -89,10 +117,14 @@ class NginxLogParser(threading.Thread):
 			if (start_time != end_time):
 				web_request_rate_lb = n_web_requests / (end_time - start_time)
 				php_request_rate_lb = n_php_requests / (end_time - start_time) 
+				error_rate_lb = n_errors / (end_time - start_time)
+				throughput_lb = bytes_sent / (end_time - start_time)
 				self.last_access_time = end_time
 			else:
 				web_request_rate_lb = 0
 				php_request_rate_lb = 0
+				error_rate_lb = 0
+				throughput_lb = 0
 
 			logger.debug("Start time: " + str(start_time) + ", end time: " + str(end_time) + "\n")
 			# response time in ms
@@ -106,12 +138,18 @@ class NginxLogParser(threading.Thread):
 			else:
 				php_response_time_lb = 0
 
+			if (start_time == end_time):
+				web_histogram = LatencyHistogram()
+				php_histogram = LatencyHistogram()
+			histogram_metrics = to_metrics('web_response_time_lb', web_histogram,
+				end_time - start_time)
+			histogram_metrics.update(to_metrics('php_response_time_lb', php_histogram,
+				end_time - start_time))
+
 			logger.debug("Web req rate: " + str(web_request_rate_lb) + ", web response time: " + \
 									str(web_response_time_lb) + "n. web requests: " + str(n_web_requests) + "\n")
 			logger.debug("PHP req rate: " + str(php_request_rate_lb) + ", php response time: " + \
 									str(php_response_time_lb) + "n. php requests: " + str(n_php_requests) + "\n")
-			
-			f_tmp_r.close()
 
 		except Exception, ex:
 			logger.exception(ex)
@@ -148,6 +186,18 @@ def php_response_time_lb_handler(name):
 	global php_response_time_lb
 	return php_response_time_lb
 
+def error_rate_lb_handler(name):
+	global error_rate_lb
+	return error_rate_lb
+
+def throughput_lb_handler(name):
+	global throughput_lb
+	return throughput_lb
+
+def histogram_handler(name):
+	global histogram_metrics
+	return histogram_metrics.get(name, 0)
+
 def metric_init(params):
 	global descriptors, web_proxy_log, logtail_interval
 	global logger
@@ -204,8 +254,49 @@ def metric_init(params):
 		'description': 'Load Balancer PHP Response Time',
 		'groups': 'web'}
 
+	d5 = {'name': 'error_rate_lb',
+		'call_back': error_rate_lb_handler,
+		'time_max': 90,
+		'value_type': 'float',
+		'units': 'req/s',
+		'slope': 'both',
+		'format': '%f',
+		'description': 'Load Balancer Server Error Rate',
+		'groups': 'web'}
+
+	d6 = {'name': 'throughput_lb',
+		'call_back': throughput_lb_handler,
+		'time_max': 90,
+		'value_type': 'float',
+		'units': 'bytes/s',
+		'slope': 'both',
+		'format': '%f',
+		'description': 'Load Balancer Throughput',
+		'groups': 'web'}
 	
-	descriptors = [d1, d2, d3, d4]
+	descriptors = [d1, d2, d3, d4, d5, d6]
+
+	# percentiles and histogram of the response times
+	for name, units in metric_units('web_response_time_lb'):
+		descriptors.append({'name': name,
+			'call_back': histogram_handler,
+			'time_max': 90,
+			'value_type': 'float',
+			'units': units,
+			'slope': 'both',
+			'format': '%f',
+			'description': 'Load Balancer Web Response Time ' + name[len('web_response_time_lb') + 1:],
+			'groups': 'web'})
+	for name, units in metric_units('php_response_time_lb'):
+		descriptors.append({'name': name,
+			'call_back': histogram_handler,
+			'time_max': 90,
+			'value_type': 'float',
+			'units': units,
+			'slope': 'both',
+			'format': '%f',
+			'description': 'Load Balancer PHP Response Time ' + name[len('php_response_time_lb') + 1:],
+			'groups': 'web'})
 
 	parser_thread =  NginxLogParser(web_proxy_log, logtail_interval)	
 	parser_thread.start()
@@ -1,10 +1,14 @@
 # Ganglia module for parsing the PHP-FPM access log.
-# Computes average request rate and response time.
-# Uses the logtail tool to access the log.
-import subprocess, threading;
+# Computes average request rate and response time, the percentiles of the
+# response time, and the rate of errors.
+# Reads the log incrementally, with a LogTailer.
+import threading;
 import time, os;
 import logging;
 
+from log_tailer import LogTailer
+from histogram import LatencyHistogram, metric_units, to_metrics
+
 php_fpm_log = '/var/cache/cpsagent/fpm-access.log'
 dbg_log = '/tmp/php_mon_dbg.log'
 logtail_interval = 15
@@ -15,6 +19,10 @@ logger = logging.getLogger('Ganglia PHP')
 # These global variables hold the computed monitoring results
 php_response_time = 0
 php_request_rate = 0
+php_error_rate = 0
+
+# Percentiles and histogram of the response times, see histogram.py
+histogram_metrics = {}
 
 # Can be used to stop the parsing thread
 stop_parsing = False
@@ -33,7 +41,7 @@ class PHPLogParser(threading.Thread):
 		self.parse_interval = parse_interval
 		logger.debug("Initializing PHPLogParser with parse interval: " + \
 			str(self.parse_interval) + ", log file: " + self.log_file)
-		self.tmp_log_file = '/tmp/php_mon_temp.log'		
+		self.tailer = LogTailer(self.log_file)
 
 		# last timestamp seen in the log
 		self.last_access_time = 0
@@ -42,32 +50,43 @@ class PHPLogParser(threading.Thread):
 	# Computes the average request rate and response time and stores them
 	# in global variables.
 	def process_php_log(self):  
-		global logger, php_response_time, php_request_rate
+		global logger, php_response_time, php_request_rate, php_error_rate
+		global histogram_metrics
 
 		logger.debug("Processing PHP log...")
 
 		try:
-			# get what has been written in the log since the last time we checked
-			f_tmp_w = open(self.tmp_log_file, 'w')
-			subprocess.call(['/usr/sbin/logtail', '-f', self.log_file], stdout=f_tmp_w)
-			f_tmp_w.close()
-
 			start_time = 0
 			crt_time = self.last_access_time
 			n_requests = 0
 			total_resp_time = 0
+			n_errors = 0
+			histogram = LatencyHistogram()
 		
-			f_tmp_r = open(self.tmp_log_file, 'r')
-			for line in f_tmp_r:
+			# what has been written in the log since the last time we checked
+			for line in self.tailer.lines():
 				logger.debug(line + '\n')
-				tokens = line.split()
-				nt = len(tokens)
-				crt_time = float(tokens[nt - 2])
+				try:
+					tokens = line.split()
+					nt = len(tokens)
+					line_time = float(tokens[nt - 2])
+					resp_time = float(tokens[nt - 1])
+					# the status follows the quoted request
+					status = line.split('"')[2].split()[0]
+				except (IndexError, ValueError):
+					logger.warning("Skipping malformed log line: " + line)
+					continue
+
+				crt_time = line_time
 				if (start_time == 0):
 					start_time = crt_time
-				total_resp_time += float(tokens[nt - 1])	
+				total_resp_time += resp_time
+				histogram.add(resp_time)
 				n_requests += 1
 
+				if (status.startswith('5')):
+					n_errors += 1
+
 			# not the first time we read from the log
 			if (self.last_access_time != 0):
 				start_time = self.last_access_time
@@ -79,9 +98,11 @@ class PHPLogParser(threading.Thread):
 			# request rate in requests / sec
 			if (start_time != end_time):
 				php_request_rate = n_requests / (end_time - start_time) 
+				php_error_rate = n_errors / (end_time - start_time)
 				self.last_access_time = end_time
 			else:
 				php_request_rate = 0
+				php_error_rate = 0
 
 			# response time in ms
 			if (n_requests != 0):
@@ -89,11 +110,12 @@ class PHPLogParser(threading.Thread):
 			else:
 				php_response_time = 0
 
+			histogram_metrics = to_metrics('php_response_time', histogram,
+				end_time - start_time)
+
 			logger.debug("Req rate: " + str(php_request_rate) + ", response time: " + str(php_response_time) + 
 "n. requests: " + str(n_requests) + "\n")
 
-			f_tmp_r.close()
-
 		except Exception, ex:
 			logger.exception(ex)
 			return 1 		
@@ -121,6 +143,14 @@ def response_time_handler(name):
 	global php_response_time
 	return php_response_time
 
+def error_rate_handler(name):
+	global php_error_rate
+	return php_error_rate
+
+def histogram_handler(name):
+	global histogram_metrics
+	return histogram_metrics.get(name, 0)
+
 def metric_init(params):
 	global descriptors, php_fpm_log, logtail_interval
 	global logger
@@ -157,7 +187,29 @@ def metric_init(params):
 		'description': 'PHP Response Time',
 		'groups': 'web'}
 
-	descriptors = [d1, d2]
+	d3 = {'name': 'php_error_rate',
+		'call_back': error_rate_handler,
+		'time_max': 90,
+		'value_type': 'float',
+		'units': 'req/s',
+		'slope': 'both',
+		'format': '%f',
+		'description': 'PHP Error Rate',
+		'groups': 'web'}
+
+	descriptors = [d1, d2, d3]
+
+	# percentiles and histogram of the response times
+	for name, units in metric_units('php_response_time'):
+		descriptors.append({'name': name,
+			'call_back': histogram_handler,
+			'time_max': 90,
+			'value_type': 'float',
+			'units': units,
+			'slope': 'both',
+			'format': '%f',
+			'description': 'PHP Response Time ' + name[len('php_response_time') + 1:],
+			'groups': 'web'})
 
 	parser_thread =  PHPLogParser(php_fpm_log, logtail_interval)	
 	parser_thread.start()
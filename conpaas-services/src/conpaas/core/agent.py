@@ -9,8 +9,11 @@
     :copyright: (C) 2010-2013 by Contrail Consortium.
 """
 
+import time
+
 from conpaas.core.expose import expose
 from conpaas.core.log import create_logger
+from conpaas.core import https
 
 from conpaas.core import ipop
 
@@ -66,6 +69,33 @@ class BaseAgent(object):
             return HttpErrorResponse('ERROR: Arguments unexpected')
         return HttpJsonResponse()
 
+def announce(config_parser, manager_port=443, attempts=8):
+    """Tell the manager that this agent is up, so that it does not have
+    to wait for its next check of this node. The manager keeps checking
+    its nodes anyway, failures are only logged.
+
+    Call it once the agent server listens for requests."""
+    logger = create_logger(__name__)
+
+    manager_ip = config_parser.get('agent', 'IP_WHITE_LIST')
+    ips = [ config_parser.get('agent', option)
+            for option in ('MY_IP', 'IPOP_IP_ADDRESS')
+            if config_parser.has_option('agent', option) ]
+
+    delay = 1
+    for _ in range(attempts):
+        try:
+            https.client.check_response(https.client.jsonrpc_post(
+                manager_ip, manager_port, '/', 'agent_up', { 'ips': ips }))
+            logger.info('Told manager %s that agent is up' % manager_ip)
+            return
+        except Exception, err:
+            logger.debug('Could not tell manager that agent is up: %s' % err)
+        time.sleep(delay)
+        delay *= 2
+
+    logger.info('Gave up telling manager %s that agent is up' % manager_ip)
+
 class AgentException(Exception):
 
     E_CONFIG_NOT_EXIST = 0
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""
+    conpaas.core.context
+    ====================
+
+    ConPaaS core: caching the static parts of contextualization files.
+
+    Contextualization files are mostly made of scripts and configuration
+    files read from disk. ContextCache keeps what is built out of them,
+    and builds it again only when one of the files is modified, created
+    or removed. Fields which change for every VM, such as certificates,
+    are filled in by the caller.
+
+    :copyright: (C) 2010-2013 by Contrail Consortium.
+"""
+
+import os
+from threading import Lock
+
+def _file_signature(path):
+    """Return what tells whether path changed, None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+class ContextCache(object):
+    """Values built out of files, rebuilt when the files change"""
+
+    def __init__(self):
+        self.__entries = {}
+        self.__lock = Lock()
+
+    def get(self, key, paths, build):
+        """
+            Return the value cached under key, calling build() to get it
+            the first time or if one of the files changed since then.
+
+            @param key A hashable value identifying what build() returns,
+                       including the parameters it depends on
+
+            @param paths The files read by build(), including optional ones
+                         which do not exist
+
+            @param build A function without arguments returning the value
+        """
+        # Taken before building, so that files modified while building
+        # make the next call build the value again
+        signature = [ _file_signature(path) for path in paths ]
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+
+        value = build()
+
+        with self.__lock:
+            self.__entries[key] = (signature, value)
+        return value
+
+    def clear(self):
+        with self.__lock:
+            self.__entries = {}
+
+# Shared by all the controllers of a process
+context_cache = ContextCache()
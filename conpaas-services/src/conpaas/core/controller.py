@@ -6,13 +6,29 @@
 
     ConPaaS core: start/stop/list nodes.
 
+    New nodes are ready once their agent answers test_agent. Agents tell
+    the manager when they are up (see BaseManager.agent_up), so that
+    they are checked right away. Nodes which have not done so yet are
+    checked in parallel, less and less often as they keep failing.
+
+    With STANDBY_NODES set in the manager section of the configuration,
+    the controller keeps that many booted nodes of each cloud and instance
+    type aside, so that create_nodes does not have to wait for new VMs.
+    Standby nodes are charged like any other node.
+
+    Nodes are charged every hour by a single ReservationScheduler thread,
+    whatever the number of nodes.
+
     :copyright: (C) 2010-2013 by Contrail Consortium.
 """
 
-from threading import Thread, Lock, Event
+from threading import Thread, Lock, Condition
 
 import os.path
 import time
+import posixpath
+import heapq
+import itertools
 import json
 import socket
 import urlparse
@@ -21,6 +37,9 @@ from string import Template
 from conpaas.core.log import create_logger
 from conpaas.core import iaas
 from conpaas.core import https
+from conpaas.core.https import fanout
+from conpaas.core.misc import file_get_contents
+from conpaas.core.context import context_cache
 
 class Controller(object):
     """Implementation of the clouds controller. This class implements functions
@@ -32,6 +51,16 @@ class Controller(object):
          - removing nodes (VMs)
     """
 
+    # Seconds to wait for new nodes before giving up on them
+    WAIT_FOR_NODES_TIMEOUT = 300
+
+    # Seconds between two checks of a node which is not ready: the first
+    # interval is doubled after each failed check, up to the second one
+    CHECK_NODE_INTERVALS = (1, 10)
+
+    # Number of RSA keypairs for agent certificates generated in advance
+    KEY_POOL_SIZE = 4
+
     def __init__(self, config_parser, **kwargs):
         # Params for director callback
         self.__conpaas_creditUrl = config_parser.get('manager',
@@ -74,18 +103,46 @@ class Controller(object):
 
         # For crediting system
         self.__reservation_logger = create_logger('ReservationTimer')
-        self.__reservation_map = {'manager': ReservationTimer(['manager'],
-                                  55 * 60,  # 55mins
-                                  self.__deduct_and_check_credit,
-                                  self.__reservation_logger)}
-        self.__reservation_map['manager'].start()
+        self.__reservations = ReservationScheduler(
+            self.__deduct_and_check_credit, self.__reservation_logger)
+        self.__reservations.add_nodes(['manager'], 55 * 60) # 55mins
+        self.__reservations.start()
         self.__force_terminate_lock = Lock()
 
+        self.__key_pool = https.x509.KeyPool(self.KEY_POOL_SIZE)
+        self.__key_pool.start()
+
+        # Certificates requested together by generate_context, to be used
+        # by _get_certificate
+        self.__certificates = []
+
         self.config_parser = config_parser
         self.__created_nodes = []
         self.__partially_created_nodes = []
         self.__logger = create_logger(__name__)
 
+        # Booted nodes waiting to be used by create_nodes, by (cloud name,
+        # instance type)
+        if config_parser.has_option('manager', 'STANDBY_NODES'):
+            self.__standby_count = config_parser.getint('manager',
+                                                        'STANDBY_NODES')
+        else:
+            self.__standby_count = 0
+        self.__standby_nodes = {}
+        self.__standby_refilling = set()
+        self.__nodes_lock = Lock()
+
+        # Context set by generate_context or update_context, by cloud name,
+        # and the one each standby node was booted with, by node id. Only
+        # standby nodes booted with the current context are used.
+        self.__contexts = {}
+        self.__standby_contexts = {}
+
+        # IP addresses of the agents which announced they are up
+        self.__agents_up = set()
+        self.__agents_up_count = 0
+        self.__agents_up_cond = Condition()
+
         self.__available_clouds = []
         self.__default_cloud = None
         if config_parser.has_option('iaas', 'DRIVER'):
@@ -110,8 +167,11 @@ class Controller(object):
         network = self.__ipop_subnet.iter_hosts()
         
         # Currently running hosts
-        running_hosts = [ str(node.ip) 
-            for node in self.__created_nodes + self.__partially_created_nodes ] 
+        with self.__nodes_lock:
+            running_hosts = [ str(node.ip)
+                for node in self.__created_nodes +
+                            self.__partially_created_nodes +
+                            sum(self.__standby_nodes.values(), []) ]
 
         self.__logger.debug("get_available_ipop_address: running nodes: %s" 
             % running_hosts)
@@ -137,6 +197,11 @@ class Controller(object):
         Creates the VMs associated with the list of nodes. It also tests
         if the agents started correctly.
 
+        Nodes are taken from the standby nodes of the given cloud and
+        instance type first, if any, and the standby nodes are created
+        again in the background (see STANDBY_NODES). Standby nodes are
+        only used if they were booted with the current context.
+
         @param count The number of nodes to be created
 
         @param test_agent A callback function to test if the agent
@@ -152,12 +217,40 @@ class Controller(object):
         @return A list of nodes of type node.ServiceNode
 
         """
+        if cloud is None:
+            cloud = self.__default_cloud
+
+        standby_key = (cloud.cloud_name, inst_type)
+        ready = self.__claim_standby_nodes(standby_key, count,
+                                           test_agent, port)
+        try:
+            if len(ready) < count:
+                ready += self.__create_nodes(count - len(ready), test_agent,
+                                             port, cloud, inst_type)
+        except Exception:
+            # Nodes claimed from the standby ones are still fine
+            with self.__nodes_lock:
+                self.__standby_nodes.setdefault(standby_key, [])[:0] = ready
+            raise
+
+        with self.__nodes_lock:
+            self.__created_nodes += ready
+
+        self.__refill_standby_nodes(standby_key, test_agent, port,
+                                    cloud, inst_type)
+        return ready
+
+    def __create_nodes(self, count, test_agent, port, cloud, inst_type,
+                       standby_key=None):
+        """Create count nodes and charge them. They are added to the
+        standby nodes of standby_key if given, otherwise the caller adds
+        them to the created nodes."""
         ready = []
-        poll = []
         iteration = 0
 
-        if cloud is None:
-            cloud = self.__default_cloud
+        # Taken before the nodes are requested: if it changes meanwhile,
+        # they do not become standby nodes
+        context = self.__contexts.get(cloud.cloud_name)
 
         if not self.deduct_credit(count):
             raise Exception('Could not add nodes. Not enough credits.')
@@ -172,6 +265,7 @@ class Controller(object):
 
             self.__logger.debug(msg)
 
+            new_nodes = []
             try:
                 self.__force_terminate_lock.acquire()
                 if iteration == 1:
@@ -188,7 +282,8 @@ class Controller(object):
                     # contextualization data for each new instance
                     for _ in range(count - len(ready)):
                         vpn_ip = self.get_available_ipop_address()
-                        self.update_context({ 'IPOP_IP_ADDRESS': vpn_ip }, cloud)
+                        self.__substitute_context(
+                            { 'IPOP_IP_ADDRESS': vpn_ip }, cloud)
                         
                         for newinst in cloud.new_instances(1, name, inst_type):
                             # Set VPN IP
@@ -198,50 +293,178 @@ class Controller(object):
                                 # If private_ip is not set yet, use vpn_ip
                                 newinst.private_ip = vpn_ip
 
-                            self.__partially_created_nodes.append(newinst)
+                            with self.__nodes_lock:
+                                new_nodes.append(newinst)
+                                self.__partially_created_nodes.append(newinst)
 
-                        self.__logger.debug("cloud.new_instances: %s" % poll)
+                        self.__logger.debug("cloud.new_instances: %s"
+                                            % new_nodes)
                 else:
-                    self.__partially_created_nodes = cloud.new_instances(
+                    new_nodes = cloud.new_instances(
                         count - len(ready), name, inst_type)
+                    with self.__nodes_lock:
+                        self.__partially_created_nodes += new_nodes
 
             except Exception as e:
                 self.__logger.exception(
                     '[_create_nodes]: Failed to request new nodes')
-                self.delete_nodes(ready)
-                self.__partially_created_nodes = []
+                self.__forget_partially_created_nodes(ready + new_nodes)
+                self.delete_nodes(ready + new_nodes)
                 raise e
             finally:
                 self.__force_terminate_lock.release()
 
-            poll, failed = self.__wait_for_nodes(
-                self.__partially_created_nodes, test_agent, port)
+            poll, failed = self.__wait_for_nodes(new_nodes, test_agent, port)
             ready += poll
 
-            poll = []
             if failed:
                 self.__logger.debug('[_create_nodes]: %d nodes '
                                     'failed to startup properly: %s'
                                     % (len(failed), str(failed)))
-                self.__partially_created_nodes = []
+                self.__forget_partially_created_nodes(failed)
                 self.delete_nodes(failed)
+
+        stale = []
         self.__force_terminate_lock.acquire()
-        self.__created_nodes += ready
-        self.__partially_created_nodes = []
+        self.__forget_partially_created_nodes(ready)
+        if standby_key is not None:
+            with self.__nodes_lock:
+                if self.__contexts.get(cloud.cloud_name) == context:
+                    self.__standby_nodes.setdefault(standby_key,
+                                                    []).extend(ready)
+                    for node in ready:
+                        self.__standby_contexts[node.id] = context
+                else:
+                    stale = ready
         self.__force_terminate_lock.release()
 
-        # start reservation timer with slack of 3 mins + time already wasted
+        # charge them again with slack of 3 mins + time already wasted
         # this should be enough time to terminate instances before
         # hitting the following hour
-        timer = ReservationTimer([i.id for i in ready],
-                                 (55 * 60) - (time.time() - request_start),
-                                 self.__deduct_and_check_credit,
-                                 self.__reservation_logger)
-        timer.start()
-        # set mappings
-        for i in ready:
-            self.__reservation_map[i.id] = timer
-        return ready
+        self.__reservations.add_nodes([i.id for i in ready],
+            (55 * 60) - (time.time() - request_start))
+
+        if stale:
+            self.__logger.debug('[create_nodes]: the context changed while '
+                                'creating standby nodes %s' % stale)
+            self.delete_nodes(stale)
+        return [ node for node in ready if node not in stale ]
+
+    def __forget_partially_created_nodes(self, nodes):
+        with self.__nodes_lock:
+            self.__partially_created_nodes = [ node
+                for node in self.__partially_created_nodes
+                if node not in nodes ]
+
+    def __claim_standby_nodes(self, standby_key, count, test_agent, port):
+        """Take up to count standby nodes whose agent still answers"""
+        with self.__nodes_lock:
+            standby = self.__standby_nodes.get(standby_key, [])
+            claimed = standby[:count]
+            del standby[:count]
+
+            context = self.__contexts.get(standby_key[0])
+            stale = [ node for node in claimed
+                      if self.__standby_contexts.pop(node.id, None) != context ]
+
+        if stale:
+            self.__logger.debug('[create_nodes]: standby nodes %s were booted '
+                                'with another context' % stale)
+            self.delete_nodes(stale)
+            claimed = [ node for node in claimed if node not in stale ]
+
+        if not claimed:
+            return []
+
+        outcome = fanout.call_nodes(
+            lambda node: self.__check_node(node, test_agent, port), claimed)
+        lost = [ node for node, ready in zip(claimed, outcome.results)
+                 if not ready ]
+        if lost:
+            self.__logger.debug('[create_nodes]: standby nodes %s do not '
+                                'answer anymore' % lost)
+            self.delete_nodes(lost)
+
+        self.__logger.debug('[create_nodes]: using %d standby nodes'
+                            % (len(claimed) - len(lost)))
+        return [ node for node in claimed if node not in lost ]
+
+    def __refill_standby_nodes(self, standby_key, test_agent, port,
+                               cloud, inst_type):
+        """Create the missing standby nodes of standby_key in the
+        background"""
+        with self.__nodes_lock:
+            if self.__standby_count <= 0 or \
+                    standby_key in self.__standby_refilling:
+                return
+            self.__standby_refilling.add(standby_key)
+
+        def refill():
+            try:
+                while True:
+                    with self.__nodes_lock:
+                        missing = self.__standby_count - len(
+                            self.__standby_nodes.get(standby_key, []))
+                        if missing <= 0 or not self.__created_nodes:
+                            break
+
+                    self.__logger.debug('[create_nodes]: creating %d standby '
+                                        'nodes' % missing)
+                    self.__create_nodes(missing, test_agent, port, cloud,
+                                        inst_type, standby_key)
+
+                    # The service may have been stopped meanwhile
+                    with self.__nodes_lock:
+                        stopped = not self.__created_nodes
+                    if stopped:
+                        self.delete_standby_nodes()
+                        break
+            except Exception:
+                self.__logger.exception('[create_nodes]: Failed to create '
+                                        'standby nodes')
+            finally:
+                with self.__nodes_lock:
+                    self.__standby_refilling.discard(standby_key)
+
+        thread = Thread(target=refill)
+        thread.daemon = True
+        thread.start()
+
+    def get_standby_nodes(self):
+        """Return the list of standby nodes of all the clouds and instance
+        types"""
+        with self.__nodes_lock:
+            return sum(self.__standby_nodes.values(), [])
+
+    def delete_standby_nodes(self):
+        """Kill the standby nodes. They are created again by the next call
+        to create_nodes."""
+        with self.__nodes_lock:
+            standby = sum(self.__standby_nodes.values(), [])
+            self.__standby_nodes = {}
+            self.__standby_contexts = {}
+        self.delete_nodes(standby)
+
+    def __set_context(self, cloud, context):
+        """Record the context of cloud. When it changes, its standby nodes
+        are killed: they are created again with the new one by the next
+        call to create_nodes."""
+        with self.__nodes_lock:
+            if self.__contexts.get(cloud.cloud_name) == context:
+                return
+            self.__contexts[cloud.cloud_name] = context
+
+            stale = []
+            for standby_key in self.__standby_nodes.keys():
+                if standby_key[0] == cloud.cloud_name:
+                    stale += self.__standby_nodes.pop(standby_key)
+            for node in stale:
+                self.__standby_contexts.pop(node.id, None)
+
+        if stale:
+            self.__logger.debug('[set_context]: killing standby nodes %s '
+                                'booted with the previous context' % stale)
+            self.delete_nodes(stale)
 
     #=========================================================================#
     #                    delete_nodes(self, nodes)                            #
@@ -249,6 +472,9 @@ class Controller(object):
     def delete_nodes(self, nodes):
         """Kills the VMs associated with the list of nodes.
 
+            Deleting the last created node of the service deletes the
+            standby nodes as well.
+
             @param nodes The list of nodes to be removed;
                             - a node must be of type ServiceNode
                               or a class that extends ServiceNode
@@ -257,16 +483,21 @@ class Controller(object):
             cloud = self.get_cloud_by_name(node.cloud_name)
             self.__logger.debug('[delete_nodes]: killing ' + str(node.id))
             try:
-            # node may not be in map if it failed to start
-                if node.id in self.__reservation_map:
-                    timer = self.__reservation_map.pop(node.id)
-                    if timer.remove_node(node.id) < 1:
-                        timer.stop()
+            # node may not be charged if it failed to start
+                self.__reservations.remove_node(node.id)
                 cloud.kill_instance(node)
             except:
                 self.__logger.exception('[delete_nodes]: '
                                         'Failed to kill node %s', node.id)
 
+        with self.__nodes_lock:
+            created = len(self.__created_nodes)
+            self.__created_nodes = [ node for node in self.__created_nodes
+                                     if node not in nodes ]
+            stopped = created and not self.__created_nodes
+        if stopped:
+            self.delete_standby_nodes()
+
     #=========================================================================#
     #                    list_vms(self, cloud=None)                           #
     #=========================================================================#
@@ -299,10 +530,22 @@ class Controller(object):
             contxt = self._get_context_file(service_name,
                                             cloud.get_cloud_type())
             cloud.set_context_template(contxt)
+            self.__set_context(cloud, contxt)
 
         if cloud is None:
-            for cloud in self.__available_clouds:
-                __set_cloud_ctx(cloud)
+            if len(self.__available_clouds) > 1:
+                # Sign the certificates of all the clouds at once
+                try:
+                    self.__certificates = self._get_certificates(
+                        len(self.__available_clouds))
+                except Exception:
+                    self.__logger.exception('[generate_context]: failed to '
+                                            'get certificates at once')
+            try:
+                for cloud in self.__available_clouds:
+                    __set_cloud_ctx(cloud)
+            finally:
+                self.__certificates = []
         else:
             __set_cloud_ctx(cloud)
 
@@ -328,9 +571,15 @@ class Controller(object):
         if cloud is None:
             cloud = self.__default_cloud
 
+        self.__set_context(cloud, self.__substitute_context(replace, cloud))
+
+    def __substitute_context(self, replace, cloud):
+        """Set the context of cloud to its template, with the values of
+        replace substituted. Return it."""
         contxt = cloud.get_context_template()
         contxt = Template(contxt).safe_substitute(replace)
         cloud.config(context=contxt)
+        return contxt
 
     #=========================================================================#
     #               get_clouds(self)                                          #
@@ -401,50 +650,105 @@ class Controller(object):
 
         return False
 
-    def __wait_for_nodes(self, nodes, test_agent, port, poll_interval=10):
+    def agent_up(self, ips):
+        """Called when an agent announces that it is up. ips holds the
+        addresses of its node."""
+        with self.__agents_up_cond:
+            self.__agents_up.update([ ip for ip in ips if ip ])
+            self.__agents_up_count += 1
+            self.__agents_up_cond.notify_all()
+
+    def __announced(self, node):
+        """Return True if the agent of node announced it is up. The caller
+        must hold __agents_up_cond."""
+        return node.ip in self.__agents_up or \
+            node.private_ip in self.__agents_up
+
+    def __refresh_nodes(self, nodes):
+        """Update the addresses of nodes, listing the VMs of each of their
+        clouds once"""
+        for cloud_name in set([ node.cloud_name for node in nodes ]):
+            try:
+                vms = self.list_vms(self.get_cloud_by_name(cloud_name))
+            except Exception:
+                self.__logger.exception('[__wait_for_nodes]: failed to list '
+                                        'the VMs of cloud %s' % cloud_name)
+                continue
+
+            refreshed = dict([ (vm.id, vm) for vm in vms ])
+            for node in nodes:
+                if node.cloud_name == cloud_name and node.id in refreshed:
+                    node.ip = refreshed[node.id].ip
+                    node.private_ip = refreshed[node.id].private_ip
+
+    def __wait_for_nodes(self, nodes, test_agent, port):
         self.__logger.debug('[__wait_for_nodes]: going to start polling')
 
         done = []
-        poll_cycles = 0
-
-        while len(nodes) > 0:
-            poll_cycles += 1
-
-            # Add to 'done' the nodes on which an agent has been started
-            # properly.
-            done.extend([ node for node in nodes 
-                if self.__check_node(node, test_agent, port) ])
+        deadline = time.time() + self.WAIT_FOR_NODES_TIMEOUT
+        min_interval, max_interval = self.CHECK_NODE_INTERVALS
+
+        # Time of the next check of each node, and interval before the
+        # following one, by position in nodes
+        next_check = [ time.time() ] * len(nodes)
+        interval = [ min_interval ] * len(nodes)
+
+        agents_up_count = None
+        while True:
+            with self.__agents_up_cond:
+                new_agents_up = agents_up_count != self.__agents_up_count
+                agents_up_count = self.__agents_up_count
+
+            # Nodes may not have an IP address yet. Look for it when they
+            # are due for a check, or as soon as an agent announces itself
+            # as it may be running on one of them.
+            now = time.time()
+            self.__refresh_nodes([ node for i, node in enumerate(nodes)
+                                   if (node.ip == '' or node.private_ip == '')
+                                   and (new_agents_up or next_check[i] <= now) ])
+
+            with self.__agents_up_cond:
+                due = [ i for i, node in enumerate(nodes)
+                        if next_check[i] <= now or self.__announced(node) ]
+                for i in due:
+                    self.__agents_up.discard(nodes[i].ip)
+                    self.__agents_up.discard(nodes[i].private_ip)
+
+            outcome = fanout.call_nodes(
+                lambda node: self.__check_node(node, test_agent, port),
+                [ nodes[i] for i in due ])
+            for node, exc_info in outcome.errors:
+                self.__logger.debug('[__wait_for_nodes]: %s: %s'
+                                    % (node, exc_info[1]))
+
+            for i, ready in zip(due, outcome.results):
+                if ready:
+                    done.append(nodes[i])
+                else:
+                    next_check[i] = time.time() + interval[i]
+                    interval[i] = min(interval[i] * 2, max_interval)
 
-            # Put in 'nodes' only those who have not started yet.
-            nodes = [ node for node in nodes if node not in done ]
+            remaining = [ i for i, node in enumerate(nodes)
+                          if node not in done ]
+            nodes = [ nodes[i] for i in remaining ]
+            next_check = [ next_check[i] for i in remaining ]
+            interval = [ interval[i] for i in remaining ]
 
             if len(nodes) == 0:
                 # All the nodes are ready.
                 break
-            elif poll_cycles * poll_interval > 300:
-                # We have waited for more than 5 mins of sleeping + poll time.
+            elif time.time() > deadline:
+                # We have waited for more than 5 mins.
                 # Let's return whatever we have.
                 return (done, nodes)
 
-            self.__logger.debug('[__wait_for_nodes]: waiting %d secs for %d nodes'
-                                % (poll_interval, len(nodes)))
-            time.sleep(poll_interval)
-
-            # Check if some nodes still do not have an IP address.
-            no_ip_nodes = [ node for node in nodes
-                           if node.ip == '' or node.private_ip == '' ]
-            if no_ip_nodes:
-                self.__logger.debug('[__wait_for_nodes]: refreshing %d nodes'
-                                    % len(no_ip_nodes))
-
-                for node in no_ip_nodes:
-                    refreshed_list = self.list_vms(
-                        self.get_cloud_by_name(node.cloud_name))
-
-                    for refreshed_node in refreshed_list:
-                        if refreshed_node.id == node.id:
-                            node.ip = refreshed_node.ip
-                            node.private_ip = refreshed_node.private_ip
+            # Wait for the next check, or for an agent to announce itself
+            timeout = min(min(next_check), deadline) - time.time()
+            self.__logger.debug('[__wait_for_nodes]: waiting up to %.1f secs '
+                                'for %d nodes' % (max(timeout, 0), len(nodes)))
+            with self.__agents_up_cond:
+                if timeout > 0 and agents_up_count == self.__agents_up_count:
+                    self.__agents_up_cond.wait(timeout)
 
         self.__logger.debug('[__wait_for_nodes]: All nodes are ready %s'
                             % str(done))
@@ -456,6 +760,8 @@ class Controller(object):
         it's installing all the necessary dependencies for the service
         on the cloud you are installing
 
+        Only the certificates are generated for each call, the rest is
+        read from disk again only when the files change.
         '''
         conpaas_home = self.config_parser.get('manager', 'CONPAAS_HOME')
         cloud_scripts_dir = conpaas_home + '/scripts/cloud'
@@ -465,19 +771,56 @@ class Controller(object):
         bootstrap = self.config_parser.get('manager', 'BOOTSTRAP')
         manager_ip = self.config_parser.get('manager', 'MY_IP')
 
+        paths = [ cloud_scripts_dir + '/' + cloud_type,
+                  agent_scripts_dir + '/agent-setup',
+                  agent_cfg_dir + '/default-agent.cfg',
+                  agent_cfg_dir + '/' + service_name + '-agent.cfg',
+                  agent_scripts_dir + '/' + service_name + '-agent-start',
+                  agent_scripts_dir + '/default-agent-start',
+                  os.path.join(conpaas_home, 'startup.sh') ]
+
+        key = ('agent', service_name, cloud_type, conpaas_home, bootstrap,
+               manager_ip, self.__conpaas_user_id, self.__conpaas_service_id,
+               self.__conpaas_app_id, self.__ipop_base_namespace,
+               self.__ipop_base_ip, self.__ipop_netmask)
+
+        head, tail = context_cache.get(key, paths,
+            lambda: self.__get_context_parts(service_name, cloud_type,
+                                             *paths))
+
+        # Get key and a certificate from CA
+        agent_certs = self._get_certificate()
+
+        # Concatenate the files
+        return (head
+                + 'cat <<EOF > /tmp/cert.pem\n'
+                + agent_certs['cert'] + '\n' + 'EOF\n\n'
+                + 'cat <<EOF > /tmp/key.pem\n'
+                + agent_certs['key'] + '\n' + 'EOF\n\n'
+                + 'cat <<EOF > /tmp/ca_cert.pem\n'
+                + agent_certs['ca_cert'] + '\n' + 'EOF\n\n'
+                + tail)
+
+    def __get_context_parts(self, service_name, cloud_type, cloud_script_path,
+                            agent_setup_path, default_agent_cfg_path,
+                            agent_cfg_path, agent_start_path,
+                            default_agent_start_path, startup_script):
+        """Return the parts of the context file preceding and following the
+        certificates"""
+        bootstrap = self.config_parser.get('manager', 'BOOTSTRAP')
+        manager_ip = self.config_parser.get('manager', 'MY_IP')
+
         # Get contextualization script for the corresponding cloud
-        cloud_script_file = open(cloud_scripts_dir + '/' + cloud_type, 'r')
-        cloud_script = cloud_script_file.read()
+        cloud_script = file_get_contents(cloud_script_path)
 
         # Get agent setup file
-        agent_setup_file = open(agent_scripts_dir + '/agent-setup', 'r')
-        agent_setup = Template(agent_setup_file.read()).safe_substitute(
-            SOURCE=bootstrap)
+        agent_setup = Template(file_get_contents(
+            agent_setup_path)).safe_substitute(SOURCE=bootstrap)
 
         # Get agent config file - add to the default one the one specific
         # to the service if it exists
-        default_agent_cfg_file = open(agent_cfg_dir + '/default-agent.cfg')
-        agent_cfg = Template(default_agent_cfg_file.read()).safe_substitute(
+        agent_cfg = Template(file_get_contents(
+            default_agent_cfg_path)).safe_substitute(
             AGENT_TYPE=service_name,
             MANAGER_IP=manager_ip,
             CONPAAS_USER_ID=self.__conpaas_user_id,
@@ -491,56 +834,81 @@ class Controller(object):
             agent_cfg += '\nIPOP_NETMASK = %s' % self.__ipop_netmask
             agent_cfg += '\nIPOP_IP_ADDRESS = $IPOP_IP_ADDRESS'
 
-        if os.path.isfile(agent_cfg_dir + '/' + service_name + '-agent.cfg'):
-            agent_cfg_file = open(agent_cfg_dir +
-                                  '/' + service_name + '-agent.cfg')
-            agent_cfg += '\n' + agent_cfg_file.read()
+        if os.path.isfile(agent_cfg_path):
+            agent_cfg += '\n' + file_get_contents(agent_cfg_path)
 
         # Get agent start file - if none for this service, use the default one
-        if os.path.isfile(agent_scripts_dir +
-                          '/' + service_name + '-agent-start'):
-            agent_start_file = open(agent_scripts_dir +
-                                    '/' + service_name + '-agent-start')
+        if os.path.isfile(agent_start_path):
+            agent_start = file_get_contents(agent_start_path)
         else:
-            agent_start_file = open(agent_scripts_dir + '/default-agent-start')
-        agent_start = agent_start_file.read()
+            agent_start = file_get_contents(default_agent_start_path)
 
-        # Get key and a certificate from CA
-        agent_certs = self._get_certificate()
-
-        # Concatenate the files
-        context_file = (cloud_script + '\n\n'
-                        + 'cat <<EOF > /tmp/cert.pem\n'
-                        + agent_certs['cert'] + '\n' + 'EOF\n\n'
-                        + 'cat <<EOF > /tmp/key.pem\n'
-                        + agent_certs['key'] + '\n' + 'EOF\n\n'
-                        + 'cat <<EOF > /tmp/ca_cert.pem\n'
-                        + agent_certs['ca_cert'] + '\n' + 'EOF\n\n'
-                        + agent_setup + '\n\n'
-                        + 'cat <<EOF > $ROOT_DIR/config.cfg\n'
-                        + agent_cfg + '\n' + 'EOF\n\n')
-
-        # Get user-provided startup script's absolute path
-        basedir = self.config_parser.get('manager', 'CONPAAS_HOME')
-        startup_script = os.path.join(basedir, 'startup.sh')
+        tail = (agent_setup + '\n\n'
+                + 'cat <<EOF > $ROOT_DIR/config.cfg\n'
+                + agent_cfg + '\n' + 'EOF\n\n')
 
         # Append user-provided startup script (if any)
         if os.path.isfile(startup_script):
-            context_file += open(startup_script).read() + '\n'
+            tail += file_get_contents(startup_script) + '\n'
 
         # Finally, the agent startup script
-        context_file += agent_start + '\n'
+        tail += agent_start + '\n'
 
-        return context_file
+        return (cloud_script + '\n\n', tail)
 
     def _get_certificate(self):
         '''
         Requests a certificate from the CA
         '''
+        if self.__certificates:
+            return self.__certificates.pop(0)
+
         parsed_url = urlparse.urlparse(self.__conpaas_caUrl)
 
-        req_key = https.x509.gen_rsa_keypair()
+        req_key = self.__key_pool.get()[0]
+        x509_req_as_pem = self.__create_x509_req(req_key)
+        _, cert = https.client.https_post(parsed_url.hostname,
+                                          parsed_url.port or 443,
+                                          parsed_url.path,
+                                          files=[('csr', 'csr.pem',
+                                                  x509_req_as_pem)])
+
+        certs = {'ca_cert': self.__get_ca_cert(),
+                 'key': https.x509.key_as_pem(req_key),
+                 'cert': cert}
+
+        return certs
+
+    def _get_certificates(self, count):
+        '''
+        Requests count certificates from the CA in a single request
+        '''
+        parsed_url = urlparse.urlparse(self.__conpaas_caUrl)
 
+        # The CA signs many requests at once next to the single request
+        # URL, eg. /ca/get_certs.php next to /ca/get_cert.php
+        path = parsed_url.path
+        if posixpath.basename(path) == 'get_cert.php':
+            path = posixpath.dirname(path)
+        path = posixpath.join(path or '/', 'get_certs.php')
+
+        req_keys = self.__key_pool.get(count)
+        files = [ ('csr', 'csr%d.pem' % i, self.__create_x509_req(req_key))
+                  for i, req_key in enumerate(req_keys) ]
+        _, body = https.client.https_post(parsed_url.hostname,
+                                          parsed_url.port or 443,
+                                          path, files=files)
+        obj = json.loads(body)
+        if obj['error']:
+            raise Exception('Could not get certificates: %s' % obj['msg'])
+
+        ca_cert = self.__get_ca_cert()
+        return [ {'ca_cert': ca_cert,
+                  'key': https.x509.key_as_pem(req_key),
+                  'cert': cert}
+                 for req_key, cert in zip(req_keys, obj['certs']) ]
+
+    def __create_x509_req(self, req_key):
         x509_req = https.x509.create_x509_req(
             req_key,
             userId=self.__conpaas_user_id,
@@ -550,22 +918,13 @@ class Controller(object):
             CN='ConPaaS',
             role='agent'
         )
+        return https.x509.x509_req_as_pem(x509_req)
 
-        x509_req_as_pem = https.x509.x509_req_as_pem(x509_req)
-        _, cert = https.client.https_post(parsed_url.hostname,
-                                          parsed_url.port or 443,
-                                          parsed_url.path,
-                                          files=[('csr', 'csr.pem',
-                                                  x509_req_as_pem)])
+    def __get_ca_cert(self):
         cert_dir = self.config_parser.get('manager', 'CERT_DIR')
-        ca_cert_file = open(os.path.join(cert_dir, 'ca_cert.pem'), 'r')
-        ca_cert = ca_cert_file.read()
-
-        certs = {'ca_cert': ca_cert,
-                 'key': https.x509.key_as_pem(req_key),
-                 'cert': cert}
-
-        return certs
+        ca_cert_path = os.path.join(cert_dir, 'ca_cert.pem')
+        return context_cache.get(('ca_cert', ca_cert_path), [ca_cert_path],
+                                 lambda: file_get_contents(ca_cert_path))
 
     def __force_terminate_service(self):
         # DO NOT release lock after acquiring it
@@ -574,10 +933,13 @@ class Controller(object):
         self.__logger.debug('OUT OF CREDIT, TERMINATING SERVICE')
 
         # kill all partially created nodes
-        self.delete_nodes(self.__partially_created_nodes)
+        self.delete_nodes(list(self.__partially_created_nodes))
+
+        # kill all standby nodes
+        self.delete_standby_nodes()
 
         # kill all created nodes
-        self.delete_nodes(self.__created_nodes)
+        self.delete_nodes(list(self.__created_nodes))
 
         # notify front-end, attempt 10 times until successful
         for _ in range(10):
@@ -613,39 +975,112 @@ class Controller(object):
             self.__force_terminate_service()
 
 
-class ReservationTimer(Thread):
-    def __init__(self, nodes, delay, callback,
-                 reservation_logger, interval=3600):
+class ReservationScheduler(Thread):
+    """Charge the user for the nodes of a service, once per interval for
+    each node.
+
+    A single thread waits for the next charge, using a heap of (time,
+    node) entries. Nodes due for a charge within MERGE_WINDOW seconds of
+    each other are charged together, with a single call to callback.
+    """
+
+    # Seconds within which charges are merged into one
+    MERGE_WINDOW = 60
 
+    def __init__(self, callback, reservation_logger, interval=3600):
         Thread.__init__(self)
-        self.nodes = nodes
-        self.event = Event()
-        self.delay = delay
-        self.interval = interval
+        self.daemon = True
         self.callback = callback
-        self.lock = Lock()
+        self.interval = interval
         self.reservation_logger = reservation_logger
-        self.reservation_logger.debug('RTIMER Creating timer for %s'
-                                      % (str(self.nodes)))
+
+        # Heap of [time, sequence number, node id] entries. Cancelled
+        # entries have their node id set to None and are dropped when they
+        # reach the top of the heap.
+        self.heap = []
+        self.entries = {}
+        self.sequence = itertools.count()
+        self.cond = Condition()
+        self.stopped = False
+
+    def add_nodes(self, node_ids, delay):
+        """Charge node_ids in delay seconds, then every interval"""
+        charge_time = time.time() + delay
+        with self.cond:
+            for node_id in node_ids:
+                self.__cancel(node_id)
+                entry = [charge_time, self.sequence.next(), node_id]
+                self.entries[node_id] = entry
+                heapq.heappush(self.heap, entry)
+            self.cond.notify()
+        self.reservation_logger.debug('RTIMER scheduled %s in %d seconds'
+                                      % (str(node_ids), delay))
 
     def remove_node(self, node_id):
-        with self.lock:
-            self.nodes.remove(node_id)
+        """Stop charging node_id. Return the number of nodes still charged."""
+        with self.cond:
+            self.__cancel(node_id)
             self.reservation_logger.debug('RTIMER removed node %s, '
                                           'updated list %s'
-                                          % (node_id, str(self.nodes)))
-        return len(self.nodes)
+                                          % (node_id, str(self.entries.keys())))
+            return len(self.entries)
+
+    def get_nodes(self):
+        """Return the ids of the nodes being charged"""
+        with self.cond:
+            return self.entries.keys()
+
+    def __cancel(self, node_id):
+        entry = self.entries.pop(node_id, None)
+        if entry is not None:
+            entry[2] = None
+
+    def __pop_due(self, now):
+        """Pop the entries due within MERGE_WINDOW and schedule their next
+        charge. Return their node ids."""
+        due = []
+        while self.heap and self.heap[0][0] <= now + self.MERGE_WINDOW:
+            charge_time, _, node_id = heapq.heappop(self.heap)
+            if node_id is None:
+                continue
+            due.append(node_id)
+            entry = [charge_time + self.interval, self.sequence.next(),
+                     node_id]
+            self.entries[node_id] = entry
+            heapq.heappush(self.heap, entry)
+        return due
 
     def run(self):
-        self.event.wait(self.delay)
-        while not self.event.is_set():
-            with self.lock:
-                list_size = len(self.nodes)
-                self.reservation_logger.debug('RTIMER charging user credit '
-                                              'for hour of %d instances %s'
-                                              % (list_size, str(self.nodes)))
-            Thread(target=self.callback, args=[list_size]).start()
-            self.event.wait(self.interval)
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    # Drop cancelled entries so that they do not wake us up
+                    while self.heap and self.heap[0][2] is None:
+                        heapq.heappop(self.heap)
+
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    elif self.heap:
+                        self.cond.wait(self.heap[0][0] - now)
+                    else:
+                        self.cond.wait()
+
+                if self.stopped:
+                    return
+
+                due = self.__pop_due(now)
+
+            self.reservation_logger.debug('RTIMER charging user credit '
+                                          'for hour of %d instances %s'
+                                          % (len(due), str(due)))
+            try:
+                self.callback(len(due))
+            except Exception:
+                self.reservation_logger.exception('RTIMER failed to charge '
+                                                  'user credit')
 
     def stop(self):
-        self.event.set()
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
@@ -10,13 +10,66 @@
 """
 
 import os
+import socket
 
 from shutil import copyfile, copy
+from xml.etree import cElementTree as ElementTree
 
 from Cheetah.Template import Template
 
 from conpaas.core.misc import run_cmd
 
+# Port on which gmond shares the state of the cluster, as XML
+GMOND_PORT = 8649
+
+# Metrics not reported for this many times their reporting interval are
+# considered gone
+STALE_FACTOR = 4
+
+def parse_gmond_xml(xml):
+    """Return the numeric metrics of the hosts in a gmond XML dump.
+
+    @param xml The XML document written by gmond
+
+    @return A dictionary of {metric name: value} dictionaries, indexed by
+            host IP
+    """
+    hosts = {}
+    for host in ElementTree.fromstring(xml).getiterator('HOST'):
+        metrics = {}
+        for metric in host.getiterator('METRIC'):
+            if metric.get('TYPE') == 'string':
+                continue
+
+            try:
+                if float(metric.get('TN')) > STALE_FACTOR * float(metric.get('TMAX')):
+                    continue
+                metrics[metric.get('NAME')] = float(metric.get('VAL'))
+            except (TypeError, ValueError):
+                pass
+
+        hosts[host.get('IP')] = metrics
+    return hosts
+
+def read_gmond_metrics(host='127.0.0.1', port=GMOND_PORT, timeout=10):
+    """Read the metrics of all hosts known to a gmond. The gmond of a
+    manager receives the metrics of all its agents.
+
+    @return The metrics as returned by parse_gmond_xml
+    """
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+
+    return parse_gmond_xml(''.join(chunks))
+
 class BaseGanglia(object):
     """Basic Ganglia configuration and startup. Valid for both managers and
     agents. Not to be used directly!"""
@@ -26,6 +79,12 @@ class BaseGanglia(object):
     GMOND_CONF    = os.path.join(GANGLIA_ETC, 'gmond.conf')
     GANGLIA_MODULES_DIR = '/usr/lib/ganglia/python_modules/'
 
+    # Helpers imported by the modules, installed along with them
+    SHARED_MODULES = ('log_tailer',)
+
+    # Modules of the conpaas package imported by the modules
+    SHARED_CORE_MODULES = ('histogram',)
+
     def __init__(self):
         """Set basic values"""
         self.cluster_name = 'conpaas'
@@ -75,6 +134,16 @@ class BaseGanglia(object):
                 'ganglia_modules', module + '.py') 
             copy(filename, self.GANGLIA_MODULES_DIR)
 
+        for module in self.SHARED_MODULES:
+            filename = os.path.join(self.cps_home, 'contrib',
+                'ganglia_modules', module + '.py')
+            copy(filename, self.GANGLIA_MODULES_DIR)
+
+        for module in self.SHARED_CORE_MODULES:
+            filename = os.path.join(self.cps_home, 'src', 'conpaas', 'core',
+                module + '.py')
+            copy(filename, self.GANGLIA_MODULES_DIR)
+
         # Restart ganglia-monitor
         run_cmd('/etc/init.d/ganglia-monitor restart')
 
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+    conpaas.core.histogram
+    ======================
+
+    ConPaaS core: mergeable histograms of response times.
+
+    The Ganglia modules of the agents count the response times of the
+    requests of each interval in logarithmic buckets, and publish the
+    percentiles as well as the buckets. Adding up the buckets of several
+    nodes gives the percentiles of the whole service.
+
+    Each bucket is a Ganglia metric of its own, the state of a histogram
+    being too large for a string metric. The pyconf files of the modules
+    put the buckets in a collection group whose time_threshold is its
+    collect_every: they are all sent after each collection, so that the
+    buckets read together come from the same interval.
+
+    A histogram thus costs BUCKETS + 5 metrics, and as many RRD files on
+    gmetad, on each node publishing it. Web and PHP nodes publish one,
+    proxy nodes two: the web and PHP response times of the load balancer.
+
+    This module is also installed along with the Ganglia modules, so it
+    only depends on the standard library.
+
+    :copyright: (C) 2010-2013 by Contrail Consortium.
+"""
+
+import math
+
+# Buckets per doubling of the response time: a value is known within 9%
+BUCKETS_PER_OCTAVE = 4
+
+# Upper bound in ms of the first bucket
+MIN_VALUE = 1.0
+
+# Number of buckets. The last one holds everything above 55 seconds.
+BUCKETS = 64
+
+PERCENTILES = (50, 90, 95, 99)
+
+def upper_bound(index):
+    """Return the largest value in ms counted in bucket index"""
+    if index >= BUCKETS - 1:
+        return float('inf')
+    return MIN_VALUE * 2 ** (float(index) / BUCKETS_PER_OCTAVE)
+
+def bucket(value):
+    """Return the index of the bucket counting value, in ms"""
+    if value <= MIN_VALUE:
+        return 0
+    index = int(math.ceil(math.log(value / MIN_VALUE, 2) * BUCKETS_PER_OCTAVE))
+    # log() may round a bound up to the next bucket
+    if index > 0 and value <= upper_bound(index - 1):
+        index -= 1
+    return min(index, BUCKETS - 1)
+
+class LatencyHistogram(object):
+    """Counts of response times, in BUCKETS logarithmic buckets"""
+
+    def __init__(self):
+        self.counts = [ 0 ] * BUCKETS
+        self.max = 0
+
+    def add(self, value, count=1):
+        self.counts[bucket(value)] += count
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add the counts of another LatencyHistogram to this one"""
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.max = max(self.max, other.max)
+
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, percentile):
+        """Return the given percentile of the values, as the upper bound of
+        its bucket, or 0 without values. It is never above the maximum."""
+        threshold = self.total() * percentile / 100.0
+        if not threshold:
+            return 0
+
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return min(upper_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Return the percentiles of PERCENTILES, as 'pNN', and the 'max'"""
+        summary = dict(('p%d' % percentile, self.percentile(percentile))
+                       for percentile in PERCENTILES)
+        summary['max'] = self.max
+        return summary
+
+# The metrics of the histogram of the response times published as
+# <name> are named <name>_pNN, <name>_max and <name>_bucket_NN.
+
+def percentile_metric(name, percentile):
+    return '%s_p%d' % (name, percentile)
+
+def max_metric(name):
+    return name + '_max'
+
+def bucket_metric(name, index):
+    return '%s_bucket_%02d' % (name, index)
+
+def metric_units(name):
+    """Return the (metric name, units) of the metrics of the histogram of
+    name"""
+    return ([ (percentile_metric(name, percentile), 'ms')
+              for percentile in PERCENTILES ] +
+            [ (max_metric(name), 'ms') ] +
+            [ (bucket_metric(name, index), 'req/s')
+              for index in range(BUCKETS) ])
+
+def to_metrics(name, histogram, duration):
+    """Return the metrics of histogram, as a {metric name: value}
+    dictionary: its percentiles and maximum in ms, and the rate of the
+    values of each bucket over duration seconds."""
+    metrics = dict((percentile_metric(name, percentile),
+                    histogram.percentile(percentile))
+                   for percentile in PERCENTILES)
+    metrics[max_metric(name)] = histogram.max
+    for index, count in enumerate(histogram.counts):
+        metrics[bucket_metric(name, index)] = (float(count) / duration
+                                               if duration else 0)
+    return metrics
+
+def from_metrics(name, metrics):
+    """Return the LatencyHistogram of the bucket metrics of name, counting
+    rates, or None if they are not among metrics"""
+    if bucket_metric(name, 0) not in metrics:
+        return None
+
+    histogram = LatencyHistogram()
+    histogram.counts = [ metrics.get(bucket_metric(name, index), 0)
+                         for index in range(BUCKETS) ]
+    histogram.max = metrics.get(max_metric(name), 0)
+    return histogram
+
+def is_bucket_metric(name):
+    return '_bucket_' in name
@@ -1,3 +1,5 @@
 from . import client
 from . import server
 from . import x509
+from . import multipart
+from . import fanout
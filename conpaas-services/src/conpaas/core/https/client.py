@@ -18,35 +18,63 @@
     implement the missing function 'makefile', which is
     part by the python socket API and thus required to work
     with httplib.
+
+    Connections are kept alive (HTTP/1.1) and pooled per host:port,
+    so that consecutive requests to the same manager or agent do not
+    pay for a new TCP connection and TLS handshake every time.
  
     It implements the following methods:
         - https_get
         - https_post
         - jsonrpc_post
         - jsonrpc_get
+        - jsonrpc_get_file
+        - jsonrpc_batch
+
+    To make the same call to many agents in parallel, see
+    conpaas.core.https.fanout.
 
     :copyright: (C) 2010-2013 by Contrail Consortium.
 """
 
+import time
+import select
 import socket
-import mimetypes
-from cStringIO import StringIO
+import threading
 from urllib import urlencode
 
 from OpenSSL import SSL
 from httplib import HTTPConnection
 
 from conpaas.core.misc import file_get_contents
+from conpaas.core.context import context_cache
 
 import json
 import httplib
 
 from . import x509
+from . import multipart
 
 __client_ctx = None
 __uid = None
 __sid = None
 
+# Maximum number of idle connections kept open for each host:port
+POOL_MAXSIZE = 4
+
+# How many times to try again a request the server was too busy to accept
+BUSY_RETRIES = 3
+
+# Size of the chunks in which downloaded files are written to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Methods whose requests can be sent again when no response came back
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# (host, port) -> list of idle HTTPSConnection objects
+__connection_pool = {}
+__connection_pool_lock = threading.Lock()
+
 def conpaas_init_ssl_ctx(dir, role, uid=None, sid=None):
     cert_file = dir + '/cert.pem'
     key_file = dir + '/key.pem'
@@ -65,12 +93,24 @@ def conpaas_init_ssl_ctx(dir, role, uid=None, sid=None):
             # Extract uid from the certificate itself
             uid = x509.get_x509_dn_field(file_get_contents(cert_file), 'UID')
 
+    # The context is only built again if its files changed, so that
+    # callers may initialize it before each request
+    ctx = context_cache.get(('ssl', dir, role),
+        [ cert_file, key_file, ca_cert_file ],
+        lambda: _init_context(SSL.SSLv23_METHOD, cert_file, key_file,
+                              ca_cert_file, verify_callback))
+
     global __client_ctx, __uid, __sid
-    __client_ctx = _init_context(SSL.SSLv23_METHOD, cert_file, key_file,
-                        ca_cert_file, verify_callback)
+    if ctx is __client_ctx and uid == __uid and sid == __sid:
+        return
+
+    __client_ctx = ctx
     __uid = uid
     __sid = sid
 
+    # Pooled connections were established with the old context
+    close_connections()
+
 class HTTPSConnection(HTTPConnection):
     """
         This class allows communication via SSL using 
@@ -111,36 +151,33 @@ class SSLConnectionWrapper(object):
             Forward everything to underlying socket.
         """
         return getattr(self._ssl_conn, name)
-    
+
+    def recv(self, bufsize, flags=None):
+        """
+            Same as SSL.Connection.recv, but returns an empty string
+            when the peer closes the connection, like a socket does.
+        """
+        try:
+            return self._ssl_conn.recv(bufsize)
+        except (SSL.ZeroReturnError, SSL.SysCallError):
+            return ''
+
     def makefile(self, *args):
         """
             This is the method that is missing from SSL.Connection.
             We need to provide this method, which is specific to python
             socket API as it is required by the httplib.
 
-            This function just reads from the socket and writes to a
-            StringIO object.
+            The connection may be kept alive after the response, so
+            we must not read past its end: the returned file object
+            only reads from the socket what httplib asks for, through a
+            buffer of default_buf_size bytes. Large responses can thus
+            be consumed as they arrive (see jsonrpc_get_file).
 
-            @return: file object of type cStringIO.StringIO for data returned
-                     from socket
+            @return: file object of type socket._fileobject for data
+                     returned from socket
         """
-        _buf_size = self.__class__.default_buf_size
-
-        fileobject = StringIO()
-        try:
-            buf = self._ssl_conn.recv(_buf_size)
-            while buf:
-                fileobject.write(buf)
-                buf = self._ssl_conn.recv(_buf_size)
-
-        except (SSL.ZeroReturnError, SSL.SysCallError):
-            # Ignore the exception thrown by httplib
-            # when incomplete content received
-            pass
-
-        # Start reading buffer from beginning
-        fileobject.seek(0)
-        return fileobject
+        return socket._fileobject(self, 'rb', self.__class__.default_buf_size)
 
 
 def _init_context(protocol, cert_file, key_file, 
@@ -158,7 +195,7 @@ def _conpaas_callback_agent(connection, x509, errnum, errdepth, ok):
         The custom certificate verification function called on the
         agent's client side. The agent might sends requests only to
         other agents pertaining to the same user and the same
-        service.
+        service, or to their manager to announce itself.
     '''
 
     components = x509.get_subject().get_components()
@@ -175,7 +212,7 @@ def _conpaas_callback_agent(connection, x509, errnum, errdepth, ok):
             if value == 'CA':
                 return ok
 
-    if dict['role'] != 'agent':
+    if dict['role'] != 'agent' and dict['role'] != 'manager':
        return False
 
     if dict['UID'] != __uid or dict['serviceLocator'] != __sid:
@@ -269,6 +306,144 @@ def _conpaas_callback_director(connection, x509, errnum, errdepth, ok):
 
     return ok 
 
+def _is_open(conn):
+    """
+        Tell whether the server kept the idle connection conn open. It
+        has nothing to send on it: anything to read is the end of the
+        connection.
+    """
+    if conn.sock is None:
+        # Connects on first use
+        return True
+    try:
+        if conn.sock.pending():
+            return False
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, SSL.Error, ValueError):
+        return False
+    return not readable
+
+def _get_connection(host, port):
+    """
+        Return a tuple (connection, reused). An idle connection to
+        host:port is taken from the pool if there is one the server has
+        not closed, otherwise a new one is created (it will connect on
+        first use).
+    """
+    while True:
+        with __connection_pool_lock:
+            idle = __connection_pool.get((host, port))
+            if not idle:
+                break
+            conn = idle.pop()
+
+        if _is_open(conn):
+            return conn, True
+        conn.close()
+
+    return HTTPSConnection(host, port=port, ssl_context=__client_ctx), False
+
+def _release_connection(conn, response):
+    """
+        Put conn back into the pool, unless the server is going to
+        close it or the pool for its host:port is already full.
+    """
+    if not response.will_close and conn.ssl_ctx is __client_ctx:
+        with __connection_pool_lock:
+            idle = __connection_pool.setdefault((conn.host, conn.port), [])
+            if len(idle) < POOL_MAXSIZE:
+                idle.append(conn)
+                return
+
+    conn.close()
+
+def close_connections():
+    """Close all the idle connections in the pool"""
+    with __connection_pool_lock:
+        for idle in __connection_pool.values():
+            for conn in idle:
+                conn.close()
+        __connection_pool.clear()
+
+def _copy_response(response, dest):
+    """Write the body of response to the file object dest, one chunk at
+    a time"""
+    while True:
+        chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        dest.write(chunk)
+
+def _request(host, port, method, uri, body=None, headers=[], dest=None):
+    """
+        Send an HTTPS request over a pooled connection.
+
+        If dest is given and the server answers with a file (a response
+        with a Content-disposition header), the file is written to dest
+        as it is received and None is returned instead of its contents.
+
+        The server closes idle connections when other clients are
+        waiting: pooled connections it closed are not used. It may still
+        close one right after it was checked. If sending the request over
+        it fails, the request is sent once
+        more over a brand new connection. Once it is sent, only requests
+        with an idempotent method are sent again when no response comes
+        back: the server may have executed the others already.
+
+        A server with all its workers busy answers '503 Service
+        Unavailable' without processing the request: in that case it is
+        sent again after the delay the server asked for, up to
+        BUSY_RETRIES times.
+
+        @return A tuple containing the return code
+        and the response to the HTTP request
+    """
+    busy_retries = BUSY_RETRIES
+    while True:
+        h, reused = _get_connection(host, port)
+        sent = False
+        try:
+            h.putrequest(method, uri)
+            for header, value in headers:
+                h.putheader(header, value)
+            if body is not None:
+                h.putheader('content-length', str(len(body)))
+            if isinstance(body, multipart.MultipartBody):
+                h.endheaders()
+                body.send(h.send)
+            else:
+                # Send headers and body together, in as few packets as
+                # possible
+                h.endheaders(body)
+            sent = True
+            r = h.getresponse()
+        except (socket.error, SSL.Error, httplib.HTTPException):
+            h.close()
+            if reused and (not sent or method in IDEMPOTENT_METHODS):
+                continue
+            raise
+
+        try:
+            if dest is not None and r.getheader('content-disposition'):
+                _copy_response(r, dest)
+                data = None
+            else:
+                data = r.read()
+        except:
+            h.close()
+            raise
+
+        _release_connection(h, r)
+
+        retry_after = r.getheader('retry-after', '')
+        if (r.status == httplib.SERVICE_UNAVAILABLE and busy_retries
+                and retry_after.isdigit()):
+            busy_retries -= 1
+            time.sleep(int(retry_after))
+            continue
+
+        return r.status, data
+
 def https_get(host, port, uri, params=None):
     """Creates the VMs associated with the list of nodes. It also tests
        if the agents started correctly.
@@ -285,16 +460,9 @@ def https_get(host, port, uri, params=None):
         @return A tuple containing the return code
         and the response to the HTTP request
     """
-    h = HTTPSConnection(host, port=port, ssl_context=__client_ctx)
     if params:
-        h.putrequest('GET', '%s?%s' % (uri, urlencode(params)))
-    else:
-        h.putrequest('GET', uri)
-    h.endheaders()
-    r = h.getresponse()
-    body = r.read()
-    h.close()
-    return r.status, body
+        uri = '%s?%s' % (uri, urlencode(params))
+    return _request(host, port, 'GET', uri)
 
 def https_post(host, port, uri, params={}, files=[]):
     """
@@ -304,22 +472,19 @@ def https_post(host, port, uri, params={}, files=[]):
         @param params A dictionary containing key:value pairs for regular
                       form fields.
         @param files A sequence of (name, filename, value) tuples for
-                     data to be uploaded as files
+                     data to be uploaded as files. value can be a file
+                     object: it is then read while the request is sent,
+                     rather than loaded in memory.
 
         @return A tuple containing the return code
         and the response to the HTTP request
     """
-    content_type, body = _encode_multipart_formdata(params, files)
-    h = HTTPSConnection(host, port=port, ssl_context=__client_ctx)
-    h.putrequest('POST', uri)
-    h.putheader('content-type', content_type)
-    h.putheader('content-length', str(len(body)))
-    h.endheaders()
-    h.send(body)
-    r = h.getresponse()
-    body = r.read()
-    h.close()
-    return r.status, body
+    body = multipart.MultipartBody(params, files)
+    content_type = body.content_type
+    if not body.has_files():
+        body = body.getvalue()
+    return _request(host, port, 'POST', uri, body,
+                    [('content-type', content_type)])
 
 def _encode_multipart_formdata(params, files):
     """
@@ -332,34 +497,8 @@ def _encode_multipart_formdata(params, files):
         @return A tuple, (content_type, body), ready for
                 httplib.HTTP instance
     """
-    '''
-        TODO: For some reason we receive the filename in
-        unicode and the CRLF.join(L) crashes.
-        To solve this, I converted the filename to ascii.
-    '''
-    BOUNDARY = '----------_BoUnDaRy_StRiNg_$'
-    CRLF = '\r\n'
-    L = []
-    for key in params:
-        L.append('--' + BOUNDARY)
-        L.append('Content-Disposition: form-data; name="%s"' % key)
-        L.append('')
-        L.append(str(params[key]))
-    for (key, filename, value) in files:
-        L.append('--' + BOUNDARY)
-        L.append('Content-Disposition: form-data; name="%s"; filename="%s"' \
-                % (key, filename.encode('ascii')))
-        L.append('Content-Type: %s' % _get_content_type(filename))
-        L.append('')
-        L.append(value)
-    L.append('--' + BOUNDARY + '--')
-    L.append('')
-    body = CRLF.join(L)
-    content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-    return content_type, body
-
-def _get_content_type(filename):
-    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    body = multipart.MultipartBody(params, files)
+    return body.content_type, body.getvalue()
 
 def jsonrpc_get(host, port, uri, method, params=None):
     """
@@ -374,17 +513,30 @@ def jsonrpc_get(host, port, uri, method, params=None):
         @return A tuple containing the return code
         and the response to the HTTP request
     """
-    h = HTTPSConnection(host, port=port, ssl_context=__client_ctx)
     all_params = {'method': method, 'id': '1'}
     if params:
         all_params['params'] = json.dumps(params)
-    h.putrequest('GET', '%s?%s' % (uri, urlencode(all_params)))
-    h.putheader('content-type', 'application/json')
-    h.endheaders()
-    r = h.getresponse()
-    body = r.read()
-    h.close()
-    return r.status, body 
+    return _request(host, port, 'GET', '%s?%s' % (uri, urlencode(all_params)),
+                    headers=[('content-type', 'application/json')])
+
+def jsonrpc_get_file(host, port, uri, method, dest, params=None):
+    """
+        Same as jsonrpc_get, for methods returning a file: the file
+        is written to dest while it is downloaded, rather than being
+        kept in memory.
+
+        @param dest A file object opened for writing
+
+        @return A tuple containing the return code and None if the file
+        has been written to dest, or the response to the HTTP request
+        otherwise (eg: an error message)
+    """
+    all_params = {'method': method, 'id': '1'}
+    if params:
+        all_params['params'] = json.dumps(params)
+    return _request(host, port, 'GET', '%s?%s' % (uri, urlencode(all_params)),
+                    headers=[('content-type', 'application/json')],
+                    dest=dest)
 
 def jsonrpc_post(host, port, uri, method, params={}):
     """
@@ -400,16 +552,39 @@ def jsonrpc_post(host, port, uri, method, params={}):
         and the response to the HTTP request
     """
     body = json.dumps({'method': method, 'params': params, 'id': '1'})
-    h = HTTPSConnection(host, port=port, ssl_context=__client_ctx)
-    h.putrequest('POST', uri)
-    h.putheader('content-type', 'application/json')
-    h.putheader('content-length', str(len(body)))
-    h.endheaders()
-    h.send(body)
-    r = h.getresponse()
-    body = r.read()
-    h.close()
-    return r.status, body
+    return _request(host, port, 'POST', uri, body,
+                    [('content-type', 'application/json')])
+
+def jsonrpc_batch(host, port, uri, calls):
+    """
+        Post several calls to an HTTPS server in a single application/json
+        request. The server runs them one after the other, in order.
+
+        @param calls A sequence of (method, params) tuples, params being
+                     a dictionary of arguments for method
+
+        @return A tuple containing the return code and the response to
+        the HTTP request, which holds the list of the responses to each
+        call (see check_batch_response)
+    """
+    body = json.dumps([ {'method': method, 'params': params, 'id': str(i + 1)}
+                        for i, (method, params) in enumerate(calls) ])
+    return _request(host, port, 'POST', uri, body,
+                    [('content-type', 'application/json')])
+
+def check_batch_response(response):
+    """Check the response to jsonrpc_batch, returning the list of results
+    if every call went fine"""
+    code, body = response
+    if code != httplib.OK:
+        raise Exception('Received http response code %d' % (code))
+
+    results = []
+    for data in json.loads(body):
+        if data['error']:
+            raise Exception(data['error'])
+        results.append(data['result'])
+    return results
 
 def check_response(response):
     """Check the given HTTP response, returning the result if everything went
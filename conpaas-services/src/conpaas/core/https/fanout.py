@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+    conpaas.core.https.fanout
+    =========================
+    ConPaaS core: calling many agents in parallel.
+
+    Managers often make the same call to every node of a service. Making
+    those calls one after the other takes as many times the duration of
+    a call as there are nodes. call_nodes makes them in parallel:
+
+        from conpaas.core.https import fanout
+
+        outcome = fanout.call_nodes(
+            lambda node: client.stopWebServer(node.ip, 5555), nodes)
+        outcome.log_errors(logger, 'Failed to stop web')
+        outcome.check()
+
+    :copyright: (C) 2010-2013 by Contrail Consortium.
+"""
+
+import sys
+import time
+import threading
+
+# Default maximum number of calls running at the same time
+CONCURRENCY = 16
+
+class NodeTimeout(Exception): pass
+
+
+class FanoutOutcome(object):
+    """
+        The outcome of call_nodes.
+
+        results holds the value returned for each node, in the order of
+        the nodes (None for nodes whose call failed).
+
+        errors holds a (node, exc_info) tuple for each node whose call
+        failed, in the order of the nodes. exc_info is the tuple returned
+        by sys.exc_info() when the call raised its exception.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.results = [ None ] * len(nodes)
+        self._exc_infos = [ None ] * len(nodes)
+
+    @property
+    def errors(self):
+        return [ (node, exc_info)
+                 for node, exc_info in zip(self.nodes, self._exc_infos)
+                 if exc_info is not None ]
+
+    def log_errors(self, logger, failure):
+        """Log the error of each failed call as 'failure at node ...'"""
+        for node, exc_info in self.errors:
+            logger.error('%s at node %s' % (failure, node), exc_info=exc_info)
+
+    def check(self):
+        """Raise the exception of the first node whose call failed, if
+        any, with its original traceback"""
+        for exc_info in self._exc_infos:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def call_nodes(call, nodes, concurrency=CONCURRENCY, timeout=None):
+    """
+        Call call(node) for every node, running up to concurrency calls
+        at the same time, and wait for all of them to return.
+
+        @param call A function taking a node as its only argument,
+                    typically making a call to the agent of that node
+
+        @param nodes A sequence of nodes
+
+        @param concurrency The maximum number of calls running at the same
+                           time
+
+        @param timeout If not None, calls still running timeout seconds
+                       after they started are reported as failed with a
+                       NodeTimeout exception. They are not interrupted,
+                       but their outcome is ignored.
+
+        @return A FanoutOutcome holding the result or the error of each
+                call
+    """
+    nodes = list(nodes)
+    outcome = FanoutOutcome(nodes)
+    cond = threading.Condition()
+
+    # Calls started and not timed out yet, by index in nodes
+    running = {}
+
+    def run(index):
+        try:
+            result, exc_info = call(nodes[index]), None
+        except Exception:
+            result, exc_info = None, sys.exc_info()
+
+        with cond:
+            if index in running:
+                del running[index]
+                outcome.results[index] = result
+                outcome._exc_infos[index] = exc_info
+                cond.notify()
+
+    next_index = 0
+    with cond:
+        while next_index < len(nodes) or running:
+            while next_index < len(nodes) and len(running) < concurrency:
+                running[next_index] = time.time()
+                thread = threading.Thread(target=run, args=[next_index])
+                thread.daemon = True
+                thread.start()
+                next_index += 1
+
+            if timeout is None:
+                cond.wait()
+                continue
+
+            now = time.time()
+            for index, started in running.items():
+                if started + timeout <= now:
+                    del running[index]
+                    try:
+                        raise NodeTimeout('No answer from node %s after %s '
+                                          'seconds' % (nodes[index], timeout))
+                    except NodeTimeout:
+                        outcome._exc_infos[index] = sys.exc_info()
+
+            # Unless timeouts made room for more calls
+            if running and (len(running) >= concurrency or
+                            next_index == len(nodes)):
+                cond.wait(min(running.values()) + timeout - now)
+
+    return outcome
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+    conpaas.core.https.multipart
+    ============================
+    ConPaaS core: streaming multipart/form-data support.
+
+    MultipartBody is used on the client side. It builds a request body
+    out of regular form fields and files, and reads the files only while
+    the body is being sent.
+
+    MultipartParser is used on the server side. It reads such a body
+    from a file object one chunk at a time, keeping uploaded files in
+    temporary files which stay in memory only up to a given size.
+
+    :copyright: (C) 2010-2013 by Contrail Consortium.
+"""
+
+import cgi
+import uuid
+import mimetypes
+import tempfile
+from cStringIO import StringIO
+
+CRLF = '\r\n'
+
+# Size of the chunks in which files are sent and request bodies are read
+CHUNK_SIZE = 64 * 1024
+
+# Maximum size of the headers of a single part
+MAX_HEADERS_SIZE = 64 * 1024
+
+class MultipartError(Exception): pass
+
+
+def _get_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+def _remaining_size(fileobj):
+    """Return the number of bytes between the current position of fileobj
+    and its end"""
+    start = fileobj.tell()
+    fileobj.seek(0, 2)
+    size = fileobj.tell() - start
+    fileobj.seek(start)
+    return size
+
+
+class MultipartBody(object):
+    """
+        A multipart/form-data request body.
+
+        @param params A dictionary containing key:value pairs for regular
+                      form fields.
+
+        @param files A sequence of (name, filename, value) tuples for
+                     data to be uploaded as files. value is either a
+                     string or a file object, which will be read from
+                     its current position when the body is sent.
+    """
+
+    def __init__(self, params, files):
+        self.boundary = '----------ConPaaS' + uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+
+        # Strings, and (file object, start, length) tuples
+        self.parts = []
+
+        for key in params:
+            self.parts.append('--%s%sContent-Disposition: form-data; '
+                              'name="%s"%s%s%s%s' % (self.boundary, CRLF, key,
+                              CRLF, CRLF, str(params[key]), CRLF))
+
+        for (key, filename, value) in files:
+            '''
+                TODO: For some reason we receive the filename in
+                unicode and the join crashes.
+                To solve this, I converted the filename to ascii.
+            '''
+            filename = filename.encode('ascii')
+            self.parts.append('--%s%sContent-Disposition: form-data; '
+                              'name="%s"; filename="%s"%sContent-Type: %s%s%s'
+                              % (self.boundary, CRLF, key, filename, CRLF,
+                                 _get_content_type(filename), CRLF, CRLF))
+            if isinstance(value, basestring):
+                self.parts.append(value)
+            else:
+                self.parts.append((value, value.tell(), _remaining_size(value)))
+            self.parts.append(CRLF)
+
+        self.parts.append('--%s--%s' % (self.boundary, CRLF))
+
+    def __len__(self):
+        return sum([ len(part) if isinstance(part, basestring) else part[2]
+                     for part in self.parts ])
+
+    def has_files(self):
+        """Return True if some parts are read from file objects"""
+        return not all([ isinstance(part, basestring)
+                         for part in self.parts ])
+
+    def getvalue(self):
+        """Return the whole body as a string"""
+        out = StringIO()
+        self.send(out.write)
+        return out.getvalue()
+
+    def send(self, write):
+        """
+            Pass the body to write, one chunk at a time.
+
+            Files are read again from their starting position each time,
+            so that a body can be sent more than once.
+        """
+        pending = []
+        for part in self.parts:
+            if isinstance(part, basestring):
+                # Join consecutive strings to send fewer, bigger chunks
+                pending.append(part)
+                continue
+
+            if pending:
+                write(''.join(pending))
+                pending = []
+
+            fileobj, start, length = part
+            fileobj.seek(start)
+            while length > 0:
+                chunk = fileobj.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    raise MultipartError('File %s shrunk while being sent' %
+                                         getattr(fileobj, 'name', fileobj))
+                write(chunk)
+                length -= len(chunk)
+
+        if pending:
+            write(''.join(pending))
+
+
+class MultipartParser(object):
+    """
+        Incremental parser of multipart/form-data bodies.
+
+        @param fp File object to read the body from
+
+        @param boundary The boundary given in the Content-Type header
+
+        @param length The length of the body: no more than length bytes
+                      are read from fp
+
+        @param spool_size Uploaded files larger than spool_size bytes
+                          are written to disk
+    """
+
+    def __init__(self, fp, boundary, length, spool_size):
+        if not boundary:
+            raise MultipartError('Missing boundary')
+
+        self.fp = fp
+        self.delimiter = CRLF + '--' + boundary
+        self.remaining = length
+        self.spool_size = spool_size
+
+    def parse(self):
+        """
+            Read the whole body.
+
+            @return A list of (name, filename, value) tuples. For regular
+            form fields filename is None and value a string. For files,
+            value is a file object positioned at the beginning of the file.
+        """
+        fields = []
+
+        # The first delimiter is not preceded by a line break
+        buf = CRLF
+
+        # Skip the preamble
+        buf = self._read_until(buf, None)
+
+        while True:
+            buf = self._fill(buf, 2)
+            if buf.startswith('--'):
+                # Closing delimiter
+                break
+
+            buf, name, filename = self._read_headers(buf)
+            if filename is None:
+                sink = StringIO()
+            else:
+                sink = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+
+            buf = self._read_until(buf, sink)
+
+            if filename is None:
+                fields.append((name, None, sink.getvalue()))
+            else:
+                sink.seek(0)
+                fields.append((name, filename, sink))
+
+        # Skip the epilogue, the request must be read entirely
+        while self._read():
+            pass
+
+        return fields
+
+    def _read(self):
+        if self.remaining <= 0:
+            return ''
+
+        data = self.fp.read(min(CHUNK_SIZE, self.remaining))
+        self.remaining -= len(data)
+        if not data:
+            # The connection has been closed
+            self.remaining = 0
+        return data
+
+    def _fill(self, buf, size):
+        """Return buf with more data read, up to at least size bytes"""
+        while len(buf) < size:
+            data = self._read()
+            if not data:
+                raise MultipartError('Unexpected end of body')
+            buf += data
+        return buf
+
+    def _read_until(self, buf, sink):
+        """
+            Write to sink (unless it is None) the data preceding the next
+            delimiter, and return the data following it.
+        """
+        keep = len(self.delimiter) - 1
+        while True:
+            index = buf.find(self.delimiter)
+            if index != -1:
+                if sink is not None:
+                    sink.write(buf[:index])
+                return buf[index + len(self.delimiter):]
+
+            # The end of buf might be the beginning of the delimiter
+            if len(buf) > keep:
+                if sink is not None:
+                    sink.write(buf[:-keep])
+                buf = buf[-keep:]
+
+            data = self._read()
+            if not data:
+                raise MultipartError('Missing closing boundary')
+            buf += data
+
+    def _read_headers(self, buf):
+        """
+            Parse the headers of a part.
+
+            @return A tuple (buf, name, filename) where buf holds the data
+            following the headers. filename is None for regular fields.
+        """
+        while True:
+            end = buf.find(CRLF + CRLF)
+            if end != -1:
+                break
+            if len(buf) > MAX_HEADERS_SIZE:
+                raise MultipartError('Part headers too long')
+            data = self._read()
+            if not data:
+                raise MultipartError('Unexpected end of body')
+            buf += data
+
+        # The first line is the end of the delimiter line
+        name = filename = None
+        for line in buf[:end].split(CRLF)[1:]:
+            header, _, value = line.partition(':')
+            if header.strip().lower() == 'content-disposition':
+                _, pdict = cgi.parse_header(value.strip())
+                name = pdict.get('name')
+                filename = pdict.get('filename')
+
+        if name is None:
+            raise MultipartError('Part without a name')
+
+        return buf[end + len(CRLF + CRLF):], name, filename
@@ -23,6 +23,23 @@
     python libraries with a SSL.Connection object provided
     by the pyopenssl library.
 
+    Requests are handled in the server thread, unless the role's
+    configuration section sets SERVER_THREADS: a bounded pool of worker
+    threads then serves up to that many connections in parallel, with at
+    most SERVER_QUEUE_SIZE more waiting for a worker. Connections coming
+    in when the queue is full get a '503 Service Unavailable' response.
+    GET methods then run in parallel, but the POST and UPLOAD ones, which
+    may change the state of the service, still run one at a time: they
+    hold the update_lock of the server, which is the one of the manager
+    when it has one.
+
+    Uploaded files are kept in memory up to UPLOAD_SPOOL_SIZE bytes and
+    written to temporary files beyond that. Uploads larger than
+    UPLOAD_MAX_SIZE bytes are refused.
+
+    A JSON POST request may also hold a list of calls, which are run in
+    order and answered with the list of their responses.
+
     :copyright: (C) 2010-2013 by Contrail Consortium.
 """
 
@@ -33,12 +50,17 @@ import json
 import cgi
 import os 
 import sys
+import time
+import select
+import threading
+import Queue
 
 from SocketServer import BaseServer
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from OpenSSL import SSL
 
 from conpaas.core import log
+from conpaas.core.https import multipart
 from conpaas.core.expose import exposed_functions
 from conpaas.core.services import manager_services 
 from conpaas.core.services import agent_services 
@@ -74,15 +96,161 @@ class HttpFileDownloadResponse(HttpResponse):
 
 
 class HTTPSServer(HTTPServer):
+
+    # Uploaded files larger than this many bytes are written to disk
+    upload_spool_size = 1024 * 1024
+
+    # Maximum size of an upload request, in bytes
+    upload_max_size = 1024 * 1024 * 1024
+
+    # Methods which peers having one of these roles are allowed to call,
+    # by role. Peers having other roles can call any method.
+    restricted_roles = {}
+
+    # POST methods which do not need to hold update_lock
+    concurrent_methods = ()
+
     def __init__(self, server_address, handler, ctx):
         BaseServer.__init__(self, server_address, handler)
+        self.update_lock = threading.RLock()
         self.socket = SSL.Connection(ctx, socket.socket(self.address_family,
                                                         self.socket_type))
         self.server_bind()
         self.server_activate()
 
+    def shutdown_request(self, request):
+        """SSL.Connection.shutdown does not take the 'how' argument"""
+        try:
+            request.shutdown()
+        except SSL.Error:
+            pass
+        self.close_request(request)
+
+    def wait_for_request(self, connection, timeout):
+        """Wait for the next request on a kept-alive connection.
+
+        Return False after timeout seconds, or as soon as a new client is
+        waiting to be accepted: requests are handled one at a time.
+        """
+        try:
+            readable, _, _ = select.select([connection, self.socket], [], [],
+                                           timeout)
+        except select.error:
+            return False
+
+        return connection in readable
+
+
+class ThreadPoolMixIn:
+    """Mix-in class to handle requests with a bounded pool of threads.
+
+    Accepted connections are queued for pool_size worker threads. When
+    queue_size connections are already waiting, new ones are answered
+    with '503 Service Unavailable' by a single extra thread, and closed
+    without an answer if that one is busy too.
+
+    The pool is used only after start_workers() has been called, and
+    busy_handler_class must be set to the request handler class answering
+    the rejected connections.
+    """
+
+    pool_size = 0
+    queue_size = 0
+
+    # Seconds between two checks for queued connections while a worker
+    # waits on an idle kept-alive connection
+    poll_interval = 0.5
+
+    busy_handler_class = None
+
+    def start_workers(self, pool_size, queue_size):
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.requests = Queue.Queue(queue_size)
+        self.rejected_requests = Queue.Queue(queue_size)
+
+        self.workers = [ threading.Thread(target=self._process_requests,
+                                          args=[self.requests, self._serve])
+                         for _ in range(pool_size) ]
+        self.workers.append(threading.Thread(target=self._process_requests,
+                                             args=[self.rejected_requests,
+                                                   self._reject]))
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def stop_workers(self):
+        for _ in range(self.pool_size):
+            self.requests.put(None)
+        self.rejected_requests.put(None)
+
+        for worker in self.workers:
+            worker.join()
+        self.pool_size = 0
+
+    def process_request(self, request, client_address):
+        if not self.pool_size:
+            self._serve(request, client_address)
+            return
+
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Queue.Full:
+            try:
+                self.rejected_requests.put_nowait((request, client_address))
+            except Queue.Full:
+                self.shutdown_request(request)
 
-class ConpaasSecureServer(HTTPSServer):
+    def wait_for_request(self, connection, timeout):
+        """Wait for the next request on a kept-alive connection.
+
+        Return False after timeout seconds, or as soon as other
+        connections are waiting for a worker: an idle connection must
+        not hold one while they do.
+        """
+        if not self.pool_size:
+            return HTTPSServer.wait_for_request(self, connection, timeout)
+
+        deadline = time.time() + timeout
+        while self.requests.empty():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            try:
+                readable, _, _ = select.select([connection], [], [],
+                                   min(remaining, self.poll_interval))
+            except select.error:
+                return False
+
+            if readable:
+                return True
+
+        return False
+
+    def _process_requests(self, requests, process):
+        while True:
+            item = requests.get()
+            if item is None:
+                break
+            process(*item)
+
+    def _serve(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    def _reject(self, request, client_address):
+        try:
+            self.busy_handler_class(request, client_address, self)
+        except:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+
+class ConpaasSecureServer(ThreadPoolMixIn, HTTPSServer):
     '''
     HTTPS server for ConPaaS.
 
@@ -133,6 +301,39 @@ class ConpaasSecureServer(HTTPSServer):
                                     config_parser.get(role, 'CERT_DIR'), SSL.SSLv23_METHOD)
         HTTPSServer.__init__(self, server_address, ConpaasRequestHandler, ctx)
 
+        if role == 'manager':
+            # Agents can only tell their manager that they are up
+            self.restricted_roles = {'agent': ['agent_up']}
+            # Agents announce themselves while nodes are being created
+            self.concurrent_methods = ('agent_up',)
+
+        # Threads of the service changing its state share its lock
+        self.update_lock = getattr(self.instance, 'update_lock',
+                                   self.update_lock)
+
+        if config_parser.has_option(role, 'UPLOAD_SPOOL_SIZE'):
+            self.upload_spool_size = config_parser.getint(role,
+                                                          'UPLOAD_SPOOL_SIZE')
+        if config_parser.has_option(role, 'UPLOAD_MAX_SIZE'):
+            self.upload_max_size = config_parser.getint(role,
+                                                        'UPLOAD_MAX_SIZE')
+
+        # Serve requests in parallel if so configured
+        if config_parser.has_option(role, 'SERVER_THREADS'):
+            pool_size = config_parser.getint(role, 'SERVER_THREADS')
+            queue_size = pool_size * 4
+            if config_parser.has_option(role, 'SERVER_QUEUE_SIZE'):
+                queue_size = config_parser.getint(role, 'SERVER_QUEUE_SIZE')
+
+            if pool_size > 0:
+                self.busy_handler_class = ConpaasBusyRequestHandler
+                self.start_workers(pool_size, queue_size)
+
+    def server_close(self):
+        if self.pool_size:
+            self.stop_workers()
+        HTTPSServer.server_close(self)
+
     def _register_method(self, http_method, func_name, callback):
         self.callback_dict[http_method][func_name] = callback
 
@@ -197,16 +398,16 @@ class ConpaasSecureServer(HTTPSServer):
         if dict['role'] == 'frontend':
             return ok
 
-        # Check if request from user or manager
-        if dict['role'] != 'user' and dict['role'] != 'manager':
+        # Check if request from user, manager or agent
+        if dict['role'] not in ('user', 'manager', 'agent'):
             return False
 
         uid = self.config_parser.get('manager', 'USER_ID')
         if dict['UID'] != uid:
             return False
 
-        # If request from manager, check the SID
-        if dict['role'] == 'manager':
+        # If request from manager or agent, check the SID
+        if dict['role'] in ('manager', 'agent'):
             sid = self.config_parser.get('manager', 'SERVICE_ID')
             if dict['serviceLocator'] != sid:
                 return False
@@ -258,7 +459,19 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
                           'application/json',
                           'application/jsonrequest']
     MULTIPART_CONTENT_TYPE = 'multipart/form-data'
-    
+
+    # Keep connections alive between requests (clients pool them)
+    protocol_version = 'HTTP/1.1'
+
+    # Seconds to wait for the next request on a kept-alive connection
+    KEEPALIVE_TIMEOUT = 15
+
+    # Buffer responses: they are flushed once complete
+    wbufsize = -1
+
+    # Size of the chunks in which files are read and sent
+    FILE_CHUNK_SIZE = 64 * 1024
+
     def setup(self):
         """
         We need to use socket._fileobject Because SSL.Connection
@@ -269,6 +482,27 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
         self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
         self.wfile = socket._fileobject(self.request, "wb", self.wbufsize)
 
+    def handle(self):
+        '''
+        Handle HTTP requests until the client closes the connection, asks
+        us to close it or stays idle for too long.
+        '''
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            self.handle_one_request()
+
+    def _wait_for_request(self):
+        '''
+        Return True when the next request on this connection can be read,
+        False if the server wants it closed (see wait_for_request).
+        '''
+        if len(self.rfile._rbuf.getvalue()) or self.connection.pending():
+            return True
+
+        return self.server.wait_for_request(self.connection,
+                                            self.KEEPALIVE_TIMEOUT)
+
     def handle_one_request(self):
         '''
         Handle a single HTTP request.
@@ -278,7 +512,11 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
         commands such as GET and POST.
 
         '''
-        self.raw_requestline = self.rfile.readline()
+        try:
+            self.raw_requestline = self.rfile.readline()
+        except (SSL.ZeroReturnError, SSL.SysCallError):
+            # The client closed the connection
+            self.raw_requestline = ''
         if not self.raw_requestline:
             self.close_connection = 1
             return
@@ -301,6 +539,7 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
             self._handle_post()
         else:
             self.send_error(httplib.METHOD_NOT_ALLOWED)
+        self.wfile.flush()
 
     def _handle_get(self, parsed_url):
         if self.headers['content-type'] in self.JSON_CONTENT_TYPES:
@@ -310,9 +549,15 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
 
     def _handle_post(self):
         if self.headers['content-type'] in self.JSON_CONTENT_TYPES:
-            self._dispatch('POST', self._parse_jsonrpc_post_params())
+            params = self._parse_jsonrpc_post_params()
+            if isinstance(params, list):
+                self._dispatch_batch(params)
+            else:
+                self._dispatch('POST', params)
         elif self.headers['content-type'].startswith(self.MULTIPART_CONTENT_TYPE):
-            self._dispatch('UPLOAD', self._parse_upload_params())
+            params = self._parse_upload_params()
+            if params is not None:
+                self._dispatch('UPLOAD', params)
         else:
             self.send_error(httplib.UNSUPPORTED_MEDIA_TYPE)
 
@@ -336,24 +581,62 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
         return params
 
     def _parse_upload_params(self):
-        post_data = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={'REQUEST_METHOD': 'POST'})
+        '''
+        Read a multipart/form-data request body. Return None if it cannot
+        be read, after sending an error response.
+        '''
+        length = self.headers.get('content-length', '')
+        if not length.isdigit():
+            self.close_connection = 1
+            self.send_error(httplib.LENGTH_REQUIRED)
+            return None
+        if int(length) > self.server.upload_max_size:
+            # Do not read the body
+            self.close_connection = 1
+            self.send_error(httplib.REQUEST_ENTITY_TOO_LARGE)
+            return None
+
+        _, pdict = cgi.parse_header(self.headers['content-type'])
+        try:
+            parser = multipart.MultipartParser(self.rfile,
+                                               pdict.get('boundary'),
+                                               int(length),
+                                               self.server.upload_spool_size)
+            fields = parser.parse()
+        except multipart.MultipartError, err:
+            self.close_connection = 1
+            self.send_error(httplib.BAD_REQUEST, str(err))
+            return None
+
         params = {}
         # get rid of repeated params, pick the last one
-        if post_data.list:
-            for k in post_data.keys():
-                if isinstance(post_data[k], list): record = post_data[k][-1]
-                else: record = post_data[k]
-                if record.filename == None:
-                    params[record.name] = record.value
-                else:
-                    params[record.name] = FileUploadField(record.filename, record.file)
+        for name, filename, value in fields:
+            if filename is None:
+                params[name] = value
+            else:
+                params[name] = FileUploadField(filename, value)
         return params
 
+    def _is_allowed(self, callback_name):
+        '''Return True if the peer is allowed to call callback_name'''
+        if not self.server.restricted_roles:
+            return True
+
+        cert = self.connection.get_peer_certificate()
+        if cert is None:
+            return False
+        role = dict(cert.get_subject().get_components()).get('role')
+        if role not in self.server.restricted_roles:
+            return True
+        return callback_name in self.server.restricted_roles[role]
+
     def _dispatch(self, callback_type, params):
         if 'method' not in params:
             self.send_method_missing(callback_type, params)
         elif params['method'] not in self.server.callback_dict[callback_type]:
             self.send_method_not_found(callback_type, params)
+        elif not self._is_allowed(params['method']):
+            self.send_custom_response(httplib.FORBIDDEN, 'method not allowed')
         else:
             callback_name = params.pop('method')
             callback_params = {}
@@ -378,31 +661,170 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
             except Exception as e:
                 print e
                 sys.stdout.flush()
+                # No response was sent, the client must not wait for one
+                self.close_connection = 1
+
+    def _dispatch_batch(self, calls):
+        '''
+        Run a list of POST calls in order, in a single request. The
+        response holds the list of their responses, in the same order.
+        '''
+        if not calls:
+            self.send_custom_response(httplib.BAD_REQUEST, 'Empty batch')
+            return
+
+        responses = []
+        for call in calls:
+            if not isinstance(call, dict) or 'method' not in call:
+                responses.append({'error': 'Did not specify method',
+                                  'id': None})
+                continue
+
+            request_id = call.get('id')
+            if call['method'] not in self.server.callback_dict['POST']:
+                responses.append({'error': 'method not found',
+                                  'id': request_id})
+                continue
+            if not self._is_allowed(call['method']):
+                responses.append({'error': 'method not allowed',
+                                  'id': request_id})
+                continue
+
+            try:
+                response = self._do_dispatch('POST', call['method'],
+                                             call.get('params', {}))
+            except Exception as e:
+                print e
+                sys.stdout.flush()
+                responses.append({'error': str(e), 'id': request_id})
+                continue
+
+            if isinstance(response, HttpErrorResponse):
+                responses.append({'error': response.message,
+                                  'id': request_id})
+            elif isinstance(response, HttpJsonResponse):
+                responses.append({'result': response.obj, 'error': None,
+                                  'id': request_id})
+            else:
+                responses.append({'error': 'Files cannot be sent in a batch',
+                                  'id': request_id})
+
+        self.send_custom_response(httplib.OK, json.dumps(responses))
 
     def _do_dispatch(self, callback_type, callback_name, params):
-        return self.server.callback_dict[callback_type][callback_name](self.server.instance, params)
+        callback = self.server.callback_dict[callback_type][callback_name]
+        if (callback_type == 'GET' or
+                callback_name in self.server.concurrent_methods):
+            return callback(self.server.instance, params)
+
+        # The other methods may change the state of the service: they
+        # run one at a time, checking and changing it atomically
+        with self.server.update_lock:
+            return callback(self.server.instance, params)
 
     def send_custom_response(self, code, body=None):
         '''Convenience method to send a custom HTTP response.
         code: HTTP Response code.
         body: Optional HTTP response content.
         '''
+        if body is None:
+            body = ''
+        body = str(body)
         self.send_response(code)
+        self.send_header('Content-length', len(body))
         self.end_headers()
-        if body != None:
-            print >>self.wfile, body,
+        self.wfile.write(body)
 
     def send_file_response(self, code, filename, headers=None):
-        fd = open(filename)
-        stat = os.fstat(fd.fileno())
+        '''Send the contents of filename, FILE_CHUNK_SIZE bytes at a time.
+
+        A request for a single byte range ('Range: bytes=first-last') is
+        answered with '206 Partial Content' and only that part of the file.
+        '''
+        fd = open(filename, 'rb')
+        try:
+            self._send_file(code, fd, headers)
+        finally:
+            fd.close()
+
+    def _send_file(self, code, fd, headers):
+        size = os.fstat(fd.fileno()).st_size
+
+        try:
+            byte_range = self._get_byte_range(size)
+        except ValueError:
+            self.send_response(httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-length', 0)
+            self.end_headers()
+            return
+
+        if byte_range:
+            code = httplib.PARTIAL_CONTENT
+            first, last = byte_range
+            fd.seek(first)
+        else:
+            first, last = 0, size - 1
+        length = last - first + 1
+
         self.send_response(code)
         for h in headers:
             self.send_header(h, headers[h])
-        self.send_header('Content-length', stat.st_size)
+        if byte_range:
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (first, last, size))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-length', length)
         self.end_headers()
-        while fd.tell() != stat.st_size:
-            print >>self.wfile, fd.read(),
-        fd.close()
+        self.wfile.flush()
+
+        # Chunks go straight to the SSL connection: there is no sendfile()
+        # with pyopenssl, as data has to be encrypted in user space anyway
+        while length > 0:
+            chunk = fd.read(min(self.FILE_CHUNK_SIZE, length))
+            if not chunk:
+                # The file has been truncated meanwhile. The client can
+                # only tell from the connection being closed early.
+                self.close_connection = 1
+                break
+            self.connection.sendall(chunk)
+            length -= len(chunk)
+
+    def _get_byte_range(self, size):
+        '''Return the (first, last) byte positions of the range requested
+        in the Range header, None to send the whole file. Raise ValueError
+        if the range cannot be satisfied.
+
+        Only single ranges are supported, others are ignored.
+        '''
+        value = self.headers.get('range', '')
+        if not value.startswith('bytes=') or ',' in value:
+            return None
+
+        first, sep, last = value[len('bytes='):].strip().partition('-')
+        if not sep or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if first:
+            first = int(first)
+            if last and int(last) < first:
+                return None
+            if last:
+                last = min(int(last), size - 1)
+            else:
+                last = size - 1
+        elif int(last):
+            # The last 'last' bytes of the file
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first = size
+
+        if first >= size:
+            raise ValueError('Unsatisfiable range: %s' % value)
+
+        return first, last
 
     def send_method_missing(self, method, params):
         self.send_custom_response(httplib.BAD_REQUEST, 'Did not specify method')
@@ -427,3 +849,39 @@ class ConpaasRequestHandler(BaseHTTPRequestHandler):
         ret += '</table></p>'
         return ret
 
+
+
+class ConpaasBusyRequestHandler(ConpaasRequestHandler):
+    '''
+    Request handler answering '503 Service Unavailable' to any request.
+    It is used when too many connections are waiting for a worker.
+    '''
+
+    # Seconds the client is asked to wait before trying again
+    RETRY_AFTER = 1
+
+    # Largest request body read before answering
+    MAX_DRAIN_SIZE = 64 * 1024
+
+    def handle(self):
+        self.close_connection = 1
+        try:
+            self.raw_requestline = self.rfile.readline()
+        except (SSL.ZeroReturnError, SSL.SysCallError):
+            return
+        if not self.raw_requestline or not self.parse_request():
+            return
+
+        # Read a small request body: closing a connection with unread
+        # data would reset it before the client gets our response. Bigger
+        # ones are not worth buffering, the client gets a reset instead.
+        length = self.headers.get('content-length', '')
+        if length.isdigit() and int(length) <= self.MAX_DRAIN_SIZE:
+            self.rfile.read(int(length))
+
+        self.send_response(httplib.SERVICE_UNAVAILABLE)
+        self.send_header('Retry-After', self.RETRY_AFTER)
+        self.send_header('Content-length', 0)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
@@ -9,6 +9,8 @@
     :copyright: (C) 2010-2013 by Contrail Consortium.
 """
 
+import threading
+
 from OpenSSL import crypto
 
 def gen_rsa_keypair():
@@ -16,6 +18,57 @@ def gen_rsa_keypair():
     pkey.generate_key(crypto.TYPE_RSA, 2048)
     return pkey
 
+class KeyPool(object):
+    """
+        RSA keypairs generated in the background, so that getting one
+        does not have to wait for its generation.
+
+        @param size The number of keypairs kept ready
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = []
+        self.lock = threading.Lock()
+        self.filling = False
+
+    def start(self):
+        """Generate the missing keypairs in a background thread"""
+        with self.lock:
+            if self.filling or len(self.keys) >= self.size:
+                return
+            self.filling = True
+
+        thread = threading.Thread(target=self._fill)
+        thread.daemon = True
+        thread.start()
+
+    def _fill(self):
+        while True:
+            with self.lock:
+                if len(self.keys) >= self.size:
+                    self.filling = False
+                    return
+            try:
+                key = gen_rsa_keypair()
+            except Exception:
+                with self.lock:
+                    self.filling = False
+                raise
+            with self.lock:
+                self.keys.append(key)
+
+    def get(self, count=1):
+        """Return count keypairs, generating those which are not ready yet,
+        and generate new ones in the background"""
+        with self.lock:
+            keys = self.keys[:count]
+            del self.keys[:count]
+
+        keys += [ gen_rsa_keypair() for _ in range(count - len(keys)) ]
+        self.start()
+        return keys
+
 def create_x509_req(pub_key, **name):
     """
         Creates an x509 CSR. We only need to certify that the owner
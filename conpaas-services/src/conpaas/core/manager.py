@@ -9,8 +9,9 @@
     :copyright: (C) 2010-2013 by Contrail Consortium.
 """
 
-from threading import Thread
+from threading import Thread, Condition, Lock, RLock
 
+import time
 import os.path
 from conpaas.core.log import create_logger
 from conpaas.core.expose import expose
@@ -18,14 +19,19 @@ from conpaas.core.controller import Controller
 from conpaas.core.https.server import HttpJsonResponse
 from conpaas.core.https.server import HttpErrorResponse
 from conpaas.core.https.server import FileUploadField
+from conpaas.core.https import fanout
 
 from conpaas.core import ipop
 from conpaas.core.ganglia import ManagerGanglia
+from conpaas.core.timeseries import TimeSeriesStore
 
 class BaseManager(object):
     """Manager class with the following exposed methods:
 
     startup() -- POST
+    agent_up() -- POST
+    wait_for_state() -- GET
+    get_metrics() -- GET
     getLog() -- GET
     upload_startup_script() -- UPLOAD
     get_startup_script() -- GET
@@ -54,6 +60,17 @@ class BaseManager(object):
 
     AGENT_PORT = 5555
 
+    # Longest time a wait_for_state call may block, so that waiting clients
+    # do not keep the server threads busy for long
+    MAX_WAIT_TIMEOUT = 60
+
+    # Default period of time returned by get_metrics, in seconds
+    DEFAULT_METRICS_PERIOD = 3600
+
+    # Protects the creation of the condition variables, locks and metrics
+    # stores of the managers
+    __state_changed_lock = Lock()
+
     def __init__(self, config_parser):
         self.logger = create_logger(__name__)
         self.controller = Controller(config_parser)
@@ -103,6 +120,167 @@ class BaseManager(object):
 
         return HttpJsonResponse({ 'state': self.state })
 
+    @expose('POST')
+    def agent_up(self, kwargs):
+        """Called by agents once they are up. This is the only method
+        agents are allowed to call."""
+        if 'ips' not in kwargs:
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_MISSING, 'ips').message)
+
+        ips = kwargs.pop('ips')
+        if len(kwargs) != 0:
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_UNEXPECTED, kwargs.keys()).message)
+        if not isinstance(ips, list):
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_INVALID,
+                detail='ips should be a list').message)
+
+        self.logger.debug('Agent up at %s' % ips)
+        self.controller.agent_up(ips)
+        return HttpJsonResponse()
+
+    def __get_state_changed(self):
+        """Return the condition notified on each state transition"""
+        # Created here rather than in __init__, as not all the managers
+        # call BaseManager.__init__
+        with BaseManager.__state_changed_lock:
+            if '_state_changed' not in self.__dict__:
+                self._state_changed = Condition()
+            return self._state_changed
+
+    def __get_update_lock(self):
+        with BaseManager.__state_changed_lock:
+            if '_update_lock' not in self.__dict__:
+                self._update_lock = RLock()
+            return self._update_lock
+
+    # Held by the server while it runs a POST or UPLOAD method, which may
+    # check the state of the manager and change it. Other threads must
+    # hold it to do the same.
+    update_lock = property(__get_update_lock)
+
+    def __get_manager_state(self):
+        return self.__dict__.get('_state')
+
+    def __set_manager_state(self, state):
+        state_changed = self.__get_state_changed()
+        with state_changed:
+            self._state = state
+            state_changed.notify_all()
+
+    state = property(__get_manager_state, __set_manager_state)
+
+    def _notify_state_changed(self):
+        """To be called by managers which do not keep their state in
+        self.state, each time it changes"""
+        state_changed = self.__get_state_changed()
+        with state_changed:
+            state_changed.notify_all()
+
+    def _get_current_state(self):
+        """Return the state reported by get_service_info"""
+        return self.state
+
+    def __get_metrics_store(self):
+        """Return the history of the metrics of the service"""
+        with BaseManager.__state_changed_lock:
+            if '_metrics_store' not in self.__dict__:
+                self._metrics_store = TimeSeriesStore()
+            return self._metrics_store
+
+    def record_metrics(self, values, now=None):
+        """Add values, a {metric name: value} dictionary, to the history of
+        the metrics returned by get_metrics"""
+        ignored = self.__get_metrics_store().add(values, now)
+        if ignored:
+            self.logger.warning('Too many metrics, not recording %s' % ignored)
+
+    @expose('GET')
+    def wait_for_state(self, kwargs):
+        """Wait until the manager is in one of the given states, or for
+        timeout seconds at most (MAX_WAIT_TIMEOUT by default).
+
+        Return the current state, and whether it is one of the given
+        states."""
+        if 'states' not in kwargs:
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_MISSING, 'states').message)
+
+        states = kwargs.pop('states')
+        if not isinstance(states, list):
+            states = [ states ]
+
+        try:
+            timeout = min(float(kwargs.pop('timeout', self.MAX_WAIT_TIMEOUT)),
+                          self.MAX_WAIT_TIMEOUT)
+        except (TypeError, ValueError):
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_INVALID,
+                detail='timeout should be a number').message)
+
+        if len(kwargs) != 0:
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_UNEXPECTED, kwargs.keys()).message)
+
+        deadline = time.time() + timeout
+        state_changed = self.__get_state_changed()
+        with state_changed:
+            state = self._get_current_state()
+            while state not in states:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                state_changed.wait(remaining)
+                state = self._get_current_state()
+
+        return HttpJsonResponse({ 'state': state,
+                                  'reached': state in states })
+
+    @expose('GET')
+    def get_metrics(self, kwargs):
+        """Return the recent history of the given metrics.
+
+        kwargs may contain the 'names' of the metrics, the 'start' and 'end'
+        of the period of time (the last DEFAULT_METRICS_PERIOD seconds by
+        default) and the 'step' in seconds between two values. Without
+        'names', return the names of the metrics recorded."""
+        store = self.__get_metrics_store()
+        if 'names' not in kwargs:
+            if len(kwargs) != 0:
+                return HttpErrorResponse(ManagerException(
+                    ManagerException.E_ARGS_MISSING, 'names').message)
+            return HttpJsonResponse({ 'names': store.names() })
+
+        names = kwargs.pop('names')
+        if not isinstance(names, list):
+            names = [ names ]
+
+        now = time.time()
+        try:
+            end = float(kwargs.pop('end', now))
+            start = float(kwargs.pop('start', end - self.DEFAULT_METRICS_PERIOD))
+            step = kwargs.pop('step', None)
+            if step is not None:
+                step = float(step)
+        except (TypeError, ValueError):
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_INVALID,
+                detail='start, end and step should be numbers').message)
+
+        if start > end or (step is not None and step <= 0):
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_INVALID,
+                detail='Expected start <= end and a positive step').message)
+
+        if len(kwargs) != 0:
+            return HttpErrorResponse(ManagerException(
+                ManagerException.E_ARGS_UNEXPECTED, kwargs.keys()).message)
+
+        return HttpJsonResponse({ 'metrics': store.query(names, start, end,
+                                                         step, now) })
+
     @expose('GET')
     def getLog(self, kwargs):
         """Return logfile"""
@@ -175,6 +353,17 @@ class BaseManager(object):
         except IOError:
             return HttpErrorResponse('No startup script')
 
+    def _call_nodes(self, call, nodes, failure):
+        """Run call(node) for all nodes in parallel and return the list of
+        results. If some of the calls fail, log them, go to S_ERROR and
+        raise the first error."""
+        outcome = fanout.call_nodes(call, nodes)
+        if outcome.errors:
+            outcome.log_errors(self.logger, failure)
+            self.state = self.S_ERROR
+            outcome.check()
+        return outcome.results
+
     def _init_cloud(self, cloud):
         if cloud == 'default':
             cloud = 'iaas'
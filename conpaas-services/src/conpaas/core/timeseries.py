@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+    conpaas.core.timeseries
+    =======================
+
+    ConPaaS core: in-memory history of metrics.
+
+    Each metric is kept at several resolutions, in fixed-size ring buffers
+    of averages: recent values in detail, older ones downsampled, in
+    bounded memory. Metrics no longer updated, such as those of removed
+    hosts, are dropped once their archives hold no value any more, or
+    earlier to make room for new ones.
+
+    :copyright: (C) 2010-2013 by Contrail Consortium.
+"""
+
+import time
+from array import array
+from threading import Lock
+
+# (step, size) of the ring buffers of each metric: 15 seconds for an hour,
+# 5 minutes for a day and an hour for a week
+ARCHIVES = ((15, 240), (300, 288), (3600, 168))
+
+# Largest number of metrics kept by a store
+MAX_SERIES = 2000
+
+class Archive(object):
+    """Ring buffer of the averages of the values of a metric over each step
+    seconds, for the last size steps"""
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+
+        # Number of the step each slot is about, -1 when unused
+        self.steps = array('l', [ -1 ]) * size
+        self.sums = array('d', [ 0 ]) * size
+        self.counts = array('l', [ 0 ]) * size
+
+    def add(self, value, now):
+        step = int(now // self.step)
+        slot = step % self.size
+        if self.steps[slot] != step:
+            self.steps[slot] = step
+            self.sums[slot] = 0
+            self.counts[slot] = 0
+
+        self.sums[slot] += value
+        self.counts[slot] += 1
+
+    def first(self, now):
+        """Return the start of the oldest step that can be held at time now"""
+        return (int(now // self.step) - self.size + 1) * self.step
+
+    def points(self, start, end, now):
+        """Yield the (step start, sum, count) of the steps held between start
+        and end"""
+        first = max(int(start // self.step), int(self.first(now) // self.step))
+        last = int(min(end, now) // self.step)
+        for step in xrange(first, last + 1):
+            slot = step % self.size
+            if self.steps[slot] == step:
+                yield step * self.step, self.sums[slot], self.counts[slot]
+
+class TimeSeries(object):
+    """Values of a metric, kept in an Archive for each resolution"""
+
+    def __init__(self, archives=ARCHIVES):
+        self.archives = [ Archive(step, size) for step, size in sorted(archives) ]
+        self.last_update = None
+
+    def add(self, value, now):
+        self.last_update = now
+        for archive in self.archives:
+            archive.add(value, now)
+
+    def query(self, start, end, step, now):
+        """Return the [time, average] of the values between start and end,
+        over each step seconds.
+
+        The values come from the finest archive holding start, among those
+        not coarser than step. If none holds start, the coarsest of them is
+        used.
+
+        @param step Seconds each point sums up, or None for the step of the
+                    archive
+
+        @return The list of points, without those having no value
+        """
+        candidates = [ archive for archive in self.archives
+                       if step is None or archive.step <= step ]
+        candidates = candidates or self.archives[:1]
+
+        archive = candidates[-1]
+        for candidate in candidates:
+            if candidate.first(now) <= start:
+                archive = candidate
+                break
+
+        if step is None:
+            step = archive.step
+
+        buckets = {}
+        for point, total, count in archive.points(start, end, now):
+            bucket = int(point // step) * step
+            total_before, count_before = buckets.get(bucket, (0, 0))
+            buckets[bucket] = (total_before + total, count_before + count)
+
+        return [ [ bucket, total / count ]
+                 for bucket, (total, count) in sorted(buckets.items()) ]
+
+class TimeSeriesStore(object):
+    """Thread-safe set of TimeSeries, indexed by metric name"""
+
+    def __init__(self, archives=ARCHIVES, max_series=MAX_SERIES):
+        self.archives = archives
+        self.max_series = max_series
+        self.series = {}
+        self.lock = Lock()
+
+        # Seconds after which a series not updated holds no value any more
+        self.retention = max(step * size for step, size in archives)
+        # Expired series are looked for at most once per finest step
+        self.expiry_step = min(step for step, _ in archives)
+        self.next_expiry = 0
+
+    def add(self, values, now=None):
+        """Record values, a {metric name: value} dictionary, at time now.
+
+        When there are max_series metrics already, the one updated least
+        recently is dropped to make room for a new one, unless it was
+        updated at now too.
+
+        @return The names of the metrics ignored, there being too many
+        """
+        if now is None:
+            now = time.time()
+
+        ignored = []
+        with self.lock:
+            if now >= self.next_expiry:
+                self._expire(now)
+                self.next_expiry = now + self.expiry_step
+
+            # Known metrics first, so that they are not dropped for new ones
+            known = lambda item: item[0] not in self.series
+            for name, value in sorted(values.items(), key=known):
+                if name not in self.series:
+                    if (len(self.series) >= self.max_series and
+                        not self._drop_least_recent(now)):
+                        ignored.append(name)
+                        continue
+                    self.series[name] = TimeSeries(self.archives)
+                self.series[name].add(value, now)
+        return ignored
+
+    def _expire(self, now):
+        """Drop the series not updated for longer than retention"""
+        for name, series in self.series.items():
+            if series.last_update < now - self.retention:
+                del self.series[name]
+
+    def _drop_least_recent(self, now):
+        """Drop the series updated least recently, unless it was updated at
+        now. Return True if one was dropped."""
+        if not self.series:
+            return False
+
+        name = min(self.series, key=lambda name: self.series[name].last_update)
+        if self.series[name].last_update >= now:
+            return False
+
+        del self.series[name]
+        return True
+
+    def names(self):
+        with self.lock:
+            return sorted(self.series.keys())
+
+    def query(self, names, start, end, step=None, now=None):
+        """Return the values of the given metrics between start and end, as
+        returned by TimeSeries.query, in a {metric name: points}
+        dictionary. Unknown metrics have no points."""
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            return dict((name, self.series[name].query(start, end, step, now)
+                               if name in self.series else [])
+                        for name in names)
@@ -8,7 +8,6 @@ import httplib, json
 import sys
 
 from conpaas.core import https
-from conpaas.core.misc import file_get_contents
 
 class ManagerException(Exception): pass
 
@@ -89,8 +88,14 @@ def get_service_performance(host, port):
 
 def load_dump(host, port, mysqldump_path):
     params = {'method': 'load_dump'}
-    files = [('mysqldump_file', mysqldump_path, file_get_contents(mysqldump_path))]
-    return _check(https.client.https_post(host, port, '/', params, files=files))
+    f = open(mysqldump_path, 'r')
+    try:
+        # The dump is read while it is being sent
+        files = [('mysqldump_file', mysqldump_path, f)]
+        return _check(https.client.https_post(host, port, '/', params,
+                                              files=files))
+    finally:
+        f.close()
 
 if __name__ == '__main__':
     if sys.argv.__len__() in (4, 5):
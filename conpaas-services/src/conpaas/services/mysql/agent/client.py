@@ -72,10 +72,13 @@ def check_agent_process(host, port):
 def load_dump(host, port, mysqldump_path):
     params = {'method': 'load_dump'}
     f = open(mysqldump_path, 'r')
-    filecontent = f.read() 
-    f.close()
-    files = [('mysqldump_file', mysqldump_path, filecontent)]
-    return _check(https.client.https_post(host, port, '/', params, files=files))
+    try:
+        # The dump is read while it is being sent
+        files = [('mysqldump_file', mysqldump_path, f)]
+        return _check(https.client.https_post(host, port, '/', params,
+                                              files=files))
+    finally:
+        f.close()
 
 
 '''
@@ -93,7 +96,10 @@ def setup_slave(host, port, slave_server_id, master_host, \
         'slave_server_id': slave_server_id
     }
     f = open(mysqldump_path, 'r')
-    filecontent = f.read() 
-    f.close()
-    files = [('mysqldump_file', mysqldump_path, filecontent)]
-    return _check(https.client.https_post(host, port, '/', params, files=files))
+    try:
+        # The dump is read while it is being sent
+        files = [('mysqldump_file', mysqldump_path, f)]
+        return _check(https.client.https_post(host, port, '/', params,
+                                              files=files))
+    finally:
+        f.close()
@@ -67,14 +67,12 @@ class MySQLManager(BaseManager):
         self.state = self.S_RUNNING
 
     def _start_master(self, nodes):
-        for serviceNode in nodes:
-            try:
-                client.create_master(serviceNode.ip, self.config.AGENT_PORT,
-                                    self._get_server_id())
-            except client.AgentException:
-                self.logger.exception('Failed to start MySQL Master at node %s' % str(serviceNode))
-                self.state = self.S_ERROR
-                raise
+        server_ids = dict([ (serviceNode.id, self._get_server_id())
+                            for serviceNode in nodes ])
+        self._call_nodes(lambda serviceNode: client.create_master(
+                             serviceNode.ip, self.config.AGENT_PORT,
+                             server_ids[serviceNode.id]),
+                         nodes, 'Failed to start MySQL Master')
 
     def _start_slave(self, nodes, master):
         slaves = {}
@@ -281,8 +279,10 @@ class MySQLManager(BaseManager):
 
         #TODO: modify this when multiple masters
         try:
-            for master in masters:
-                client.set_password(master.ip, self.config.AGENT_PORT, kwargs['user'], kwargs['password'])
+            self._call_nodes(lambda master: client.set_password(
+                                 master.ip, self.config.AGENT_PORT,
+                                 kwargs['user'], kwargs['password']),
+                             masters, 'Failed to set password')
         except:
             self.logger.exception('set_password: Could not set password')
             self.state = self.S_ERROR
@@ -316,8 +316,9 @@ class MySQLManager(BaseManager):
         # TODO: modify this when multiple masters
         masters = self.config.getMySQLmasters()
         try:
-            for master in masters:
-                client.load_dump(master.ip, self.config.AGENT_PORT, filename)
+            self._call_nodes(lambda master: client.load_dump(
+                                 master.ip, self.config.AGENT_PORT, filename),
+                             masters, 'Failed to load dump')
         except:
             self.logger.exception('load_dump: could not upload mysqldump_file ')
             self.state = self.S_ERROR
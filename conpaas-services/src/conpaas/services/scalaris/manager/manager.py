@@ -90,8 +90,8 @@ class ScalarisManager(BaseManager):
             self.logger.info('Create nodes: %s', node_instances)
             self.nodes += node_instances
             # Startup agents
-            for node in node_instances:
-                client.startup(node.ip, 5555, node.ip)
+            self._call_nodes(lambda node: client.startup(node.ip, 5555, node.ip),
+                             node_instances, 'Failed to start scalaris')
             self.state = self.S_RUNNING
             self.logger.info('Started nodes: %d %s', count, self.state)
         except HttpError as e:
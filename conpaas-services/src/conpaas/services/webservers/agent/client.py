@@ -7,7 +7,6 @@
 import httplib, json
 
 from conpaas.core import https
-from conpaas.core.misc import file_get_contents
 
 
 class AgentException(Exception): pass
@@ -20,20 +19,42 @@ def _check(response):
   if data['error']: raise AgentException(data['error'])
   else: return True
 
-def createWebServer(host, port, web_port, code_versions):
-  method = 'createWebServer'
-  params = {
+def _check_batch(response):
+  code, body = response
+  if code != httplib.OK: raise AgentException('Received http response code %d' % (code))
+  try: responses = json.loads(body)
+  except Exception as e: raise AgentException(*e.args)
+  for data in responses:
+    if data['error']: raise AgentException(data['error'])
+  return True
+
+def _web_server_params(web_port, code_versions):
+  return {
     'port': web_port,
     'code_versions': code_versions,
   }
+
+def _http_proxy_params(proxy_port, code_version, cdn=False, web_list=[], fpm_list=[], tomcat_list=[], tomcat_servlets=[]):
+  params = {
+    'port': proxy_port,
+    'code_version': code_version,
+  }
+  if web_list: params['web_list'] = web_list
+  if fpm_list: params['fpm_list'] = fpm_list
+  if tomcat_list: params['tomcat_list'] = tomcat_list
+  if tomcat_servlets: params['tomcat_servlets'] = tomcat_servlets
+  if cdn:
+    params['cdn'] = cdn
+  return params
+
+def createWebServer(host, port, web_port, code_versions):
+  method = 'createWebServer'
+  params = _web_server_params(web_port, code_versions)
   return _check(https.client.jsonrpc_post(host, port, '/', method, params=params))
 
 def updateWebServer(host, port, web_port, code_versions):
   method = 'updateWebServer'
-  params = {
-    'port': web_port,
-    'code_versions': code_versions,
-  }
+  params = _web_server_params(web_port, code_versions)
   return _check(https.client.jsonrpc_post(host, port, '/', method, params=params))
 
 def stopWebServer(host, port):
@@ -46,32 +67,30 @@ def getHttpProxyState(host, port):
 
 def createHttpProxy(host, port, proxy_port, code_version, cdn=False, web_list=[], fpm_list=[], tomcat_list=[], tomcat_servlets=[]):
   method = 'createHttpProxy'
-  params = {
-    'port': proxy_port,
-    'code_version': code_version,
-  }
-  if web_list: params['web_list'] = web_list
-  if fpm_list: params['fpm_list'] = fpm_list
-  if tomcat_list: params['tomcat_list'] = tomcat_list
-  if tomcat_servlets: params['tomcat_servlets'] = tomcat_servlets
-  if cdn:
-    params['cdn'] = cdn
+  params = _http_proxy_params(proxy_port, code_version, cdn, web_list, fpm_list, tomcat_list, tomcat_servlets)
   return _check(https.client.jsonrpc_post(host, port, '/', method, params=params))
 
 def updateHttpProxy(host, port, proxy_port, code_version, cdn=False, web_list=[], fpm_list=[], tomcat_list=[], tomcat_servlets=[]):
   method = 'updateHttpProxy'
-  params = {
-    'port': proxy_port,
-    'code_version': code_version,
-  }
-  if web_list: params['web_list'] = web_list
-  if fpm_list: params['fpm_list'] = fpm_list
-  if tomcat_list: params['tomcat_list'] = tomcat_list
-  if tomcat_servlets: params['tomcat_servlets'] = tomcat_servlets
-  if cdn:
-    params['cdn'] = cdn
+  params = _http_proxy_params(proxy_port, code_version, cdn, web_list, fpm_list, tomcat_list, tomcat_servlets)
   return _check(https.client.jsonrpc_post(host, port, '/', method, params=params))
 
+def createWebServerAndHttpProxy(host, port, web_port, code_versions, proxy_port, code_version, **kwargs):
+  '''createWebServer and createHttpProxy in a single request'''
+  calls = [
+    ('createWebServer', _web_server_params(web_port, code_versions)),
+    ('createHttpProxy', _http_proxy_params(proxy_port, code_version, **kwargs)),
+  ]
+  return _check_batch(https.client.jsonrpc_batch(host, port, '/', calls))
+
+def updateWebServerAndHttpProxy(host, port, web_port, code_versions, proxy_port, code_version, **kwargs):
+  '''updateWebServer and updateHttpProxy in a single request'''
+  calls = [
+    ('updateWebServer', _web_server_params(web_port, code_versions)),
+    ('updateHttpProxy', _http_proxy_params(proxy_port, code_version, **kwargs)),
+  ]
+  return _check_batch(https.client.jsonrpc_batch(host, port, '/', calls))
+
 def stopHttpProxy(host, port):
   method = 'stopHttpProxy'
   return _check(https.client.jsonrpc_post(host, port, '/', method))
@@ -114,9 +133,14 @@ def updatePHPCode(host, port, codeVersionId, filetype, filepath):
   }
 
   if filetype != 'git':
-    # File-based code uploads
-    files = [('file', filepath, file_get_contents(filepath))]
-    return _check(https.client.https_post(host, port, '/', params, files=files))
+    # File-based code uploads are read while they are being sent
+    f = open(filepath)
+    try:
+      files = [('file', filepath, f)]
+      return _check(https.client.https_post(host, port, '/', params,
+                                            files=files))
+    finally:
+      f.close()
 
   # git-based code uploads do not need a FileUploadField.  
   # Pass filepath as a dummy value for the 'file' parameter.
@@ -146,9 +170,14 @@ def updateTomcatCode(host, port, codeVersionId, filetype, filepath):
   }
 
   if filetype != 'git':
-    # File-based code uploads 
-    files = [('file', filepath, file_get_contents(filepath))]
-    return _check(https.client.https_post(host, port, '/', params, files=files))
+    # File-based code uploads are read while they are being sent
+    f = open(filepath)
+    try:
+      files = [('file', filepath, f)]
+      return _check(https.client.https_post(host, port, '/', params,
+                                            files=files))
+    finally:
+      f.close()
 
   # git-based code uploads do not need a FileUploadField.  
   # Pass filepath as a dummy value for the 'file' parameter.
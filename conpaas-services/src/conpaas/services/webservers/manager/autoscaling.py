@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+    conpaas.services.webservers.manager.autoscaling
+    ===============================================
+
+    ConPaaS Web Hosting Service manager: automatic scaling of the proxy,
+    web and backend roles, driven by the metrics the agents report to
+    Ganglia.
+
+    :copyright: (C) 2010-2013 by Contrail Consortium.
+"""
+
+import time
+from threading import Thread, Event
+
+from conpaas.core import ganglia
+from conpaas.core.log import create_logger
+from conpaas.services.webservers.manager.performance import ROLES, role_metrics
+
+# Number of scaling actions remembered for get_autoscaling
+HISTORY_SIZE = 50
+
+class ScalingPolicy(object):
+  """Service level objective on the response time of a role.
+
+  A node is added when the response time stays above max_response_time for
+  breach_periods evaluations in a row, and one is removed when it stays
+  below min_response_time as long. The gap between the two thresholds and
+  the number of periods keep the role from oscillating. No node is added or
+  removed for cooldown seconds after a change."""
+
+  def __init__(self, role, max_response_time, min_response_time=None,
+               min_nodes=1, max_nodes=10, breach_periods=3, cooldown=600):
+    if role not in ROLES:
+      raise ValueError('Unknown role: %s' % role)
+
+    self.role = role
+    self.max_response_time = float(max_response_time)
+    if min_response_time is None:
+      self.min_response_time = self.max_response_time / 2
+    else:
+      self.min_response_time = float(min_response_time)
+    self.min_nodes = int(min_nodes)
+    self.max_nodes = int(max_nodes)
+    self.breach_periods = int(breach_periods)
+    self.cooldown = float(cooldown)
+
+    if self.min_response_time >= self.max_response_time:
+      raise ValueError('min_response_time must be lower than max_response_time')
+    if self.min_nodes < 0 or self.min_nodes > self.max_nodes:
+      raise ValueError('Expected 0 <= min_nodes <= max_nodes')
+
+    # Evaluations in a row above/below the thresholds
+    self.above = 0
+    self.below = 0
+    self.last_change = 0
+
+  def decide(self, metrics, count, now):
+    """Account for the latest metrics of the role.
+
+    @param metrics The metrics of the role, as returned by role_metrics
+    @param count The number of nodes of the role
+    @param now The current time
+
+    @return 1 to add a node, -1 to remove one, 0 otherwise
+    """
+    if not metrics['reporting']:
+      # No data is not good data
+      self.above = self.below = 0
+      return 0
+
+    response_time = metrics['response_time']
+    if response_time > self.max_response_time:
+      self.above += 1
+      self.below = 0
+    elif response_time < self.min_response_time:
+      self.below += 1
+      self.above = 0
+    else:
+      self.above = self.below = 0
+
+    if now - self.last_change < self.cooldown:
+      return 0
+    if self.above >= self.breach_periods and count < self.max_nodes:
+      return 1
+    if self.below >= self.breach_periods and count > self.min_nodes:
+      return -1
+    return 0
+
+  def changed(self, now):
+    """Record that a node was added or removed"""
+    self.last_change = now
+    self.above = self.below = 0
+
+  def to_dict(self):
+    return { 'role': self.role,
+             'max_response_time': self.max_response_time,
+             'min_response_time': self.min_response_time,
+             'min_nodes': self.min_nodes, 'max_nodes': self.max_nodes,
+             'breach_periods': self.breach_periods,
+             'cooldown': self.cooldown }
+
+def can_change(config, role, change):
+  """Return True if the number of nodes of role can change by change, under
+  the same rules as the add_nodes and remove_nodes calls"""
+  proxy, web, backend = [ getattr(config, r + '_count') + (change if r == role else 0)
+                          for r in ROLES ]
+  if min(proxy, web, backend) < 0:
+    return False
+
+  if change > 0:
+    return not (proxy > 1 and (web == 0 or backend == 0))
+
+  return proxy >= 1 and not (proxy > 1 and (web < 1 or backend < 1))
+
+class Autoscaler(Thread):
+  """Thread evaluating the scaling policies of a manager every interval
+  seconds, and adding or removing nodes accordingly.
+
+  One node is added or removed at a time, the manager being able to adapt
+  its deployment only once at a time. Adding capacity comes first."""
+
+  def __init__(self, manager, policies, cloud='default', interval=60,
+               read_metrics=ganglia.read_gmond_metrics):
+    """
+    @param manager The BasicWebserversManager to scale
+    @param policies A list of ScalingPolicy, at most one per role
+    @param cloud The name of the cloud to start new nodes in
+    @param interval Seconds between two evaluations
+    @param read_metrics Function returning the metrics of each host, as
+                        ganglia.read_gmond_metrics
+    """
+    Thread.__init__(self)
+    self.daemon = True
+
+    self.logger = create_logger(__name__)
+    self.manager = manager
+    self.policies = dict((policy.role, policy) for policy in policies)
+    self.cloud = cloud
+    self.interval = interval
+    self.read_metrics = read_metrics
+
+    self.metrics = {}
+    self.history = []
+    self._stopped = Event()
+
+  def evaluate(self, now=None):
+    """Collect the metrics once and act on the decisions of the policies.
+
+    The state and the configuration of the manager are checked and changed
+    holding its update_lock, like its POST methods do. The nodes are then
+    added or removed without it.
+
+    @return The (role, change) made, change being 1 or -1, or None
+    """
+    if now is None:
+      now = time.time()
+
+    try:
+      hosts = self.read_metrics()
+    except Exception:
+      self.logger.exception('Autoscaling: failed to read the metrics')
+      return
+
+    with self.manager.update_lock:
+      config = self.manager._configuration_get()
+      self.metrics = role_metrics(config, hosts)
+
+      decisions = []
+      for role in ROLES:
+        if role in self.policies:
+          count = getattr(config, role + '_count')
+          change = self.policies[role].decide(self.metrics[role], count, now)
+          if change and can_change(config, role, change):
+            decisions.append((change, role))
+      if not decisions:
+        return
+
+      if self.manager._state_get() != self.manager.S_RUNNING:
+        self.logger.debug('Autoscaling: not running, leaving %s alone' % decisions)
+        return
+
+      change, role = max(decisions)
+      self.policies[role].changed(now)
+      self._adapt(role, change, now)
+
+    self._scale(config, role, change)
+    return role, change
+
+  def _adapt(self, role, change, now):
+    """Record the change and put the manager in ADAPTING state"""
+    reason = 'response time %.1f ms' % self.metrics[role]['response_time']
+    self.history = self.history[-(HISTORY_SIZE - 1):] + [
+      { 'time': now, 'role': role, 'change': change, 'reason': reason } ]
+
+    if change > 0:
+      self.manager._state_set(self.manager.S_ADAPTING,
+        msg='Autoscaling: adding a %s node, %s' % (role, reason))
+    else:
+      self.manager._state_set(self.manager.S_ADAPTING,
+        msg='Autoscaling: removing a %s node, %s' % (role, reason))
+
+  def _scale(self, config, role, change):
+    counts = dict((r, 0) for r in ROLES)
+    counts[role] = 1
+
+    if change > 0:
+      self.manager.do_add_nodes(config, counts['proxy'], counts['web'],
+                                counts['backend'], self.cloud)
+    else:
+      self.manager.do_remove_nodes(config, counts['proxy'], counts['web'],
+                                   counts['backend'])
+
+  def run(self):
+    while not self._stopped.wait(self.interval):
+      try:
+        self.evaluate()
+      except Exception:
+        self.logger.exception('Autoscaling: evaluation failed')
+
+  def stop(self):
+    self._stopped.set()
+
+  def to_dict(self):
+    return { 'interval': self.interval, 'cloud': self.cloud,
+             'policies': [ policy.to_dict() for policy in self.policies.values() ],
+             'metrics': self.metrics, 'history': self.history }
@@ -9,6 +9,8 @@ import memcache, tempfile, os, os.path, time
 
 from conpaas.services.webservers.agent import client
 from conpaas.services.webservers.manager.config import WebServiceNode, CodeVersion
+from conpaas.services.webservers.manager.autoscaling import Autoscaler, ScalingPolicy
+from conpaas.services.webservers.manager.performance import PerformanceMonitor
 from conpaas.services.webservers.misc import archive_open, archive_get_members, archive_close,\
   archive_get_type
 from conpaas.core.https.server import HttpJsonResponse, HttpErrorResponse,\
@@ -16,6 +18,7 @@ from conpaas.core.https.server import HttpJsonResponse, HttpErrorResponse,\
 from conpaas.core.expose import expose
 from conpaas.core.manager import BaseManager
 from conpaas.core.manager import ManagerException
+from conpaas.core.https import fanout
 
 from conpaas.core import git
 
@@ -35,6 +38,9 @@ class BasicWebserversManager(BaseManager):
 
     self.code_repo = config_parser.get('manager', 'CODE_REPO') 
     self.state_log = []
+    self.autoscaler = None
+    self.monitor = PerformanceMonitor(self)
+    self.monitor.start()
      
   def _state_get(self):
     return self.memcache.get(self.DEPLOYMENT_STATE)
@@ -43,6 +49,10 @@ class BasicWebserversManager(BaseManager):
     self.memcache.set(self.DEPLOYMENT_STATE, target_state)
     self.state_log.append({'time': time.time(), 'state': target_state, 'reason': msg})
     self.logger.debug('STATE %s: %s' % (target_state, msg))
+    self._notify_state_changed()
+
+  def _get_current_state(self):
+    return self._state_get()
   
   def _configuration_get(self):
     return self.memcache.get(self.CONFIG)
@@ -56,50 +66,81 @@ class BasicWebserversManager(BaseManager):
   def _adapting_get_count(self):
     return self.memcache.get('adapting_count')
   
+  def _call_nodes(self, call, nodes, failure):
+    outcome = fanout.call_nodes(call, nodes)
+    if outcome.errors:
+      outcome.log_errors(self.logger, failure)
+      self._state_set(self.S_ERROR, msg='%s at node %s' % (failure, str(outcome.errors[0][0])))
+      outcome.check()
+    return outcome.results
+  
   def _stop_proxy(self, config, nodes):
-    for serviceNode in nodes:
-      try: client.stopHttpProxy(serviceNode.ip, 5555)
-      except client.AgentException:
-          self.logger.exception('Failed to stop proxy at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to stop proxy at node %s' % str(serviceNode))
-          raise
+    self._call_nodes(lambda serviceNode: client.stopHttpProxy(serviceNode.ip, 5555),
+                     nodes, 'Failed to stop proxy')
 
-  def _start_web(self, config, nodes):
+  def _get_code_versions(self, config):
     if config.prevCodeVersion == None:
-      code_versions = [config.currentCodeVersion]
+      return [config.currentCodeVersion]
     else:
-      code_versions = [config.currentCodeVersion, config.prevCodeVersion]
-    for serviceNode in nodes:
-      try:
-        client.createWebServer(serviceNode.ip, 5555,
-                               config.web_config.port,
-                               code_versions)
-      except client.AgentException:
-          self.logger.exception('Failed to start web at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to start web at node %s' % str(serviceNode))
-          raise
+      return [config.currentCodeVersion, config.prevCodeVersion]
+  
+  def _get_packed_nodes(self, config, webNodes, proxyNodes):
+    # proxies are only started once there is some code to serve
+    if config.currentCodeVersion == None:
+      return []
+    return [ node for node in webNodes if node in proxyNodes ]
+  
+  def _start_web(self, config, nodes):
+    code_versions = self._get_code_versions(config)
+    self._call_nodes(lambda serviceNode: client.createWebServer(serviceNode.ip, 5555,
+                                                                config.web_config.port,
+                                                                code_versions),
+                     nodes, 'Failed to start web')
   
   def _update_web(self, config, nodes):
-    if config.prevCodeVersion == None:
-      code_versions = [config.currentCodeVersion]
-    else:
-      code_versions = [config.currentCodeVersion, config.prevCodeVersion]
-    for webNode in nodes:
-        try: client.updateWebServer(webNode.ip, 5555,
-                                    config.web_config.port,
-                                    code_versions)
-        except client.AgentException:
-          self.logger.exception('Failed to update web at node %s' % str(webNode))
-          self._state_set(self.S_ERROR, msg='Failed to update web at node %s' % str(webNode))
-          raise
+    code_versions = self._get_code_versions(config)
+    self._call_nodes(lambda webNode: client.updateWebServer(webNode.ip, 5555,
+                                                            config.web_config.port,
+                                                            code_versions),
+                     nodes, 'Failed to update web')
+  
+  def _start_web_and_proxy(self, config, webNodes, proxyNodes):
+    '''Start web servers on webNodes, then proxies on proxyNodes.
+    Nodes running both get both orders in a single request.'''
+    packed = self._get_packed_nodes(config, webNodes, proxyNodes)
+    self._start_web(config, [ node for node in webNodes if node not in packed ])
+    if packed:
+      code_versions = self._get_code_versions(config)
+      proxy_kwargs = self._get_proxy_kwargs(config)
+      self._call_nodes(lambda serviceNode: client.createWebServerAndHttpProxy(serviceNode.ip, 5555,
+                                                                              config.web_config.port,
+                                                                              code_versions,
+                                                                              config.proxy_config.port,
+                                                                              config.currentCodeVersion,
+                                                                              **proxy_kwargs),
+                       packed, 'Failed to start web and proxy')
+    self._start_proxy(config, [ node for node in proxyNodes if node not in packed ])
+  
+  def _update_web_and_proxy(self, config, webNodes, proxyNodes):
+    '''Update web servers on webNodes, then proxies on proxyNodes.
+    Nodes running both get both orders in a single request.'''
+    packed = self._get_packed_nodes(config, webNodes, proxyNodes)
+    self._update_web(config, [ node for node in webNodes if node not in packed ])
+    if packed:
+      code_versions = self._get_code_versions(config)
+      proxy_kwargs = self._get_proxy_kwargs(config)
+      self._call_nodes(lambda serviceNode: client.updateWebServerAndHttpProxy(serviceNode.ip, 5555,
+                                                                              config.web_config.port,
+                                                                              code_versions,
+                                                                              config.proxy_config.port,
+                                                                              config.currentCodeVersion,
+                                                                              **proxy_kwargs),
+                       packed, 'Failed to update web and proxy')
+    self._update_proxy(config, [ node for node in proxyNodes if node not in packed ])
   
   def _stop_web(self, config, nodes):
-    for serviceNode in nodes:
-      try: client.stopWebServer(serviceNode.ip, 5555)
-      except client.AgentException:
-          self.logger.exception('Failed to stop web at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to stop web at node %s' % str(serviceNode))
-          raise
+    self._call_nodes(lambda serviceNode: client.stopWebServer(serviceNode.ip, 5555),
+                     nodes, 'Failed to stop web')
   
   @expose('POST')
   def startup(self, kwargs):
@@ -145,6 +186,7 @@ class BasicWebserversManager(BaseManager):
       return HttpErrorResponse(ManagerException(ManagerException.E_STATE_ERROR).message)
     
     config = self._configuration_get()
+    self._stop_autoscaler()
     self._state_set(self.S_EPILOGUE, msg='Shutting down')
     Thread(target=self.do_shutdown, args=[config]).start()
     return HttpJsonResponse({'state': self.S_EPILOGUE})
@@ -188,11 +230,9 @@ class BasicWebserversManager(BaseManager):
     if config.currentCodeVersion != None:
       self._update_code(config, config.serviceNodes.values())
     
-    # issue orders to agents to start web servers inside
-    self._start_web(config, config.getWebServiceNodes())
-    
-    # issue orders to agents to start proxy inside
-    self._start_proxy(config, config.getProxyServiceNodes())
+    # issue orders to agents to start web servers and proxy inside
+    self._start_web_and_proxy(config, config.getWebServiceNodes(),
+                              config.getProxyServiceNodes())
     
     self._configuration_set(config) # update configuration
     self._state_set(self.S_RUNNING)
@@ -298,8 +338,9 @@ class BasicWebserversManager(BaseManager):
     if config.currentCodeVersion != None:
       self._update_code(config, [ node for node in newNodes if node not in config.serviceNodes ])
     
-    self._start_web(config, [ node for node in newNodes if node.isRunningWeb ])
-    self._start_proxy(config, [ node for node in newNodes if node.isRunningProxy ])
+    self._start_web_and_proxy(config,
+                              [ node for node in newNodes if node.isRunningWeb ],
+                              [ node for node in newNodes if node.isRunningProxy ])
     
     # update services
     if webNodesNew or backendNodesNew:
@@ -567,15 +608,83 @@ class BasicWebserversManager(BaseManager):
 
   @expose('GET')
   def get_service_performance(self, kwargs):
+    """Return the performance of the service over the last 'window'
+    seconds (300 by default): the request rate, server error rate and
+    throughput in bytes/s seen by the proxies, and the median response time
+    of their requests. 'roles' details it for each role, with the 50th, 90th,
+    95th and 99th response time percentiles and the maximum, over the
+    requests of all its nodes."""
+    window = 300
+    if 'window' in kwargs:
+      if not isinstance(kwargs['window'], int):
+        return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_INVALID, detail='Expected an integer value for "window"').message)
+      window = int(kwargs.pop('window'))
+      if window <= 0 or window > max(self.monitor.performance.windows):
+        return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_INVALID, detail='Expected a "window" of at most %d seconds' % max(self.monitor.performance.windows)).message)
     if len(kwargs) != 0:
       return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_UNEXPECTED, kwargs.keys()).message)
+    
+    roles = self.monitor.performance.summary(window, time.time())
     return HttpJsonResponse({
-            'request_rate': 0,
-            'error_rate': 0,
-            'throughput': 0,
-            'response_time': 0,
+            'request_rate': roles['proxy']['request_rate'],
+            'error_rate': roles['proxy']['error_rate'],
+            'throughput': roles['proxy']['throughput'],
+            'response_time': roles['proxy']['response_time']['p50'],
+            'window': window,
+            'roles': roles,
             })
 
+  @expose('POST')
+  def enable_autoscaling(self, kwargs):
+    """Start adding and removing nodes automatically, according to the
+    response time of each role. Replaces the current policies, if any.
+
+    kwargs must contain 'policies', a {role: parameters} dictionary whose
+    parameters are those of ScalingPolicy, and may contain the 'interval'
+    in seconds between two evaluations and the 'cloud' to start nodes in."""
+    dstate = self._state_get()
+    if dstate != self.S_RUNNING:
+      return HttpErrorResponse(ManagerException(ManagerException.E_STATE_ERROR).message)
+    if 'policies' not in kwargs:
+      return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_MISSING, 'policies').message)
+    
+    try:
+      policies = [ ScalingPolicy(role, **params) for role, params in kwargs.pop('policies').items() ]
+      interval = float(kwargs.pop('interval', 60))
+    except (AttributeError, TypeError, ValueError), err:
+      return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_INVALID, detail=str(err)).message)
+    if not policies or interval <= 0:
+      return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_INVALID, detail='Expected at least one policy and a positive interval').message)
+    
+    cloud = kwargs.pop('cloud', 'default')
+    if len(kwargs) != 0:
+      return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_UNEXPECTED, kwargs.keys()).message)
+    
+    self._stop_autoscaler()
+    self.autoscaler = Autoscaler(self, policies, cloud, interval)
+    self.autoscaler.start()
+    return HttpJsonResponse(self.autoscaler.to_dict())
+  
+  @expose('POST')
+  def disable_autoscaling(self, kwargs):
+    if len(kwargs) != 0:
+      return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_UNEXPECTED, kwargs.keys()).message)
+    self._stop_autoscaler()
+    return HttpJsonResponse()
+  
+  @expose('GET')
+  def get_autoscaling(self, kwargs):
+    if len(kwargs) != 0:
+      return HttpErrorResponse(ManagerException(ManagerException.E_ARGS_UNEXPECTED, kwargs.keys()).message)
+    if self.autoscaler is None:
+      return HttpJsonResponse({'enabled': False})
+    return HttpJsonResponse(dict(self.autoscaler.to_dict(), enabled=True))
+  
+  def _stop_autoscaler(self):
+    if self.autoscaler is not None:
+      self.autoscaler.stop()
+      self.autoscaler = None
+  
   @expose('POST')
   def git_push_hook(self, kwargs):
     if len(kwargs) != 0:
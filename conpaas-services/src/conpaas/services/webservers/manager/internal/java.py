@@ -27,77 +27,59 @@ class JavaManager(BasicWebserversManager):
       self._create_initial_configuration()
   
   def _update_code(self, config, nodes):
-    for serviceNode in nodes:
+    codeVersion = config.codeVersions[config.currentCodeVersion]
+    
+    def update_code(serviceNode):
       # Push the current code version via GIT if necessary
-      if config.codeVersions[config.currentCodeVersion].type == 'git':
+      if codeVersion.type == 'git':
         _, err = git.git_push(git.DEFAULT_CODE_REPO, serviceNode.ip)
         if err:
           self.logger.debug('git-push to %s: %s' % (serviceNode.ip, err))
 
-      try:
-        if serviceNode.isRunningBackend:  ## UPLOAD TOMCAT CODE TO TOMCAT
-          client.updateTomcatCode(serviceNode.ip, 5555, config.currentCodeVersion, config.codeVersions[config.currentCodeVersion].type, os.path.join(self.code_repo, config.currentCodeVersion))
-        if serviceNode.isRunningProxy or serviceNode.isRunningWeb:
-          client.updatePHPCode(serviceNode.ip, 5555, config.currentCodeVersion, config.codeVersions[config.currentCodeVersion].type, os.path.join(self.code_repo, config.currentCodeVersion))
-      except client.AgentException:
-        self.logger.exception('Failed to update code at node %s' % str(serviceNode))
-        self._state_set(self.S_ERROR, msg='Failed to update code at node %s' % str(serviceNode))
-        return
+      if serviceNode.isRunningBackend:  ## UPLOAD TOMCAT CODE TO TOMCAT
+        client.updateTomcatCode(serviceNode.ip, 5555, config.currentCodeVersion, codeVersion.type, os.path.join(self.code_repo, config.currentCodeVersion))
+      if serviceNode.isRunningProxy or serviceNode.isRunningWeb:
+        client.updatePHPCode(serviceNode.ip, 5555, config.currentCodeVersion, codeVersion.type, os.path.join(self.code_repo, config.currentCodeVersion))
+    
+    try:
+      self._call_nodes(update_code, nodes, 'Failed to update code')
+    except client.AgentException:
+      return
+  
+  def _get_proxy_kwargs(self, config):
+    return {
+            'web_list': config.getWebTuples(),
+            'tomcat_list': config.getBackendTuples(),
+            'tomcat_servlets': self._get_servlet_urls(config.currentCodeVersion),
+            }
   
   def _start_proxy(self, config, nodes):
-    kwargs = {
-              'web_list': config.getWebTuples(),
-              'tomcat_list': config.getBackendTuples(),
-              'tomcat_servlets': self._get_servlet_urls(config.currentCodeVersion),
-              }
-    
-    for proxyNode in nodes:
-      try:
-        if config.currentCodeVersion != None:
-          client.createHttpProxy(proxyNode.ip, 5555,
-                                 config.proxy_config.port,
-                                 config.currentCodeVersion,
-                                 **kwargs)
-      except client.AgentException:
-          self.logger.exception('Failed to start proxy at node %s' % str(proxyNode))
-          self._state_set(self.S_ERROR, msg='Failed to start proxy at node %s' % str(proxyNode))
-          raise
+    if config.currentCodeVersion == None:
+      return
+    kwargs = self._get_proxy_kwargs(config)
+    self._call_nodes(lambda proxyNode: client.createHttpProxy(proxyNode.ip, 5555,
+                                                              config.proxy_config.port,
+                                                              config.currentCodeVersion,
+                                                              **kwargs),
+                     nodes, 'Failed to start proxy')
   
   def _update_proxy(self, config, nodes):
-    kwargs = {
-              'web_list': config.getWebTuples(),
-              'tomcat_list': config.getBackendTuples(),
-              'tomcat_servlets': self._get_servlet_urls(config.currentCodeVersion),
-              }
-    
-    for proxyNode in nodes:
-        try:
-          if config.currentCodeVersion != None:
-            client.updateHttpProxy(proxyNode.ip, 5555,
-                                 config.proxy_config.port,
-                                 config.currentCodeVersion,
-                                 **kwargs)
-        except client.AgentException:
-          self.logger.exception('Failed to update proxy at node %s' % str(proxyNode))
-          self._state_set(self.S_ERROR, msg='Failed to update proxy at node %s' % str(proxyNode))
-          raise
+    if config.currentCodeVersion == None:
+      return
+    kwargs = self._get_proxy_kwargs(config)
+    self._call_nodes(lambda proxyNode: client.updateHttpProxy(proxyNode.ip, 5555,
+                                                              config.proxy_config.port,
+                                                              config.currentCodeVersion,
+                                                              **kwargs),
+                     nodes, 'Failed to update proxy')
   
   def _start_backend(self, config, nodes):
-    for serviceNode in nodes:
-      try:
-        client.createTomcat(serviceNode.ip, 5555, config.backend_config.port)
-      except client.AgentException:
-          self.logger.exception('Failed to start Tomcat at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to start Tomcat at node %s' % str(serviceNode))
-          raise
+    self._call_nodes(lambda serviceNode: client.createTomcat(serviceNode.ip, 5555, config.backend_config.port),
+                     nodes, 'Failed to start Tomcat')
   
   def _stop_backend(self, config, nodes):
-    for serviceNode in nodes:
-      try: client.stopTomcat(serviceNode.ip, 5555)
-      except client.AgentException:
-          self.logger.exception('Failed to stop Tomcat at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to stop Tomcat at node %s' % str(serviceNode))
-          raise
+    self._call_nodes(lambda serviceNode: client.stopTomcat(serviceNode.ip, 5555),
+                     nodes, 'Failed to stop Tomcat')
   
   @expose('GET')
   def get_service_info(self, kwargs):
@@ -170,8 +152,8 @@ class JavaManager(BasicWebserversManager):
       config.prevCodeVersion = config.currentCodeVersion
       config.currentCodeVersion = codeVersionId
       self._update_code(config, config.serviceNodes.values())
-      self._update_web(config, config.getWebServiceNodes())
-      self._update_proxy(config, config.getProxyServiceNodes())
+      self._update_web_and_proxy(config, config.getWebServiceNodes(),
+                                 config.getProxyServiceNodes())
     
     self._state_set(self.S_RUNNING)
     self._configuration_set(config)
@@ -25,82 +25,57 @@ class PHPManager(BasicWebserversManager):
       self._register_scalaris(kwargs['scalaris'])
   
     def _update_code(self, config, nodes):
-      for serviceNode in nodes:
+      codeVersion = config.codeVersions[config.currentCodeVersion]
+    
+      def update_code(serviceNode):
         # Push the current code version via GIT if necessary
-        if config.codeVersions[config.currentCodeVersion].type == 'git':
+        if codeVersion.type == 'git':
           _, err = git.git_push(git.DEFAULT_CODE_REPO, serviceNode.ip)
           if err:
             self.logger.debug('git-push to %s: %s' % (serviceNode.ip, err))
         
-        try:
-          client.updatePHPCode(serviceNode.ip, 5555, config.currentCodeVersion, config.codeVersions[config.currentCodeVersion].type, os.path.join(self.code_repo, config.currentCodeVersion))
-        except client.AgentException:
-          self.logger.exception('Failed to update code at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to update code at node %s' % str(serviceNode))
-          raise
+        client.updatePHPCode(serviceNode.ip, 5555, config.currentCodeVersion, codeVersion.type, os.path.join(self.code_repo, config.currentCodeVersion))
+    
+      self._call_nodes(update_code, nodes, 'Failed to update code')
+  
+    def _get_proxy_kwargs(self, config):
+      return {
+              'web_list': config.getWebTuples(),
+              'fpm_list': config.getBackendTuples(),
+              'cdn': config.cdn,
+              }
   
     def _start_proxy(self, config, nodes):
-      kwargs = {
-                'web_list': config.getWebTuples(),
-                'fpm_list': config.getBackendTuples(),
-                'cdn': config.cdn,
-                }
-    
-      for proxyNode in nodes:
-        try:
-          if config.currentCodeVersion != None:
-            client.createHttpProxy(proxyNode.ip, 5555,
-                                   config.proxy_config.port,
-                                   config.currentCodeVersion,
-                                   **kwargs)
-        except client.AgentException:
-          self.logger.exception('Failed to start proxy at node %s' % str(proxyNode))
-          self._state_set(self.S_ERROR, msg='Failed to start proxy at node %s' % str(proxyNode))
-          raise
+      if config.currentCodeVersion == None:
+        return
+      kwargs = self._get_proxy_kwargs(config)
+      self._call_nodes(lambda proxyNode: client.createHttpProxy(proxyNode.ip, 5555,
+                                                                config.proxy_config.port,
+                                                                config.currentCodeVersion,
+                                                                **kwargs),
+                       nodes, 'Failed to start proxy')
   
     def _update_proxy(self, config, nodes):
-      kwargs = {
-                'web_list': config.getWebTuples(),
-                'fpm_list': config.getBackendTuples(),
-                'cdn': config.cdn
-                }
-    
-      for proxyNode in nodes:
-        try:
-          if config.currentCodeVersion != None:
-            client.updateHttpProxy(proxyNode.ip, 5555,
-                                   config.proxy_config.port,
-                                   config.currentCodeVersion,
-                                   **kwargs)
-        except client.AgentException:
-          self.logger.exception('Failed to update proxy at node %s' % str(proxyNode))
-          self._state_set(self.S_ERROR, msg='Failed to update proxy at node %s' % str(proxyNode))
-          raise
+      if config.currentCodeVersion == None:
+        return
+      kwargs = self._get_proxy_kwargs(config)
+      self._call_nodes(lambda proxyNode: client.updateHttpProxy(proxyNode.ip, 5555,
+                                                                config.proxy_config.port,
+                                                                config.currentCodeVersion,
+                                                                **kwargs),
+                       nodes, 'Failed to update proxy')
   
     def _start_backend(self, config, nodes):
-      for serviceNode in nodes:
-        try:
-          client.createPHP(serviceNode.ip, 5555, config.backend_config.port, config.backend_config.scalaris, config.backend_config.php_conf.conf)
-        except client.AgentException:
-          self.logger.exception('Failed to start php at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to start php at node %s' % str(serviceNode))
-          raise
+      self._call_nodes(lambda serviceNode: client.createPHP(serviceNode.ip, 5555, config.backend_config.port, config.backend_config.scalaris, config.backend_config.php_conf.conf),
+                       nodes, 'Failed to start php')
   
     def _update_backend(self, config, nodes):
-      for serviceNode in nodes:
-        try: client.updatePHP(serviceNode.ip, 5555, config.backend_config.port, config.backend_config.scalaris, config.backend_config.php_conf.conf)
-        except client.AgentException:
-          self.logger.exception('Failed to update php at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to update php at node %s' % str(serviceNode))
-          raise
+      self._call_nodes(lambda serviceNode: client.updatePHP(serviceNode.ip, 5555, config.backend_config.port, config.backend_config.scalaris, config.backend_config.php_conf.conf),
+                       nodes, 'Failed to update php')
   
     def _stop_backend(self, config, nodes):
-      for serviceNode in nodes:
-        try: client.stopPHP(serviceNode.ip, 5555)
-        except client.AgentException:
-          self.logger.exception('Failed to stop php at node %s' % str(serviceNode))
-          self._state_set(self.S_ERROR, msg='Failed to stop php at node %s' % str(serviceNode))
-          raise
+      self._call_nodes(lambda serviceNode: client.stopPHP(serviceNode.ip, 5555),
+                       nodes, 'Failed to stop php')
   
     @expose('GET')
     def get_service_info(self, kwargs):
@@ -171,8 +146,8 @@ class PHPManager(BasicWebserversManager):
         self.prevCodeVersion = config.currentCodeVersion
         config.currentCodeVersion = codeVersionId
         self._update_code(config, config.serviceNodes.values())
-        self._update_web(config, config.getWebServiceNodes())
-        self._update_proxy(config, config.getProxyServiceNodes())
+        self._update_web_and_proxy(config, config.getWebServiceNodes(),
+                                   config.getProxyServiceNodes())
       self._state_set(self.S_RUNNING)
       self._configuration_set(config)
   
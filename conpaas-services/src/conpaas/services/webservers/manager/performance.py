@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""
+    conpaas.services.webservers.manager.performance
+    ===============================================
+
+    ConPaaS Web Hosting Service manager: performance of the proxy, web and
+    backend roles, from the metrics the agents report to Ganglia.
+
+    The response time percentiles of a role come from the histograms the
+    agents publish, merged over its nodes: they are those of all its
+    requests, not averages of the percentiles of each node.
+
+    :copyright: (C) 2010-2013 by Contrail Consortium.
+"""
+
+import time
+from collections import deque
+from threading import Thread, Event, Lock
+
+from conpaas.core import ganglia
+from conpaas.core import histogram
+from conpaas.core.log import create_logger
+
+ROLES = ('proxy', 'web', 'backend')
+
+# (request rate, response time) metrics published by the Ganglia modules of
+# each role, see contrib/ganglia_modules
+ROLE_METRICS = {
+  'proxy': (('web_request_rate_lb', 'web_response_time_lb'),
+            ('php_request_rate_lb', 'php_response_time_lb')),
+  'web': (('web_request_rate', 'web_response_time'),),
+  'backend': (('php_request_rate', 'php_response_time'),),
+}
+
+# Rate of server errors and of bytes sent, where published
+ERROR_METRICS = { 'proxy': 'error_rate_lb', 'web': 'web_error_rate',
+                  'backend': 'php_error_rate' }
+THROUGHPUT_METRICS = { 'proxy': 'throughput_lb', 'web': 'web_throughput' }
+
+# Lengths in seconds of the windows get_service_performance reports on
+WINDOWS = (60, 300, 900)
+
+PERCENTILES = histogram.PERCENTILES
+
+def role_nodes(config, role):
+  """Return the service nodes of config running role"""
+  return { 'proxy': config.getProxyServiceNodes,
+           'web': config.getWebServiceNodes,
+           'backend': config.getBackendServiceNodes }[role]()
+
+def node_metrics(config, hosts):
+  """Return the metrics of the nodes of each role.
+
+  @param config The ServiceConfiguration of the service
+  @param hosts The metrics of each host, as returned by
+               ganglia.read_gmond_metrics
+
+  @return A {role: [metrics]} dictionary, with the metrics of each node
+          reporting some. Those are its 'request_rate' in requests/s, the
+          average 'response_time' of its requests in ms, its 'error_rate'
+          in server errors/s and its 'throughput' in bytes/s. Its
+          'response_times' are the (response time, request rate) of each
+          kind of requests it serves, and its 'histograms' the
+          LatencyHistogram of those publishing one.
+  """
+  metrics = {}
+  for role in ROLES:
+    metrics[role] = []
+    for node in role_nodes(config, role):
+      host = hosts.get(node.ip) or hosts.get(node.private_ip)
+      if host is None:
+        continue
+
+      response_times = [ (host.get(time_name, 0), host.get(rate_name, 0))
+                         for rate_name, time_name in ROLE_METRICS[role] ]
+      rate = sum(rate for _, rate in response_times)
+      weighted = sum(time * rate for time, rate in response_times)
+
+      histograms = [ histogram.from_metrics(time_name, host)
+                     for _, time_name in ROLE_METRICS[role] ]
+
+      metrics[role].append({
+        'request_rate': rate,
+        'response_time': weighted / rate if rate else 0,
+        'response_times': response_times,
+        'histograms': [ h for h in histograms if h is not None ],
+        'error_rate': host.get(ERROR_METRICS[role], 0),
+        'throughput': host.get(THROUGHPUT_METRICS.get(role), 0) })
+  return metrics
+
+def role_metrics(config, hosts):
+  """Aggregate the metrics of the nodes of each role.
+
+  @param config The ServiceConfiguration of the service
+  @param hosts The metrics of each host, as returned by
+               ganglia.read_gmond_metrics
+
+  @return A {role: metrics} dictionary. The metrics of a role are its
+          number of 'nodes', how many of them are 'reporting' metrics, their
+          total 'request_rate', 'error_rate' and 'throughput' and the
+          average 'response_time' of their requests.
+  """
+  nodes = node_metrics(config, hosts)
+  metrics = {}
+  for role in ROLES:
+    rate = sum(node['request_rate'] for node in nodes[role])
+    weighted = sum(node['request_rate'] * node['response_time']
+                   for node in nodes[role])
+    metrics[role] = {
+      'nodes': len(role_nodes(config, role)), 'reporting': len(nodes[role]),
+      'request_rate': rate,
+      'response_time': weighted / rate if rate else 0,
+      'error_rate': sum(node['error_rate'] for node in nodes[role]),
+      'throughput': sum(node['throughput'] for node in nodes[role]) }
+  return metrics
+
+def weighted_percentile(values, percentile):
+  """Return the given percentile of a list of (value, weight) tuples"""
+  values = sorted(values)
+  total = sum(weight for _, weight in values)
+  if not total:
+    return 0
+
+  threshold = total * percentile / 100.0
+  seen = 0
+  for value, weight in values:
+    seen += weight
+    if seen >= threshold:
+      return value
+  return values[-1][0]
+
+def merge_histograms(nodes):
+  """Return the LatencyHistogram of the requests of nodes, as returned by
+  node_metrics, or None if none of them publishes a histogram"""
+  merged = None
+  for node in nodes:
+    for node_histogram in node['histograms']:
+      if merged is None:
+        merged = histogram.LatencyHistogram()
+      merged.merge(node_histogram)
+  return merged
+
+def response_time_summary(nodes):
+  """Return the response time percentiles of the requests of nodes, as
+  returned by node_metrics, as 'pNN', and their 'max'.
+
+  Nodes not publishing a histogram only report the average response time
+  of each kind of requests: without any histogram, the percentiles are
+  those of these averages, weighted by their number of requests."""
+  merged = merge_histograms(nodes)
+  if merged is not None and merged.total():
+    return merged.summary()
+
+  response_times = [ response_time for node in nodes
+                     for response_time in node['response_times'] ]
+  summary = dict(('p%d' % percentile,
+                  weighted_percentile(response_times, percentile))
+                 for percentile in PERCENTILES)
+  summary['max'] = max([ time for time, rate in response_times if rate ] or [ 0 ])
+  return summary
+
+class ServicePerformance(object):
+  """Sliding windows over the node metrics of each role.
+
+  Metrics are collected at a regular interval, so the rates of a window
+  are the averages of the rates of its collections, and its response time
+  histogram the sum of theirs."""
+
+  def __init__(self, windows=WINDOWS):
+    self.windows = windows
+    self.collections = deque()
+    self.lock = Lock()
+
+  def add(self, metrics, now):
+    """Add a collection of metrics, as returned by node_metrics"""
+    with self.lock:
+      self.collections.append((now, metrics))
+      while self.collections[0][0] <= now - max(self.windows):
+        self.collections.popleft()
+
+  def summary(self, window, now):
+    """Return the performance of each role over the last window seconds.
+
+    @return A {role: performance} dictionary. The performance of a role
+            is its average 'request_rate', 'error_rate' and 'throughput',
+            and the 'response_time' percentiles of its requests, as
+            returned by response_time_summary, along with the number of
+            'collections' they come from.
+    """
+    with self.lock:
+      collections = [ metrics for collected, metrics in self.collections
+                      if collected > now - window ]
+
+    summary = {}
+    for role in ROLES:
+      nodes = [ node for metrics in collections for node in metrics[role] ]
+      count = float(len(collections) or 1)
+
+      summary[role] = dict(
+        [ (name, sum(node[name] for node in nodes) / count)
+          for name in ('request_rate', 'error_rate', 'throughput') ],
+        response_time=response_time_summary(nodes),
+        collections=len(collections))
+    return summary
+
+class PerformanceMonitor(Thread):
+  """Thread collecting the node metrics of a manager into a
+  ServicePerformance every interval seconds, while it is running.
+
+  The metrics of each host, as 'IP/metric', and of each role, as
+  'role/metric', are also recorded in the history of the manager, except
+  for the buckets of the response time histograms. The response time
+  percentiles of a role are recorded as 'role/response_time_pNN'."""
+
+  def __init__(self, manager, interval=15, windows=WINDOWS,
+               read_metrics=ganglia.read_gmond_metrics):
+    Thread.__init__(self)
+    self.daemon = True
+
+    self.logger = create_logger(__name__)
+    self.manager = manager
+    self.interval = interval
+    self.read_metrics = read_metrics
+    self.performance = ServicePerformance(windows)
+    self._stopped = Event()
+
+  def collect(self, now=None):
+    if now is None:
+      now = time.time()
+
+    if self.manager._state_get() != self.manager.S_RUNNING:
+      return
+
+    try:
+      hosts = self.read_metrics()
+    except Exception, err:
+      self.logger.debug('Failed to read the metrics: %s' % err)
+      return
+
+    config = self.manager._configuration_get()
+    nodes = node_metrics(config, hosts)
+    self.performance.add(nodes, now)
+
+    # Keep the history of the metrics of each host and role
+    values = dict(('%s/%s' % (host, name), value)
+                  for host, metrics in hosts.items()
+                  for name, value in metrics.items()
+                  if not histogram.is_bucket_metric(name))
+    for role, metrics in role_metrics(config, hosts).items():
+      for name in ('request_rate', 'response_time', 'error_rate', 'throughput'):
+        values['%s/%s' % (role, name)] = metrics[name]
+
+      merged = merge_histograms(nodes[role])
+      if merged is not None:
+        for name, value in merged.summary().items():
+          values['%s/response_time_%s' % (role, name)] = value
+    self.manager.record_metrics(values, now)
+
+  def run(self):
+    while not self._stopped.wait(self.interval):
+      try:
+        self.collect()
+      except Exception:
+        self.logger.exception('Failed to collect the metrics')
+
+  def stop(self):
+    self._stopped.set()
@@ -12,6 +12,7 @@ from conpaas.core.manager import BaseManager
 from conpaas.core.manager import ManagerException
 
 from conpaas.core.https.server import HttpJsonResponse, HttpErrorResponse
+from conpaas.core.https import fanout
 
 from conpaas.services.xtreemfs.agent import client
 
@@ -41,40 +42,22 @@ class XtreemFSManager(BaseManager):
         self.controller.generate_context('xtreemfs')
 
     def _start_dir(self, nodes):
-        for node in nodes:
-            try:
-                client.createDIR(node.ip, 5555)
-            except client.AgentException:
-                self.logger.exception('Failed to start DIR at node %s' % node)
-                self.state = self.S_ERROR
-                raise
+        self._call_nodes(lambda node: client.createDIR(node.ip, 5555),
+                         nodes, 'Failed to start DIR')
 
     def _start_mrc(self, nodes):
-        for node in nodes:
-            try:
-                client.createMRC(node.ip, 5555, self.dirNodes[0].ip)
-            except client.AgentException:
-                self.logger.exception('Failed to start MRC at node %s' % node)
-                self.state = self.S_ERROR
-                raise
+        self._call_nodes(lambda node: client.createMRC(node.ip, 5555,
+                                                       self.dirNodes[0].ip),
+                         nodes, 'Failed to start MRC')
 
     def _start_osd(self, nodes):
-        for node in nodes:
-            try:
-                client.createOSD(node.ip, 5555, self.dirNodes[0].ip)
-            except client.AgentException:
-                self.logger.exception('Failed to start OSD at node %s' % node)
-                self.state = self.S_ERROR
-                raise
+        self._call_nodes(lambda node: client.createOSD(node.ip, 5555,
+                                                       self.dirNodes[0].ip),
+                         nodes, 'Failed to start OSD')
 
     def _stop_osd(self, nodes):
-        for node in nodes:
-            try:
-                client.stopOSD(node.ip, 5555)
-            except client.AgentException:
-                self.logger.exception('Failed to stop OSD at node %s' % node)
-                self.state = self.S_ERROR
-                raise
+        self._call_nodes(lambda node: client.stopOSD(node.ip, 5555),
+                         nodes, 'Failed to stop OSD')
 
     def _do_startup(self, cloud):
         ''' Starts up the service. The firstnodes will contain all services
@@ -222,24 +205,33 @@ class XtreemFSManager(BaseManager):
         #self.KillOsd(KilledOsdNodes)
           
         # Startup DIR agents
-        for node in dirNodesAdded:
+        def start_dir(node):
             client.startup(node.ip, 5555)
-            data = client.createDIR(node.ip, 5555)
+            return client.createDIR(node.ip, 5555)
+        results = self._call_nodes(start_dir, dirNodesAdded,
+                                   'Failed to start DIR')
+        for node, data in zip(dirNodesAdded, results):
             self.logger.info('Received %s from %s', data, node.id)
             self.dirCount += 1
 
         # Startup MRC agents
-        for node in mrcNodesAdded:
+        def start_mrc(node):
             client.startup(node.ip, 5555)
-            data = client.createMRC(node.ip, 5555, self.dirNodes[0].ip)
+            return client.createMRC(node.ip, 5555, self.dirNodes[0].ip)
+        results = self._call_nodes(start_mrc, mrcNodesAdded,
+                                   'Failed to start MRC')
+        for node, data in zip(mrcNodesAdded, results):
             self.logger.info('Received %s from %s', data, node.id)
             self.mrcCount += 1
 
         # Startup OSD agents
-        for node in osdNodesAdded:
+        def start_osd(node):
             client.startup(node.ip, 5555)
-            data = client.createOSD(node.ip, 5555, self.dirNodes[0].ip)
-            self.logger.info('Received %s from %s', data, node.id)         
+            return client.createOSD(node.ip, 5555, self.dirNodes[0].ip)
+        results = self._call_nodes(start_osd, osdNodesAdded,
+                                   'Failed to start OSD')
+        for node, data in zip(osdNodesAdded, results):
+            self.logger.info('Received %s from %s', data, node.id)
             self.osdCount += 1
 
         self.state = self.S_RUNNING
@@ -379,8 +371,10 @@ class XtreemFSManager(BaseManager):
         if self.state != self.S_RUNNING:
             return HttpErrorResponse('ERROR: Wrong state to create MRC service')
         # Just createMRC from all the agents
-        for node in self.nodes:
-            data = client.createMRC(node.ip, 5555, self.dirNodes[0].ip)
+        outcome = fanout.call_nodes(lambda node: client.createMRC(node.ip, 5555, self.dirNodes[0].ip),
+                                    self.nodes)
+        outcome.check()
+        for node, data in zip(self.nodes, outcome.results):
             self.logger.info('Received %s from %s', data, node.id)
         return HttpJsonResponse({
             'xtreemfs': [ node.id for node in self.nodes ],
@@ -391,8 +385,10 @@ class XtreemFSManager(BaseManager):
         if self.state != self.S_RUNNING:
             return HttpErrorResponse('ERROR: Wrong state to create DIR service')
         # Just createDIR from all the agents
-        for node in self.nodes:
-            data = client.createDIR(node.ip, 5555)
+        outcome = fanout.call_nodes(lambda node: client.createDIR(node.ip, 5555),
+                                    self.nodes)
+        outcome.check()
+        for node, data in zip(self.nodes, outcome.results):
             self.logger.info('Received %s from %s', data, node.id)
         return HttpJsonResponse({
             'xtreemfs': [ node.id for node in self.nodes ],
@@ -403,8 +399,10 @@ class XtreemFSManager(BaseManager):
         if self.state != self.S_RUNNING:
             return HttpErrorResponse('ERROR: Wrong state to create OSD service')
         # Just createOSD from all the agents
-        for node in self.nodes:
-            data = client.createOSD(node.ip, 5555, self.dirNodes[0].ip)
+        outcome = fanout.call_nodes(lambda node: client.createOSD(node.ip, 5555, self.dirNodes[0].ip),
+                                    self.nodes)
+        outcome.check()
+        for node, data in zip(self.nodes, outcome.results):
             self.logger.info('Received %s from %s', data, node.id)
         return HttpJsonResponse({
             'xtreemfs': [ node.id for node in self.nodes ],
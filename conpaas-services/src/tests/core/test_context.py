@@ -0,0 +1,63 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from conpaas.core.context import ContextCache
+
+class TestContextCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'script')
+        self.optional = os.path.join(self.dir, 'optional')
+        self.write(self.path, 'first')
+        self.cache = ContextCache()
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, contents):
+        f = open(path, 'w')
+        f.write(contents)
+        f.close()
+
+    def build(self):
+        self.builds += 1
+        value = open(self.path).read()
+        if os.path.isfile(self.optional):
+            value += open(self.optional).read()
+        return value
+
+    def get(self, key='key'):
+        return self.cache.get(key, [self.path, self.optional], self.build)
+
+    def test_cached(self):
+        self.assertEquals('first', self.get())
+        self.assertEquals('first', self.get())
+        self.assertEquals(1, self.builds)
+
+        # Values are cached by key
+        self.assertEquals('first', self.get('other'))
+        self.assertEquals(2, self.builds)
+
+    def test_modified(self):
+        self.assertEquals('first', self.get())
+        self.write(self.path, 'second')
+        # Older modification time, but different size
+        os.utime(self.path, (time.time() - 60, time.time() - 60))
+        self.assertEquals('second', self.get())
+        self.assertEquals(2, self.builds)
+
+    def test_created_and_removed(self):
+        self.assertEquals('first', self.get())
+        self.write(self.optional, ' and optional')
+        self.assertEquals('first and optional', self.get())
+        os.remove(self.optional)
+        self.assertEquals('first', self.get())
+        self.assertEquals(3, self.builds)
+
+if __name__ == "__main__":
+    unittest.main()
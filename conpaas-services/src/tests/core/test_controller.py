@@ -1,8 +1,13 @@
+import json
 import pytest
+import socket
+import threading
+import time
 import conftest
 import logging
 from mock import Mock
-from conpaas.core.controller import Controller
+from conpaas.core.controller import Controller, ReservationScheduler
+from conpaas.core.node import ServiceNode
 
 
 @pytest.fixture(scope='module')
@@ -25,7 +30,7 @@ def controller(cloud):
     config_parser.set('manager', 'APP_ID', '1')
     controller = Controller(config_parser)
     #we don't need timer for testing
-    controller._Controller__reservation_map['manager'].stop()
+    controller._Controller__reservations.stop()
     mockedController = Mock(spec=controller)
     #for testing purposes
     mockedController.deduct_credit.return_value = True
@@ -53,3 +58,238 @@ def test_multiple_cloud_providers(controller):
     if controller is not None:
         assert controller._Controller__default_cloud is not None
         assert controller._Controller__available_clouds is not None
+
+
+def __real_controller():
+    config_parser = conftest.config_parser('ec2')
+    config_parser.add_section('manager')
+    for option, value in (('TYPE', 'helloworld'), ('SERVICE_ID', '1'),
+                          ('USER_ID', '123'), ('APP_ID', '1'),
+                          ('CREDIT_URL', 'https://localhost:5555/credit'),
+                          ('TERMINATE_URL', 'https://localhost:5555/terminate'),
+                          ('CA_URL', 'https://localhost:5555/ca')):
+        config_parser.set('manager', option, value)
+    controller = Controller(config_parser)
+    controller._Controller__reservations.stop()
+    return controller
+
+
+def test_wait_for_announced_nodes():
+    '''Nodes are checked again as soon as their agent announces itself'''
+    controller = __real_controller()
+    controller.CHECK_NODE_INTERVALS = (30, 30)
+    nodes = [ServiceNode(i, '10.0.0.%d' % i, '10.0.0.%d' % i, 'iaas')
+             for i in range(1, 4)]
+    up = set(['10.0.0.1'])
+
+    def announce():
+        time.sleep(0.2)
+        up.update(['10.0.0.2', '10.0.0.3'])
+        controller.agent_up(['10.0.0.2', '10.0.0.3'])
+    threading.Thread(target=announce).start()
+
+    def test_agent(ip, port):
+        if ip not in up:
+            raise socket.error('connection refused')
+
+    start = time.time()
+    done, remaining = controller._Controller__wait_for_nodes(
+        nodes, test_agent, 5555)
+    assert time.time() - start < 5
+    assert sorted(node.id for node in done) == [1, 2, 3]
+    assert remaining == []
+
+
+def test_wait_for_nodes_timeout():
+    '''Nodes which never answer are returned after the timeout'''
+    controller = __real_controller()
+    controller.WAIT_FOR_NODES_TIMEOUT = 0.5
+    controller.CHECK_NODE_INTERVALS = (0.1, 0.2)
+    calls = []
+
+    def test_agent(ip, port):
+        calls.append(ip)
+        if ip != '10.0.0.1':
+            raise socket.error('connection refused')
+
+    nodes = [ServiceNode(i, '10.0.0.%d' % i, '10.0.0.%d' % i, 'iaas')
+             for i in range(1, 3)]
+    done, remaining = controller._Controller__wait_for_nodes(
+        nodes, test_agent, 5555)
+    assert [node.id for node in done] == [1]
+    assert [node.id for node in remaining] == [2]
+    # Backing off, rather than checking in a busy loop
+    assert calls.count('10.0.0.2') < 10
+
+
+def __dummy_controller(standby_nodes):
+    config_parser = conftest.config_parser('dummy')
+    config_parser.add_section('manager')
+    for option, value in (('TYPE', 'helloworld'), ('SERVICE_ID', '1'),
+                          ('USER_ID', '123'), ('APP_ID', '1'),
+                          ('CREDIT_URL', 'https://localhost:5555/credit'),
+                          ('TERMINATE_URL', 'https://localhost:5555/terminate'),
+                          ('CA_URL', 'https://localhost:5555/ca'),
+                          ('STANDBY_NODES', str(standby_nodes))):
+        config_parser.set('manager', option, value)
+    controller = Controller(config_parser)
+    controller._Controller__reservations.stop()
+    controller.deduct_credit = Mock(return_value=True)
+    return controller
+
+
+def __wait_for_standby_nodes(controller, count):
+    deadline = time.time() + 5
+    while len(controller.get_standby_nodes()) < count:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_standby_nodes():
+    '''Standby nodes are used first, and created again in the background'''
+    controller = __dummy_controller(2)
+    test_agent = lambda ip, port: True
+
+    first = controller.create_nodes(1, test_agent, 5555)
+    __wait_for_standby_nodes(controller, 2)
+    standby = controller.get_standby_nodes()
+    assert not set(first) & set(standby)
+
+    second = controller.create_nodes(3, test_agent, 5555)
+    assert standby == second[:2]
+    __wait_for_standby_nodes(controller, 2)
+    # One charge per batch of new nodes: 1, 2 standby, 1, 2 standby
+    assert [args[0][0] for args in controller.deduct_credit.call_args_list] \
+        == [1, 2, 1, 2]
+
+    # Deleting all the nodes of the service deletes the standby ones
+    controller.delete_nodes(first + second)
+    assert controller.get_standby_nodes() == []
+    assert controller._Controller__reservations.get_nodes() == ['manager']
+
+
+def test_standby_nodes_context():
+    '''Standby nodes booted with another context are not used'''
+    controller = __dummy_controller(1)
+    test_agent = lambda ip, port: True
+
+    cloud = controller.get_clouds()[0]
+    cloud.set_context_template('FIRST=$FIRST')
+    contexts = {}
+    new_instances = cloud.new_instances
+    def booted(*args):
+        nodes = new_instances(*args)
+        for node in nodes:
+            contexts[node.id] = cloud.cx
+        return nodes
+    cloud.new_instances = booted
+
+    controller.update_context({ 'FIRST': 'true' })
+    first = controller.create_nodes(1, test_agent, 5555)
+    __wait_for_standby_nodes(controller, 1)
+
+    # As a service does after its first node
+    controller.update_context({ 'FIRST': 'false' })
+    assert controller.get_standby_nodes() == []
+    second = controller.create_nodes(1, test_agent, 5555)
+    __wait_for_standby_nodes(controller, 1)
+    third = controller.create_nodes(1, test_agent, 5555)
+    assert [ contexts[node.id] for node in second + third ] \
+        == [ 'FIRST=false', 'FIRST=false' ]
+
+    # Setting the same context again keeps them
+    __wait_for_standby_nodes(controller, 1)
+    controller.update_context({ 'FIRST': 'false' })
+    assert len(controller.get_standby_nodes()) == 1
+
+    controller.delete_nodes(first + second + third)
+    assert controller._Controller__reservations.get_nodes() == ['manager']
+
+
+def test_no_standby_nodes():
+    '''Without STANDBY_NODES nodes are only created on demand'''
+    controller = __dummy_controller(0)
+    nodes = controller.create_nodes(2, lambda ip, port: True, 5555)
+    time.sleep(0.1)
+    assert controller.get_standby_nodes() == []
+    controller.delete_nodes(nodes)
+    assert controller._Controller__reservations.get_nodes() == ['manager']
+
+
+def test_reservation_scheduler():
+    '''Charges due at the same time are merged, cancelled nodes are not
+    charged'''
+    charges = []
+    scheduler = ReservationScheduler(charges.append, logging.getLogger(),
+                                     interval=0.3)
+    scheduler.MERGE_WINDOW = 0.05
+    scheduler.add_nodes(['a', 'b'], 0.1)
+    scheduler.add_nodes(['c'], 0.12)
+    scheduler.add_nodes(['d'], 0.2)
+    scheduler.start()
+
+    time.sleep(0.15)
+    assert charges == [3]
+    assert scheduler.remove_node('d') == 3
+    assert scheduler.remove_node('unknown') == 3
+    time.sleep(0.4)
+    assert charges == [3, 3]
+    scheduler.stop()
+    scheduler.join(1)
+    assert not scheduler.is_alive()
+
+
+def test_context_file(tmpdir):
+    '''Only the certificates are generated again for each context file'''
+    for path, contents in (('scripts/cloud/dummy', 'CLOUD'),
+                           ('scripts/agent/agent-setup', 'SETUP $SOURCE'),
+                           ('scripts/agent/default-agent-start', 'START'),
+                           ('config/agent/default-agent.cfg',
+                            'TYPE = $AGENT_TYPE')):
+        tmpdir.join(path).write(contents, ensure=True)
+
+    controller = __dummy_controller(0)
+    controller.config_parser.set('manager', 'CONPAAS_HOME', str(tmpdir))
+    controller.config_parser.set('manager', 'BOOTSTRAP', 'http://bootstrap')
+    controller.config_parser.set('manager', 'MY_IP', '10.0.0.1')
+    certs = iter(range(10))
+    controller._get_certificate = lambda: dict(
+        (name, '%s%d' % (name, certs.next()))
+        for name in ('cert', 'key', 'ca_cert'))
+
+    first = controller._get_context_file('helloworld', 'dummy')
+    assert first.startswith('CLOUD\n\ncat <<EOF > /tmp/cert.pem\ncert')
+    assert 'SETUP http://bootstrap' in first
+    assert 'TYPE = helloworld' in first
+    assert first.endswith('START\n')
+
+    second = controller._get_context_file('helloworld', 'dummy')
+    assert 'cert3' in second and 'cert0' not in second
+    assert first.replace('cert0', 'cert3').replace('key1', 'key4') \
+        .replace('ca_cert2', 'ca_cert5') == second
+
+    # A startup script uploaded by the user is added
+    tmpdir.join('startup.sh').write('USER SCRIPT')
+    assert controller._get_context_file('helloworld', 'dummy').endswith(
+        'USER SCRIPT\nSTART\n')
+
+
+def test_get_certificates(tmpdir, monkeypatch):
+    '''Certificates of all the clouds are requested at once'''
+    from conpaas.core import https
+    tmpdir.join('ca_cert.pem').write('CA CERT')
+    controller = __dummy_controller(0)
+    controller.config_parser.set('manager', 'CERT_DIR', str(tmpdir))
+    controller._Controller__conpaas_caUrl = \
+        'https://director:5555/ca/get_cert.php'
+
+    def https_post(host, port, uri, params={}, files=[]):
+        assert (host, port, uri) == ('director', 5555, '/ca/get_certs.php')
+        return 200, json.dumps({'error': False, 'certs': [
+            'cert%d' % i for i in range(len(files))]})
+    monkeypatch.setattr(https.client, 'https_post', https_post)
+
+    certs = controller._get_certificates(3)
+    assert [cert['cert'] for cert in certs] == ['cert0', 'cert1', 'cert2']
+    assert all(cert['ca_cert'] == 'CA CERT' for cert in certs)
+    assert len(set(cert['key'] for cert in certs)) == 3
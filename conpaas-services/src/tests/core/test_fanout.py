@@ -0,0 +1,71 @@
+import threading
+import time
+import unittest
+
+from conpaas.core.https import fanout
+
+class NodeError(Exception): pass
+
+class TestFanout(unittest.TestCase):
+
+    def test_results(self):
+        outcome = fanout.call_nodes(lambda node: node * 2, [1, 2, 3])
+        self.assertEquals([2, 4, 6], outcome.results)
+        self.assertEquals([], outcome.errors)
+        outcome.check()
+
+    def test_errors(self):
+        def call(node):
+            if node % 2:
+                raise NodeError(node)
+            return node
+
+        outcome = fanout.call_nodes(call, range(5))
+        self.assertEquals([0, None, 2, None, 4], outcome.results)
+        self.assertEquals([1, 3], [ node for node, _ in outcome.errors ])
+        self.assertEquals(NodeError, outcome.errors[0][1][0])
+
+        try:
+            outcome.check()
+        except NodeError as e:
+            self.assertEquals((1,), e.args)
+        else:
+            self.fail('check() did not raise')
+
+    def test_concurrency(self):
+        lock = threading.Lock()
+        counts = { 'running': 0, 'max': 0 }
+
+        def call(node):
+            with lock:
+                counts['running'] += 1
+                counts['max'] = max(counts['max'], counts['running'])
+            time.sleep(0.05)
+            with lock:
+                counts['running'] -= 1
+
+        start = time.time()
+        fanout.call_nodes(call, range(12), concurrency=4)
+        self.assertEquals(4, counts['max'])
+        # Three rounds of calls, rather than twelve
+        self.failUnless(time.time() - start < 0.5)
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def call(node):
+            if node == 'slow':
+                release.wait()
+            return node
+
+        start = time.time()
+        outcome = fanout.call_nodes(call, ['slow', 'fast', 'other'],
+                                    concurrency=2, timeout=0.2)
+        release.set()
+        self.failUnless(time.time() - start < 2)
+        self.assertEquals([None, 'fast', 'other'], outcome.results)
+        self.assertEquals(['slow'], [ node for node, _ in outcome.errors ])
+        self.assertRaises(fanout.NodeTimeout, outcome.check)
+
+if __name__ == "__main__":
+    unittest.main()
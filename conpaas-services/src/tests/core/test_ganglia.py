@@ -0,0 +1,101 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from conpaas.core import ganglia
+
+# The helpers of the Ganglia modules are not part of the conpaas package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                                'contrib', 'ganglia_modules'))
+from log_tailer import LogTailer
+
+GMOND_XML = """<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>
+<!DOCTYPE GANGLIA_XML [
+   <!ELEMENT GANGLIA_XML (GRID|CLUSTER|HOST)*>
+      <!ATTLIST GANGLIA_XML VERSION CDATA #REQUIRED>
+]>
+<GANGLIA_XML VERSION="3.1.7" SOURCE="gmond">
+<CLUSTER NAME="conpaas" LOCALTIME="1366000000" OWNER="unspecified" LATLONG="unspecified" URL="unspecified">
+<HOST NAME="web1" IP="10.0.0.2" REPORTED="1366000000" TN="3" TMAX="20" DMAX="300" LOCATION="unspecified" GMOND_STARTED="1365990000">
+<METRIC NAME="php_request_rate" VAL="12.5" TYPE="float" UNITS="req/s" TN="5" TMAX="90" DMAX="0" SLOPE="both">
+<EXTRA_DATA><EXTRA_ELEMENT NAME="GROUP" VAL="web"/></EXTRA_DATA>
+</METRIC>
+<METRIC NAME="php_response_time" VAL="80.0" TYPE="float" UNITS="ms" TN="500" TMAX="90" DMAX="0" SLOPE="both"/>
+<METRIC NAME="os_name" VAL="Linux" TYPE="string" UNITS="" TN="5" TMAX="1200" DMAX="0" SLOPE="zero"/>
+<METRIC NAME="load_one" VAL="0.42" TYPE="float" UNITS=" " TN="5" TMAX="70" DMAX="0" SLOPE="both"/>
+</HOST>
+<HOST NAME="proxy1" IP="10.0.0.1" REPORTED="1366000000" TN="3" TMAX="20" DMAX="300" LOCATION="unspecified" GMOND_STARTED="1365990000">
+</HOST>
+</CLUSTER>
+</GANGLIA_XML>
+"""
+
+class TestGanglia(unittest.TestCase):
+
+    def test_parse_gmond_xml(self):
+        self.assertEquals({ '10.0.0.2': { 'php_request_rate': 12.5,
+                                          'load_one': 0.42 },
+                            '10.0.0.1': {} },
+                          ganglia.parse_gmond_xml(GMOND_XML))
+
+class TestLogTailer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'access.log')
+        self.write('old line\n')
+        self.tailer = LogTailer(self.log)
+
+    def tearDown(self):
+        self.tailer.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, data, mode='a'):
+        f = open(self.log, mode)
+        f.write(data)
+        f.close()
+
+    def test_append(self):
+        # What was logged before the first call is skipped
+        self.assertEquals([], list(self.tailer.lines()))
+
+        self.write('first\nsecond\nthi')
+        self.assertEquals([ 'first', 'second' ], list(self.tailer.lines()))
+        self.assertEquals([], list(self.tailer.lines()))
+
+        self.write('rd\n')
+        self.assertEquals([ 'third' ], list(self.tailer.lines()))
+
+    def test_rotation(self):
+        list(self.tailer.lines())
+        self.write('before\n')
+        os.rename(self.log, self.log + '.1')
+
+        # The new log is not created yet
+        self.assertEquals([ 'before' ], list(self.tailer.lines()))
+
+        self.write('after\n', mode='w')
+        self.assertEquals([ 'after' ], list(self.tailer.lines()))
+
+    def test_rotation_partial_line(self):
+        list(self.tailer.lines())
+        self.write('unfinished')
+        os.rename(self.log, self.log + '.1')
+        self.write('after\n', mode='w')
+
+        self.assertEquals([ 'unfinished', 'after' ],
+                          list(self.tailer.lines()))
+
+    def test_truncation(self):
+        list(self.tailer.lines())
+        self.write('new\n', mode='w')
+        self.assertEquals([ 'new' ], list(self.tailer.lines()))
+
+    def test_missing_log(self):
+        tailer = LogTailer(os.path.join(self.dir, 'missing.log'))
+        self.assertEquals([], list(tailer.lines()))
+
+if __name__ == "__main__":
+    unittest.main()
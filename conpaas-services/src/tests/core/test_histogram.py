@@ -0,0 +1,67 @@
+import unittest
+
+from conpaas.core import histogram
+from conpaas.core.histogram import LatencyHistogram
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        self.assertEquals(0, histogram.bucket(0))
+        self.assertEquals(0, histogram.bucket(histogram.MIN_VALUE))
+        self.assertEquals(histogram.BUCKETS - 1, histogram.bucket(10 ** 9))
+
+        for index in range(histogram.BUCKETS - 1):
+            bound = histogram.upper_bound(index)
+            self.assertEquals(index, histogram.bucket(bound))
+            self.assertEquals(index + 1, histogram.bucket(bound * 1.001))
+
+    def test_percentiles(self):
+        latencies = LatencyHistogram()
+        self.assertEquals({ 'p50': 0, 'p90': 0, 'p95': 0, 'p99': 0, 'max': 0 },
+                          latencies.summary())
+
+        for value in range(1, 101):
+            latencies.add(value)
+
+        # Within a bucket of the exact values
+        for percentile in (50, 90, 95):
+            value = latencies.percentile(percentile)
+            self.assertTrue(percentile <= value < percentile * 1.19)
+
+        # Never above the maximum
+        self.assertEquals(100, latencies.percentile(99))
+        self.assertEquals(100, latencies.max)
+
+    def test_merge(self):
+        fast, slow = LatencyHistogram(), LatencyHistogram()
+        fast.add(5, count=98)
+        slow.add(2000, count=2)
+
+        self.assertEquals(5, fast.percentile(99))
+        fast.merge(slow)
+        self.assertEquals(100, fast.total())
+        self.assertEquals(2000, fast.percentile(99))
+        self.assertEquals(histogram.upper_bound(histogram.bucket(5)),
+                          fast.percentile(95))
+
+    def test_metrics(self):
+        latencies = LatencyHistogram()
+        latencies.add(20, count=30)
+        latencies.add(80, count=15)
+
+        metrics = histogram.to_metrics('php_response_time', latencies, 15)
+        self.assertEquals(len(histogram.metric_units('php_response_time')),
+                          len(metrics))
+        self.assertEquals(80, metrics['php_response_time_max'])
+        self.assertEquals(2, metrics[histogram.bucket_metric(
+                                 'php_response_time', histogram.bucket(20))])
+
+        rates = histogram.from_metrics('php_response_time', metrics)
+        self.assertEquals(3, rates.total())
+        self.assertEquals(latencies.summary(), rates.summary())
+
+        self.assertEquals(None, histogram.from_metrics('web_response_time',
+                                                       metrics))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,559 @@
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import httplib
+from cStringIO import StringIO
+
+from OpenSSL import SSL
+
+from ConfigParser import ConfigParser
+
+from conpaas.core import agent
+from conpaas.core import services
+from conpaas.core.log import create_logger
+from conpaas.core.manager import BaseManager
+from conpaas.core.https import x509
+from conpaas.core.https import client
+from conpaas.core.https import server
+from conpaas.core.https import multipart
+
+def create_certs(basedir):
+    """Create a CA and a certificate for a manager and an agent in basedir.
+    Return the directories holding cert.pem, key.pem and ca_cert.pem for
+    each role."""
+    ca_key = x509.gen_rsa_keypair()
+    ca_req = x509.create_x509_req(ca_key, CN='CA', O='ConPaaS')
+    ca_cert = x509.create_cert(ca_req, ca_req, ca_key, 1, 0, 3600)
+
+    dirs = {}
+    for serial, role in enumerate(('manager', 'agent')):
+        key = x509.gen_rsa_keypair()
+        req = x509.create_x509_req(key, CN='ConPaaS', O='ConPaaS', role=role,
+                                   UID='1', serviceLocator='1')
+        cert = x509.create_cert(req, ca_cert, ca_key, serial + 2, 0, 3600)
+
+        dirs[role] = os.path.join(basedir, role)
+        os.mkdir(dirs[role])
+        open(os.path.join(dirs[role], 'cert.pem'), 'w').write(
+            x509.cert_as_pem(cert))
+        open(os.path.join(dirs[role], 'key.pem'), 'w').write(
+            x509.key_as_pem(key))
+        open(os.path.join(dirs[role], 'ca_cert.pem'), 'w').write(
+            x509.cert_as_pem(ca_cert))
+    return dirs
+
+def echo(service, kwargs):
+    return server.HttpJsonResponse(kwargs)
+
+def wait(service, kwargs):
+    service.entered.set()
+    service.release.wait()
+    return server.HttpJsonResponse()
+
+def download(service, kwargs):
+    return server.HttpFileDownloadResponse('data.bin', service.filename)
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+def upload(service, kwargs):
+    uploaded = kwargs['file']
+    service.uploaded = uploaded.file
+    return server.HttpJsonResponse({ 'filename': uploaded.filename,
+                                     'md5': md5(uploaded.file.read()),
+                                     'other': kwargs['other'] })
+
+class WaitService(object):
+    """wait() blocks until release is set"""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+
+class EchoServer(server.ThreadPoolMixIn, server.HTTPSServer):
+    """HTTPSServer exposing echo() and wait(), without the configuration
+    needed by ConpaasSecureServer"""
+
+    busy_handler_class = server.ConpaasBusyRequestHandler
+
+    def __init__(self, cert_dir):
+        self.instance = WaitService()
+        self.callback_dict = { 'GET': { 'echo': echo, 'wait': wait,
+                                        'download': download },
+                               'POST': { 'echo': echo, 'wait': wait },
+                               'UPLOAD': { 'upload': upload } }
+        ctx = SSL.Context(SSL.SSLv23_METHOD)
+        ctx.use_privatekey_file(os.path.join(cert_dir, 'key.pem'))
+        ctx.use_certificate_file(os.path.join(cert_dir, 'cert.pem'))
+        ctx.load_verify_locations(os.path.join(cert_dir, 'ca_cert.pem'))
+        ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT,
+                       lambda conn, cert, errnum, depth, ok: ok)
+        server.HTTPSServer.__init__(self, ('127.0.0.1', 0),
+                                    server.ConpaasRequestHandler, ctx)
+
+class BusyHandler(server.ConpaasBusyRequestHandler):
+    """ConpaasBusyRequestHandler reading from and writing to strings"""
+
+    def __init__(self, request):
+        self.rfile, self.wfile = StringIO(request), StringIO()
+        self.client_address = ('127.0.0.1', 0)
+
+def busy_handle(body):
+    """Answer a POST request with body as a busy server, return how much
+    of the body was read and the response"""
+    head = 'POST / HTTP/1.1\r\ncontent-length: %d\r\n\r\n' % len(body)
+    handler = BusyHandler(head + body)
+    handler.handle()
+    return handler.rfile.tell() - len(head), handler.wfile.getvalue()
+
+class KeptAliveResponse(object):
+    will_close = False
+
+class TestHttps(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.basedir = tempfile.mkdtemp()
+        cls.cert_dirs = create_certs(cls.basedir)
+
+        cls.filename = os.path.join(cls.basedir, 'data.bin')
+        open(cls.filename, 'w').write(os.urandom(300 * 1024))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.basedir)
+
+    def setUp(self):
+        client.conpaas_init_ssl_ctx(self.cert_dirs['manager'], 'manager',
+                                    '1', '1')
+        self.server = EchoServer(self.cert_dirs['agent'])
+        self.server.instance.filename = self.filename
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.instance.release.set()
+        client.close_connections()
+        self.server.shutdown()
+        self.thread.join()
+        if self.server.pool_size:
+            self.server.stop_workers()
+        self.server.server_close()
+
+    def call_in_thread(self, method, call=client.jsonrpc_get):
+        """Call method in a new thread, return the list its response will
+        be appended to and the thread"""
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(
+            call('127.0.0.1', self.port, '/', method)))
+        thread.start()
+        return responses, thread
+
+    def test_jsonrpc(self):
+        res = client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo',
+                                 { 'a': 1 })
+        self.assertEquals({ 'a': 1 }, client.check_response(res))
+
+        res = client.jsonrpc_post('127.0.0.1', self.port, '/', 'echo',
+                                  { 'b': 2 })
+        self.assertEquals({ 'b': 2 }, client.check_response(res))
+
+        code, body = client.jsonrpc_post('127.0.0.1', self.port, '/',
+                                         'missing')
+        self.assertEquals(404, code)
+
+    def test_jsonrpc_batch(self):
+        res = client.jsonrpc_batch('127.0.0.1', self.port, '/',
+                                   [ ('echo', { 'a': 1 }),
+                                     ('echo', { 'b': 2 }) ])
+        self.assertEquals([ { 'a': 1 }, { 'b': 2 } ],
+                          client.check_batch_response(res))
+
+        # Each call gets its own response
+        code, body = client.jsonrpc_batch('127.0.0.1', self.port, '/',
+                                          [ ('missing', {}),
+                                            ('echo', { 'c': 3 }) ])
+        self.assertEquals(200, code)
+        self.assertEquals([ { 'error': 'method not found', 'id': '1' },
+                            { 'result': { 'c': 3 }, 'error': None,
+                              'id': '2' } ], json.loads(body))
+        self.assertRaises(Exception, client.check_batch_response,
+                          (code, body))
+
+        code, _ = client.jsonrpc_batch('127.0.0.1', self.port, '/', [])
+        self.assertEquals(400, code)
+
+    def test_connection_reuse(self):
+        client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo')
+
+        conn, reused = client._get_connection('127.0.0.1', self.port)
+        self.failUnless(reused)
+        sock = conn.sock
+        client._release_connection(conn, KeptAliveResponse)
+
+        client.jsonrpc_post('127.0.0.1', self.port, '/', 'echo', { 'c': 3 })
+
+        conn, reused = client._get_connection('127.0.0.1', self.port)
+        self.failUnless(reused)
+        self.assertIs(sock, conn.sock)
+        conn.close()
+
+    def test_ssl_ctx_reused(self):
+        client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo')
+
+        # Initializing the same context again keeps pooled connections
+        client.conpaas_init_ssl_ctx(self.cert_dirs['manager'], 'manager',
+                                    '1', '1')
+        conn, reused = client._get_connection('127.0.0.1', self.port)
+        self.failUnless(reused)
+        client._release_connection(conn, KeptAliveResponse)
+
+        # Other credentials do not
+        client.conpaas_init_ssl_ctx(self.cert_dirs['agent'], 'agent',
+                                    '1', '1')
+        conn, reused = client._get_connection('127.0.0.1', self.port)
+        self.failIf(reused)
+        conn.close()
+
+    def test_stale_connection(self):
+        client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo')
+
+        # Close the pooled connection behind the client's back
+        conn, _ = client._get_connection('127.0.0.1', self.port)
+        conn.sock.close()
+        client._release_connection(conn, KeptAliveResponse)
+
+        res = client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo',
+                                 { 'd': 4 })
+        self.assertEquals({ 'd': 4 }, client.check_response(res))
+
+    def test_closed_by_server(self):
+        client.jsonrpc_post('127.0.0.1', self.port, '/', 'echo')
+        conn, _ = client._get_connection('127.0.0.1', self.port)
+
+        # Another client makes the server close the idle connection
+        client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo')
+        client._release_connection(conn, KeptAliveResponse)
+
+        # The POST is not sent over it
+        res = client.jsonrpc_post('127.0.0.1', self.port, '/', 'echo',
+                                  { 'k': 10 })
+        self.assertEquals({ 'k': 10 }, client.check_response(res))
+
+    def pool_unanswered_connection(self):
+        """Put a connection in the pool that sends requests but never gets
+        their response"""
+        client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo')
+
+        conn, _ = client._get_connection('127.0.0.1', self.port)
+        def getresponse():
+            raise httplib.BadStatusLine('')
+        conn.getresponse = getresponse
+        client._release_connection(conn, KeptAliveResponse)
+
+    def test_unanswered_request(self):
+        # A GET is sent again over a new connection
+        self.pool_unanswered_connection()
+        res = client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo',
+                                 { 'g': 7 })
+        self.assertEquals({ 'g': 7 }, client.check_response(res))
+
+        # A POST may have been executed already
+        self.pool_unanswered_connection()
+        self.assertRaises(httplib.BadStatusLine, client.jsonrpc_post,
+                          '127.0.0.1', self.port, '/', 'echo', { 'h': 8 })
+
+    def test_pool_maxsize(self):
+        conns = [ client._get_connection('127.0.0.1', self.port)[0]
+                  for _ in range(client.POOL_MAXSIZE + 1) ]
+        for conn in conns:
+            client._release_connection(conn, KeptAliveResponse)
+
+        for _ in range(client.POOL_MAXSIZE):
+            self.failUnless(
+                client._get_connection('127.0.0.1', self.port)[1])
+        self.failIf(client._get_connection('127.0.0.1', self.port)[1])
+
+    def test_jsonrpc_get_file(self):
+        dest = StringIO()
+        code, body = client.jsonrpc_get_file('127.0.0.1', self.port, '/',
+                                             'download', dest)
+        self.assertEquals(200, code)
+        self.assertEquals(None, body)
+        self.assertEquals(open(self.filename).read(), dest.getvalue())
+
+        # Responses other than files are returned as usual
+        res = client.jsonrpc_get_file('127.0.0.1', self.port, '/', 'echo',
+                                      dest, { 'f': 6 })
+        self.assertEquals({ 'f': 6 }, client.check_response(res))
+
+    def test_file_range(self):
+        data = open(self.filename).read()
+        size = len(data)
+        uri = '/?method=download&id=1'
+
+        for value, expected in (('bytes=10-19', data[10:20]),
+                                ('bytes=%d-' % (size - 5), data[-5:]),
+                                ('bytes=-7', data[-7:]),
+                                ('bytes=0-%d' % (size * 2), data)):
+            code, body = client._request('127.0.0.1', self.port, 'GET', uri,
+                headers=[('content-type', 'application/json'),
+                         ('range', value)])
+            self.assertEquals(206, code)
+            self.assertEquals(expected, body)
+
+        # Unsupported or invalid ranges are ignored
+        for value in ('bytes=0-1,4-5', 'bytes=5-2', 'lines=1-2'):
+            code, body = client._request('127.0.0.1', self.port, 'GET', uri,
+                headers=[('content-type', 'application/json'),
+                         ('range', value)])
+            self.assertEquals(200, code)
+            self.assertEquals(data, body)
+
+        code, body = client._request('127.0.0.1', self.port, 'GET', uri,
+            headers=[('content-type', 'application/json'),
+                     ('range', 'bytes=%d-' % size)])
+        self.assertEquals(416, code)
+
+    def test_upload(self):
+        self.server.upload_spool_size = 1024
+
+        data = os.urandom(300)
+        res = client.https_post('127.0.0.1', self.port, '/',
+                                { 'method': 'upload', 'other': 'x' },
+                                [ ('file', 'small.bin', data) ])
+        self.assertEquals({ 'filename': 'small.bin', 'md5': md5(data),
+                            'other': 'x' }, client.check_response(res))
+        self.failIf(self.server.instance.uploaded._rolled)
+
+        # Bigger files are streamed from disk and spooled to disk
+        fileobj = open(self.filename)
+        res = client.https_post('127.0.0.1', self.port, '/',
+                                { 'method': 'upload', 'other': 'y' },
+                                [ ('file', 'data.bin', fileobj) ])
+        fileobj.close()
+        self.assertEquals(md5(open(self.filename).read()),
+                          client.check_response(res)['md5'])
+        self.failUnless(self.server.instance.uploaded._rolled)
+
+        # The connection is kept alive
+        self.failUnless(client._get_connection('127.0.0.1', self.port)[1])
+
+    def test_upload_too_large(self):
+        self.server.upload_max_size = 1024
+        code, _ = client.https_post('127.0.0.1', self.port, '/',
+                                    { 'method': 'upload', 'other': 'z' },
+                                    [ ('file', 'big.bin', 'a' * 2048) ])
+        self.assertEquals(413, code)
+
+    def test_thread_pool(self):
+        self.server.start_workers(2, 2)
+
+        # A slow request does not block the others
+        waiting, thread = self.call_in_thread('wait')
+        wait_until(self.server.instance.entered.is_set)
+        res = client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo',
+                                 { 'e': 5 })
+        self.assertEquals({ 'e': 5 }, client.check_response(res))
+        self.assertEquals([], waiting)
+
+        self.server.instance.release.set()
+        thread.join()
+        self.assertEquals(200, waiting[0][0])
+
+    def test_thread_pool_post(self):
+        self.server.start_workers(3, 3)
+        instance = self.server.instance
+
+        # POST methods run one at a time, GET ones alongside them
+        first, thread1 = self.call_in_thread('wait', client.jsonrpc_post)
+        wait_until(instance.entered.is_set)
+        instance.entered.clear()
+        second, thread2 = self.call_in_thread('wait', client.jsonrpc_post)
+
+        res = client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo',
+                                 { 'i': 9 })
+        self.assertEquals({ 'i': 9 }, client.check_response(res))
+        wait_until(instance.entered.is_set, timeout=0.5)
+        self.failIf(instance.entered.is_set())
+
+        instance.release.set()
+        thread1.join()
+        thread2.join()
+        self.failUnless(instance.entered.is_set())
+        self.assertEquals(200, first[0][0])
+        self.assertEquals(200, second[0][0])
+
+    def test_thread_pool_busy(self):
+        self.server.start_workers(1, 1)
+        busy_retries = client.BUSY_RETRIES
+        client.BUSY_RETRIES = 0
+
+        try:
+            # Occupy the only worker, then the only slot in the queue
+            waiting, thread1 = self.call_in_thread('wait')
+            wait_until(self.server.instance.entered.is_set)
+            queued, thread2 = self.call_in_thread('echo')
+            wait_until(self.server.requests.full)
+
+            code, _ = client.jsonrpc_get('127.0.0.1', self.port, '/', 'echo')
+            self.assertEquals(503, code)
+        finally:
+            client.BUSY_RETRIES = busy_retries
+
+        self.server.instance.release.set()
+        thread1.join()
+        thread2.join()
+        self.assertEquals(200, waiting[0][0])
+        self.assertEquals(200, queued[0][0])
+
+    def test_busy_body(self):
+        read, response = busy_handle('a' * 100)
+        self.assertEquals('503', response.split()[1])
+        self.assertEquals(100, read)
+
+        # A big body is left unread
+        read, response = busy_handle(
+            'a' * (server.ConpaasBusyRequestHandler.MAX_DRAIN_SIZE + 1))
+        self.assertEquals('503', response.split()[1])
+        self.assertEquals(0, read)
+
+class AnnouncedController(object):
+
+    def __init__(self):
+        self.agents_up = []
+
+    def agent_up(self, ips):
+        self.agents_up.append(ips)
+
+class AnnouncedManager(BaseManager):
+    """Manager only recording the agents announcing themselves"""
+
+    def __init__(self, config_parser):
+        self.logger = create_logger(__name__)
+        self.controller = AnnouncedController()
+        self.state = self.S_RUNNING
+
+class TestAnnounce(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        cert_dirs = create_certs(self.basedir)
+
+        services.manager_services['announced'] = { 'module': __name__,
+                                                   'class': 'AnnouncedManager' }
+        config_parser = ConfigParser()
+        config_parser.add_section('manager')
+        for option, value in (('LOG_FILE', os.devnull), ('TYPE', 'announced'),
+                              ('CERT_DIR', cert_dirs['manager']),
+                              ('USER_ID', '1'), ('SERVICE_ID', '1')):
+            config_parser.set('manager', option, value)
+        self.server = server.ConpaasSecureServer(('127.0.0.1', 0),
+                                                 config_parser, 'manager')
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        # The agent calls its manager with its own certificate
+        client.conpaas_init_ssl_ctx(cert_dirs['agent'], 'agent', '1', '1')
+
+    def tearDown(self):
+        client.close_connections()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        del services.manager_services['announced']
+        shutil.rmtree(self.basedir)
+
+    def test_agent_up(self):
+        config_parser = ConfigParser()
+        config_parser.add_section('agent')
+        config_parser.set('agent', 'IP_WHITE_LIST', '127.0.0.1')
+        config_parser.set('agent', 'MY_IP', '10.0.0.5')
+
+        agent.announce(config_parser, manager_port=self.port, attempts=1)
+        self.assertEquals([ [ '10.0.0.5' ] ],
+                          self.server.instance.controller.agents_up)
+
+        # Nothing else
+        code, _ = client.jsonrpc_get('127.0.0.1', self.port, '/',
+                                     'wait_for_state', { 'states': [] })
+        self.assertEquals(403, code)
+
+class TestMultipart(unittest.TestCase):
+
+    def parse(self, body, boundary, chunk_size):
+        chunk_size, multipart.CHUNK_SIZE = multipart.CHUNK_SIZE, chunk_size
+        try:
+            return multipart.MultipartParser(StringIO(body), boundary,
+                                             len(body), 16).parse()
+        finally:
+            multipart.CHUNK_SIZE = chunk_size
+
+    def test_roundtrip(self):
+        data = 'x\r\n--y' * 10
+        body = multipart.MultipartBody({ 'a': 1 },
+                                       [ ('f', 'f.txt', StringIO(data)) ])
+        value = body.getvalue()
+        self.assertEquals(len(body), len(value))
+
+        # Delimiters split across chunks are found all the same
+        for chunk_size in (1, 3, 7, 1024):
+            fields = self.parse(value, body.boundary, chunk_size)
+            self.assertEquals([ ('a', None, '1') ], fields[:1])
+            name, filename, fileobj = fields[1]
+            self.assertEquals(('f', 'f.txt'), (name, filename))
+            self.assertEquals(data, fileobj.read())
+
+    def test_truncated(self):
+        body = multipart.MultipartBody({ 'a': 1 }, [])
+        value = body.getvalue()
+        self.assertRaises(multipart.MultipartError, self.parse,
+                          value[:-10], body.boundary, 1024)
+        self.assertRaises(multipart.MultipartError, self.parse,
+                          value, None, 1024)
+
+class TestKeyPool(unittest.TestCase):
+
+    def wait_for_keys(self, pool, count):
+        deadline = time.time() + 10
+        while len(pool.keys) < count:
+            self.failUnless(time.time() < deadline)
+            time.sleep(0.01)
+
+    def test_get(self):
+        pool = x509.KeyPool(2)
+        pool.start()
+        self.wait_for_keys(pool, 2)
+        ready = list(pool.keys)
+
+        # Ready keys are used first, missing ones generated on the spot
+        keys = pool.get(3)
+        self.assertEquals(3, len(keys))
+        self.assertEquals(ready, keys[:2])
+        self.assertEquals(3, len(set(keys)))
+
+        # The pool is filled again
+        self.wait_for_keys(pool, 2)
+        self.failIf(set(pool.keys) & set(keys))
+
+    def test_empty_pool(self):
+        pool = x509.KeyPool(0)
+        pool.start()
+        self.assertEquals(1, len(pool.get()))
+        self.failIf(pool.filling)
+        self.assertEquals([], pool.keys)
+
+if __name__ == "__main__":
+    unittest.main()
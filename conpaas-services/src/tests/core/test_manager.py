@@ -0,0 +1,94 @@
+import time
+import unittest
+from threading import Timer
+
+from conpaas.core.manager import BaseManager
+from conpaas.core.https.server import HttpJsonResponse, HttpErrorResponse
+
+class WaitingManager(BaseManager):
+    """Manager without cloud, IPOP and Ganglia setup"""
+
+    def __init__(self):
+        self.state = self.S_INIT
+
+class TestWaitForState(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = WaitingManager()
+
+    def test_current_state(self):
+        res = self.manager.wait_for_state({ 'states': [ 'INIT' ] })
+        self.assertTrue(isinstance(res, HttpJsonResponse))
+        self.assertEquals({ 'state': 'INIT', 'reached': True }, res.obj)
+
+    def test_state_change(self):
+        timer = Timer(0.1, setattr, (self.manager, 'state', 'RUNNING'))
+        timer.start()
+
+        start = time.time()
+        res = self.manager.wait_for_state({ 'states': [ 'RUNNING', 'ERROR' ],
+                                            'timeout': 5 })
+        timer.join()
+
+        self.assertEquals({ 'state': 'RUNNING', 'reached': True }, res.obj)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_timeout(self):
+        timer = Timer(0.1, setattr, (self.manager, 'state', 'PROLOGUE'))
+        timer.start()
+
+        res = self.manager.wait_for_state({ 'states': 'RUNNING',
+                                            'timeout': 0.3 })
+        timer.join()
+
+        self.assertEquals({ 'state': 'PROLOGUE', 'reached': False }, res.obj)
+
+    def test_wrong_arguments(self):
+        res = self.manager.wait_for_state({})
+        self.assertTrue(isinstance(res, HttpErrorResponse))
+
+        res = self.manager.wait_for_state({ 'states': [ 'INIT' ],
+                                            'timeout': 'never' })
+        self.assertTrue(isinstance(res, HttpErrorResponse))
+
+class TestGetMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = WaitingManager()
+        self.now = time.time()
+        self.manager.record_metrics({ 'load': 1, 'requests': 10 }, self.now - 600)
+        self.manager.record_metrics({ 'load': 3 }, self.now)
+
+    def test_names(self):
+        res = self.manager.get_metrics({})
+        self.assertEquals({ 'names': [ 'load', 'requests' ] }, res.obj)
+
+    def test_range(self):
+        res = self.manager.get_metrics({ 'names': 'load' })
+        self.assertEquals([ 1, 3 ], [ value for _, value in
+                                      res.obj['metrics']['load'] ])
+
+        res = self.manager.get_metrics({ 'names': [ 'load', 'requests' ],
+                                         'start': self.now - 60 })
+        self.assertEquals([ 3 ], [ value for _, value in
+                                   res.obj['metrics']['load'] ])
+        self.assertEquals([], res.obj['metrics']['requests'])
+
+        # Averaged over a step longer than the whole period
+        res = self.manager.get_metrics({ 'names': [ 'load' ],
+                                         'start': self.now - 600,
+                                         'step': 3600 * 24 })
+        self.assertEquals([ 2 ], [ value for _, value in
+                                   res.obj['metrics']['load'] ])
+
+    def test_wrong_arguments(self):
+        for kwargs in ({ 'start': 0 },
+                       { 'names': 'load', 'step': 'often' },
+                       { 'names': 'load', 'step': 0 },
+                       { 'names': 'load', 'start': 10, 'end': 0 },
+                       { 'names': 'load', 'format': 'xml' }):
+            res = self.manager.get_metrics(kwargs)
+            self.assertTrue(isinstance(res, HttpErrorResponse))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from conpaas.core.timeseries import Archive, TimeSeries, TimeSeriesStore
+
+class TestTimeSeries(unittest.TestCase):
+
+    def test_archive(self):
+        archive = Archive(10, 3)
+        for now in range(0, 50, 5):
+            archive.add(now, now)
+
+        # Only the last 3 steps are kept, averaged
+        self.assertEquals(20, archive.first(45))
+        self.assertEquals([ (20, 45, 2), (30, 65, 2), (40, 85, 2) ],
+                          list(archive.points(0, 100, 45)))
+        self.assertEquals([ (30, 65, 2) ], list(archive.points(30, 39, 45)))
+
+    def test_downsampling(self):
+        series = TimeSeries(archives=((10, 6), (60, 10)))
+        for now in range(0, 300, 10):
+            series.add(1 if now < 240 else 2, now)
+
+        # Recent values come from the finest archive
+        self.assertEquals([ [ 240, 2 ], [ 250, 2 ], [ 260, 2 ] ],
+                          series.query(240, 260, None, 290))
+
+        # Older ones from the coarser one
+        self.assertEquals([ [ 0, 1 ], [ 60, 1 ], [ 120, 1 ], [ 180, 1 ],
+                            [ 240, 2 ] ], series.query(0, 290, None, 290))
+
+        # Values are averaged over the requested step
+        self.assertEquals([ [ 240, 2 ] ], series.query(240, 290, 60, 290))
+        self.assertEquals([ [ 0, 1 ], [ 120, 1 ], [ 240, 2 ] ],
+                          series.query(0, 290, 120, 290))
+
+        # Steps finer than any archive come from the finest one
+        self.assertEquals([ [ 280, 2 ], [ 290, 2 ] ],
+                          series.query(280, 290, 1, 290))
+
+    def test_store(self):
+        store = TimeSeriesStore(archives=((10, 6),), max_series=2)
+        self.assertEquals([], store.add({ 'a': 1 }, 0))
+        self.assertEquals([], store.add({ 'b': 2 }, 0))
+
+        # No more metrics than max_series
+        self.assertEquals([ 'c' ], store.add({ 'c': 3 }, 0))
+        self.assertEquals([ 'a', 'b' ], store.names())
+
+        # The one updated least recently makes room for a new one
+        self.assertEquals([], store.add({ 'a': 3, 'c': 3 }, 5))
+        self.assertEquals([ 'a', 'c' ], store.names())
+
+        self.assertEquals({ 'a': [ [ 0, 2 ] ], 'b': [] },
+                          store.query([ 'a', 'b' ], 0, 10, now=10))
+
+        # Dropped once their archives hold no value any more
+        store.add({ 'a': 4 }, 60)
+        self.assertEquals([ 'a', 'c' ], store.names())
+        store.add({ 'a': 4 }, 70)
+        self.assertEquals([ 'a' ], store.names())
+
+if __name__ == "__main__":
+    unittest.main()
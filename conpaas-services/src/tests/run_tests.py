@@ -3,12 +3,35 @@ import unittest
 from core import test_agent
 from core import test_git
 from core import test_clouds
+from core import test_https
+from core import test_fanout
+from core import test_context
+from core import test_manager
+from core import test_ganglia
+from core import test_timeseries
+from core import test_histogram
+from services import test_autoscaling
+from services import test_performance
 
 suites = [
     unittest.TestLoader().loadTestsFromTestCase(test_agent.TestAgent),
     unittest.TestLoader().loadTestsFromTestCase(test_git.TestGit),
     unittest.TestLoader().loadTestsFromTestCase(test_clouds.TestCloudsBase),
     unittest.TestLoader().loadTestsFromTestCase(test_clouds.TestCloudDummy),
+    unittest.TestLoader().loadTestsFromTestCase(test_https.TestHttps),
+    unittest.TestLoader().loadTestsFromTestCase(test_https.TestAnnounce),
+    unittest.TestLoader().loadTestsFromTestCase(test_https.TestMultipart),
+    unittest.TestLoader().loadTestsFromTestCase(test_https.TestKeyPool),
+    unittest.TestLoader().loadTestsFromTestCase(test_fanout.TestFanout),
+    unittest.TestLoader().loadTestsFromTestCase(test_context.TestContextCache),
+    unittest.TestLoader().loadTestsFromTestCase(test_manager.TestWaitForState),
+    unittest.TestLoader().loadTestsFromTestCase(test_manager.TestGetMetrics),
+    unittest.TestLoader().loadTestsFromTestCase(test_ganglia.TestGanglia),
+    unittest.TestLoader().loadTestsFromTestCase(test_ganglia.TestLogTailer),
+    unittest.TestLoader().loadTestsFromTestCase(test_timeseries.TestTimeSeries),
+    unittest.TestLoader().loadTestsFromTestCase(test_histogram.TestHistogram),
+    unittest.TestLoader().loadTestsFromTestCase(test_autoscaling.TestAutoscaling),
+    unittest.TestLoader().loadTestsFromTestCase(test_performance.TestPerformance),
 ]
 
 alltests = unittest.TestSuite(suites)
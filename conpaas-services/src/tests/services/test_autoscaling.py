@@ -0,0 +1,157 @@
+import unittest
+from threading import RLock, Thread
+
+from conpaas.core.clouds.dummy import DummyCloud
+from conpaas.services.webservers.manager.config import PHPServiceConfiguration
+from conpaas.services.webservers.manager.config import WebServiceNode
+from conpaas.services.webservers.manager.autoscaling import Autoscaler
+from conpaas.services.webservers.manager.autoscaling import ScalingPolicy
+
+def count_roles(config):
+    config.proxy_count = len(config.getProxyServiceNodes())
+    config.web_count = len(config.getWebServiceNodes())
+    config.backend_count = len(config.getBackendServiceNodes())
+
+class ScalingManager(object):
+    """Webservers manager adding and removing nodes from a DummyCloud"""
+
+    S_RUNNING = 'RUNNING'
+    S_ADAPTING = 'ADAPTING'
+
+    def __init__(self):
+        self.cloud = DummyCloud('dummy', None)
+        self.state = self.S_RUNNING
+        self.update_lock = RLock()
+        self.config = PHPServiceConfiguration()
+        self._add({ 'runProxy': True }, { 'runWeb': True },
+                  { 'runBackend': True })
+
+    def _add(self, *roles):
+        nodes = self.cloud.new_instances(len(roles))
+        for node, kwargs in zip(nodes, roles):
+            self.config.serviceNodes[node.id] = WebServiceNode(node, **kwargs)
+        count_roles(self.config)
+
+    def _state_get(self):
+        return self.state
+
+    def _state_set(self, state, msg=''):
+        self.state = state
+
+    def _configuration_get(self):
+        return self.config
+
+    def do_add_nodes(self, config, proxy, web, backend, cloud):
+        self._add(*([ { 'runProxy': True } ] * proxy + [ { 'runWeb': True } ] * web +
+                    [ { 'runBackend': True } ] * backend))
+        self.state = self.S_RUNNING
+
+    def do_remove_nodes(self, config, proxy, web, backend):
+        for node in (config.getProxyServiceNodes()[:proxy] +
+                     config.getWebServiceNodes()[:web] +
+                     config.getBackendServiceNodes()[:backend]):
+            del config.serviceNodes[node.id]
+        count_roles(config)
+        self.state = self.S_RUNNING
+
+class TestAutoscaling(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = ScalingManager()
+        self.response_time = 0
+
+    def feed(self):
+        """Synthetic metrics: every backend node answers 10 requests/s in
+        self.response_time ms"""
+        return dict((node.ip, { 'php_request_rate': 10,
+                                'php_response_time': self.response_time })
+                    for node in self.manager.config.getBackendServiceNodes())
+
+    def autoscaler(self, **params):
+        policy = ScalingPolicy('backend', max_response_time=200,
+                               min_response_time=50, max_nodes=3, **params)
+        return Autoscaler(self.manager, [ policy ], read_metrics=self.feed)
+
+    def test_scale_out_and_in(self):
+        autoscaler = self.autoscaler(breach_periods=2, cooldown=0)
+
+        # A single slow period is not enough
+        self.response_time = 500
+        self.assertEquals(None, autoscaler.evaluate(now=1))
+        self.assertEquals(('backend', 1), autoscaler.evaluate(now=2))
+        self.assertEquals(2, self.manager.config.backend_count)
+
+        # Between both thresholds, nothing happens
+        self.response_time = 100
+        for now in range(3, 10):
+            self.assertEquals(None, autoscaler.evaluate(now=now))
+
+        self.response_time = 10
+        self.assertEquals(None, autoscaler.evaluate(now=10))
+        self.assertEquals(('backend', -1), autoscaler.evaluate(now=11))
+        self.assertEquals(1, self.manager.config.backend_count)
+
+        # Never below min_nodes
+        for now in range(12, 20):
+            self.assertEquals(None, autoscaler.evaluate(now=now))
+        self.assertEquals(1, self.manager.config.backend_count)
+
+        self.assertEquals([ 1, -1 ], [ entry['change'] for entry in
+                                       autoscaler.to_dict()['history'] ])
+
+    def test_cooldown_and_max_nodes(self):
+        autoscaler = self.autoscaler(breach_periods=1, cooldown=60)
+        self.response_time = 500
+
+        self.assertEquals(('backend', 1), autoscaler.evaluate(now=100))
+        self.assertEquals(None, autoscaler.evaluate(now=130))
+        self.assertEquals(('backend', 1), autoscaler.evaluate(now=160))
+        self.assertEquals(None, autoscaler.evaluate(now=300))
+        self.assertEquals(3, self.manager.config.backend_count)
+
+    def test_not_running(self):
+        autoscaler = self.autoscaler(breach_periods=1, cooldown=0)
+        self.response_time = 500
+
+        self.manager.state = 'ADAPTING'
+        self.assertEquals(None, autoscaler.evaluate(now=1))
+        self.assertEquals(1, self.manager.config.backend_count)
+
+    def test_concurrent_add_nodes(self):
+        autoscaler = self.autoscaler(breach_periods=1, cooldown=0)
+        self.response_time = 500
+
+        # A POST method of the manager checking and changing its state
+        results = []
+        with self.manager.update_lock:
+            evaluation = Thread(target=lambda: results.append(
+                autoscaler.evaluate(now=1)))
+            evaluation.start()
+            evaluation.join(0.2)
+            self.failUnless(evaluation.isAlive())
+            self.manager.state = 'ADAPTING'
+
+        evaluation.join()
+        self.assertEquals([ None ], results)
+        self.assertEquals(1, self.manager.config.backend_count)
+
+    def test_no_metrics(self):
+        def broken_feed():
+            raise IOError('gmond is down')
+
+        autoscaler = self.autoscaler(breach_periods=1, cooldown=0)
+        autoscaler.read_metrics = broken_feed
+        self.assertEquals(None, autoscaler.evaluate(now=1))
+
+        # Missing metrics do not count as a fast service
+        autoscaler.read_metrics = lambda: {}
+        self.assertEquals(None, autoscaler.evaluate(now=2))
+
+    def test_wrong_policy(self):
+        self.assertRaises(ValueError, ScalingPolicy, 'database', 100)
+        self.assertRaises(ValueError, ScalingPolicy, 'web', 100, 200)
+        self.assertRaises(ValueError, ScalingPolicy, 'web', 100,
+                          min_nodes=4, max_nodes=2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+
+from conpaas.core import histogram
+from conpaas.core.timeseries import TimeSeriesStore
+from conpaas.core.clouds.dummy import DummyCloud
+from conpaas.services.webservers.manager.config import PHPServiceConfiguration
+from conpaas.services.webservers.manager.config import WebServiceNode
+from conpaas.services.webservers.manager.performance import node_metrics
+from conpaas.services.webservers.manager.performance import role_metrics
+from conpaas.services.webservers.manager.performance import weighted_percentile
+from conpaas.services.webservers.manager.performance import ServicePerformance
+from conpaas.services.webservers.manager.performance import PerformanceMonitor
+
+class MonitoredManager(object):
+    """Webservers manager with a proxy, a web and a backend node from a
+    DummyCloud"""
+
+    S_RUNNING = 'RUNNING'
+
+    def __init__(self):
+        self.state = self.S_RUNNING
+        self.metrics = TimeSeriesStore()
+        self.config = PHPServiceConfiguration()
+        roles = ({ 'runProxy': True }, { 'runWeb': True },
+                 { 'runBackend': True })
+        for node, kwargs in zip(DummyCloud('dummy', None).new_instances(3), roles):
+            self.config.serviceNodes[node.id] = WebServiceNode(node, **kwargs)
+
+        self.proxy, self.web, self.backend = [ nodes[0].ip for nodes in (
+            self.config.getProxyServiceNodes(), self.config.getWebServiceNodes(),
+            self.config.getBackendServiceNodes()) ]
+
+    def _state_get(self):
+        return self.state
+
+    def _configuration_get(self):
+        return self.config
+
+    def record_metrics(self, values, now):
+        self.metrics.add(values, now)
+
+class TestPerformance(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = MonitoredManager()
+
+    def proxy_metrics(self, web_time, php_time, errors=0):
+        return { self.manager.proxy: {
+            'web_request_rate_lb': 30, 'web_response_time_lb': web_time,
+            'php_request_rate_lb': 10, 'php_response_time_lb': php_time,
+            'error_rate_lb': errors, 'throughput_lb': 4096 } }
+
+    def test_role_metrics(self):
+        hosts = self.proxy_metrics(10, 50, errors=1)
+        hosts[self.manager.backend] = { 'php_request_rate': 10,
+                                        'php_response_time': 40 }
+        metrics = role_metrics(self.manager.config, hosts)
+
+        self.assertEquals({ 'nodes': 1, 'reporting': 1, 'request_rate': 40,
+                            'response_time': 20, 'error_rate': 1,
+                            'throughput': 4096 }, metrics['proxy'])
+        self.assertEquals({ 'nodes': 1, 'reporting': 0, 'request_rate': 0,
+                            'response_time': 0, 'error_rate': 0,
+                            'throughput': 0 }, metrics['web'])
+        self.assertEquals(40, metrics['backend']['response_time'])
+
+    def test_weighted_percentile(self):
+        values = [ (10, 1), (30, 1), (20, 98) ]
+        self.assertEquals(20, weighted_percentile(values, 50))
+        self.assertEquals(20, weighted_percentile(values, 99))
+        self.assertEquals(30, weighted_percentile(values, 100))
+        self.assertEquals(0, weighted_percentile([], 50))
+
+    def test_windows(self):
+        performance = ServicePerformance(windows=(60, 300))
+        config = self.manager.config
+
+        performance.add(node_metrics(config, self.proxy_metrics(1000, 1000, 4)), 0)
+        for now in range(15, 286, 15):
+            performance.add(node_metrics(config, self.proxy_metrics(10, 50)), now)
+
+        proxy = performance.summary(300, 285)['proxy']
+        self.assertEquals(20, proxy['collections'])
+        self.assertEquals(0.2, proxy['error_rate'])
+        self.assertEquals({ 'p50': 10, 'p90': 50, 'p95': 50, 'p99': 1000,
+                            'max': 1000 }, proxy['response_time'])
+
+        # The slow collection is dropped, being older than the longest window
+        performance.add(node_metrics(config, self.proxy_metrics(10, 50)), 300)
+        self.assertEquals(20, len(performance.collections))
+
+        proxy = performance.summary(60, 300)['proxy']
+        self.assertEquals(4, proxy['collections'])
+        self.assertEquals(40, proxy['request_rate'])
+        self.assertEquals(0, proxy['error_rate'])
+        self.assertEquals(4096, proxy['throughput'])
+        self.assertEquals({ 'p50': 10, 'p90': 50, 'p95': 50, 'p99': 50,
+                            'max': 50 }, proxy['response_time'])
+
+        self.assertEquals(0, performance.summary(60, 300)['web']['request_rate'])
+
+    def histogram_metrics(self, name, times, duration=10):
+        latencies = histogram.LatencyHistogram()
+        for time in times:
+            latencies.add(time)
+        return histogram.to_metrics(name, latencies, duration)
+
+    def test_histograms(self):
+        performance = ServicePerformance(windows=(60,))
+        config = self.manager.config
+
+        # 90 fast static requests and 10 slow PHP requests, then 100 fast
+        # static requests
+        proxy = self.manager.proxy
+        hosts = { proxy: self.histogram_metrics('web_response_time_lb', [ 10 ] * 90) }
+        hosts[proxy].update(
+            self.histogram_metrics('php_response_time_lb', [ 400 ] * 9 + [ 900 ]))
+        performance.add(node_metrics(config, hosts), 15)
+
+        hosts = { proxy: self.histogram_metrics('web_response_time_lb', [ 10 ] * 100) }
+        performance.add(node_metrics(config, hosts), 30)
+
+        fast = histogram.upper_bound(histogram.bucket(10))
+        response_time = performance.summary(60, 30)['proxy']['response_time']
+        self.assertEquals({ 'p50': fast, 'p90': fast, 'p95': fast,
+                            'p99': histogram.upper_bound(histogram.bucket(400)),
+                            'max': 900 }, response_time)
+
+    def test_monitor(self):
+        monitor = PerformanceMonitor(self.manager,
+                                     read_metrics=lambda: self.proxy_metrics(10, 50))
+        monitor.collect(now=10)
+
+        # Nothing is collected while the service is not running
+        self.manager.state = 'ADAPTING'
+        monitor.collect(now=20)
+
+        summary = monitor.performance.summary(60, 20)
+        self.assertEquals(1, summary['proxy']['collections'])
+        self.assertEquals(40, summary['proxy']['request_rate'])
+
+        # The metrics of each host and role are kept
+        proxy = self.manager.proxy
+        self.assertEquals({ proxy + '/web_response_time_lb': [ [ 0, 10 ] ],
+                            'proxy/request_rate': [ [ 0, 40 ] ] },
+                          self.manager.metrics.query(
+                            [ proxy + '/web_response_time_lb',
+                              'proxy/request_rate' ], 0, 20, step=60, now=20))
+
+    def test_monitor_histograms(self):
+        hosts = self.proxy_metrics(10, 50)
+        hosts[self.manager.proxy].update(
+            self.histogram_metrics('php_response_time_lb', [ 40, 60 ]))
+        monitor = PerformanceMonitor(self.manager, read_metrics=lambda: hosts)
+        monitor.collect(now=10)
+
+        # The percentiles are kept, not the buckets
+        names = self.manager.metrics.names()
+        self.assertTrue('proxy/response_time_p99' in names)
+        self.assertTrue(self.manager.proxy + '/php_response_time_lb_p99' in names)
+        self.assertFalse([ name for name in names if '_bucket_' in name ])
+        self.assertEquals({ 'proxy/response_time_max': [ [ 0, 60 ] ] },
+                          self.manager.metrics.query(
+                            [ 'proxy/response_time_max' ], 0, 20, step=60, now=20))
+
+if __name__ == "__main__":
+    unittest.main()